@@ -4,6 +4,8 @@ Configures endpoints for DB
 
 """
 
+from __future__ import annotations
+
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -17,6 +19,7 @@ from authlib.integrations.flask_client import OAuth
 from .config import DevelopmentConfig, ProductionConfig, TestingConfig
 from .conn import dburl
 from flask_socketio import SocketIO
+from socketio import RedisManager
 
 db = SQLAlchemy()
 ma = Marshmallow()
@@ -34,8 +37,35 @@ socketio = SocketIO(
 )
 
 
-def create_app(debug: bool = False) -> Flask:
-    """init flask app"""
+def socketio_manager(config, write_only: bool = False) -> RedisManager | None:
+    """Client manager sharing Socket.IO events between processes
+
+    Events emitted by any worker or process are published on the redis
+    channel and delivered by the worker hosting the subscribed client.
+
+    Args:
+        config: App config with SOCKETIO_MESSAGE_QUEUE and SOCKETIO_CHANNEL
+        write_only: Only publish events, for processes without client sockets
+
+    Returns:
+        Redis client manager, None when no message queue is configured.
+    """
+
+    url = config.get("SOCKETIO_MESSAGE_QUEUE")
+    if not url:
+        return None
+    return RedisManager(
+        url, channel=config.get("SOCKETIO_CHANNEL"), write_only=write_only
+    )
+
+
+def create_app(debug: bool = False, emit_only: bool = False) -> Flask:
+    """init flask app
+
+    Processes that only ingest data, such as the queue consumer, pass emit_only
+    so Socket.IO events are published through the message queue without
+    serving client sockets.
+    """
     app = Flask(__name__)
     app.secret_key = os.getenv("APP_SECRET_KEY")
     # handle config type
@@ -61,7 +91,10 @@ def create_app(debug: bool = False) -> Flask:
     bcrypt.init_app(app)
 
     CORS(app, resources={r"/*": {"methods": "*"}})
-    socketio.init_app(app)
+    # an explicit None resets the manager of a previous app
+    socketio.init_app(
+        app, client_manager=socketio_manager(app.config, write_only=emit_only)
+    )
 
     DEBUG_SOCKETIO = os.getenv("DEBUG_SOCKETIO", "False").lower() == "true"
 
@@ -107,9 +140,25 @@ def create_app(debug: bool = False) -> Flask:
     server_session.init_app(app)
     app.config.from_prefixed_env()
 
+    from .utils.ingest_queue import ingest_queue
+
+    ingest_queue.init_app(app)
+
+    from .utils.query_cache import query_cache
+
+    query_cache.init_app(app)
+
+    from .models.cell import cell_cache
+    from .models.logger import logger_cache
+
+    cell_cache.init_app(app)
+    logger_cache.init_app(app)
+
     """-routing-"""
     app.app_context().push()
     from .resources.health_check import Health_Check
+    from .resources.id_headroom import Id_Headroom
+    from .resources.ingest_queue import Ingest_Queue
     from .resources.cell_id import Cell_Id
     from .resources.power_data import Power_Data
     from .resources.teros_data import Teros_Data
@@ -119,9 +168,10 @@ def create_app(debug: bool = False) -> Flask:
     from .resources.session import Session_r
     from .resources.users_data import User_Data
     from .resources.data_availability import DataAvailability
+    from .resources.export import Export
     from .resources.sensor_catalog import SensorCatalog
     from .resources.equation_validate import EquationValidate
-    from .resources.cell_sensors import Cell_Sensors
+    from .resources.cell_sensors import Cell_Sensors, Cell_Sensor_Data
     from .resources.tag import Tag, TagDetail
     from .resources.cell_tags import CellTags, CellTagDetail, CellsByTag
     from .resources.cell_users import CellUsers, CellUserDetail, CellByUser, CellShare
@@ -131,15 +181,19 @@ def create_app(debug: bool = False) -> Flask:
     from .auth.routes import auth
 
     api.add_resource(Health_Check, "/")
+    api.add_resource(Id_Headroom, "/health/ids")
+    api.add_resource(Ingest_Queue, "/ingest/queue")
     api.add_resource(Cell, "/cell/", "/cell/<int:cellId>")
     api.add_resource(Cell_Id, "/cell/id")
     api.add_resource(Cell_Sensors, "/cell/<int:cell_id>/sensors")
+    api.add_resource(Cell_Sensor_Data, "/cell/<int:cell_id>/sensors/data")
     api.add_resource(Logger, "/logger/", "/logger/<int:logger_id>")
     api.add_resource(Power_Data, "/power/", "/power/<int:cell_id>")
     api.add_resource(Teros_Data, "/teros/", "/teros/<int:cell_id>")
     api.add_resource(SensorData, "/sensor/")
     api.add_resource(SensorData_Json, "/sensor_json/")
     api.add_resource(DataAvailability, "/data-availability/")
+    api.add_resource(Export, "/export/")
     api.add_resource(SensorCatalog, "/catalog/sensors")
     api.add_resource(EquationValidate, "/equations/validate")
     api.add_resource(Session_r, "/session")
@@ -162,4 +216,11 @@ def create_app(debug: bool = False) -> Flask:
     api.add_resource(CellShare, "/cell/<int:cell_id>/share")
 
     app.register_blueprint(auth, url_prefix="/api")
+
+    if emit_only:
+        # without a running event loop the emit window would never close
+        from .resources.util import emit_window
+
+        emit_window.window = 0
+
     return app
@@ -28,6 +28,26 @@ class Config(object):
     SESSION_REDIS = redis.from_url("redis://redis:6379")
     TTN_API_KEY = os.getenv("TTN_API_KEY")
     TTN_APP_ID = os.getenv("TTN_APP_ID")
+    # uploads are queued on a redis stream when set, see utils/ingest_queue.py
+    INGEST_QUEUE_URL = os.getenv("INGEST_QUEUE_URL")
+    INGEST_STREAM = os.getenv("INGEST_STREAM", "ingest")
+    INGEST_GROUP = os.getenv("INGEST_GROUP", "ingest")
+    INGEST_STREAM_MAXLEN = int(os.getenv("INGEST_STREAM_MAXLEN", "1000000"))
+    # skip duplicate time-series rows, requires the unique indexes created by
+    # utils/dedup.py
+    INGEST_DEDUP = os.getenv("INGEST_DEDUP", "False").lower() == "true"
+    # share Socket.IO events between workers and ingest processes
+    SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE")
+    SOCKETIO_CHANNEL = os.getenv("SOCKETIO_CHANNEL", "flask-socketio")
+    # cache time-series query results on redis when set, see
+    # utils/query_cache.py
+    QUERY_CACHE_URL = os.getenv("QUERY_CACHE_URL")
+    QUERY_CACHE_PREFIX = os.getenv("QUERY_CACHE_PREFIX", "query")
+    QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "86400"))
+    # share invalidations of the cell and logger existence caches between
+    # workers and ingest processes when set, see utils/existence_cache.py
+    EXISTENCE_CACHE_URL = os.getenv("EXISTENCE_CACHE_URL")
+    EXISTENCE_CACHE_STREAM = os.getenv("EXISTENCE_CACHE_STREAM", "existence")
 
 
 class ProductionConfig(Config):
@@ -1,4 +1,5 @@
 import logging
+import re
 from logging.config import fileConfig
 
 from flask import current_app
@@ -44,6 +45,34 @@ target_db = current_app.extensions["migrate"].db
 # ... etc.
 
 
+# partitions of the time-series tables and their copies while they are migrated
+# to partitioning, managed by api/utils/partition.py
+PARTITION_TABLES = re.compile(
+    r"^(power_data|teros_data|data)_(p\d{6}|default|partitioned|unpartitioned)$"
+)
+
+
+# ids of the time-series tables and their bigint copies while they are widened,
+# managed by api/utils/bigint_ids.py
+ID_TABLES = ("power_data", "teros_data", "data")
+
+
+def include_name(name, type_, parent_names):
+    if type_ == "table":
+        return PARTITION_TABLES.match(name) is None
+    if type_ == "column" and parent_names["table_name"] in ID_TABLES:
+        return name != "id_big"
+    return True
+
+
+def compare_type(
+    context, inspected_column, metadata_column, inspected_type, metadata_type
+):
+    if metadata_column.table.name in ID_TABLES and metadata_column.name == "id":
+        return False
+    return None
+
+
 def get_metadata():
     if hasattr(target_db, "metadatas"):
         return target_db.metadatas[None]
@@ -94,7 +123,11 @@ def run_migrations_online():
             connection=connection,
             target_metadata=get_metadata(),
             process_revision_directives=process_revision_directives,
-            **current_app.extensions["migrate"].configure_args
+            include_name=include_name,
+            **{
+                **current_app.extensions["migrate"].configure_args,
+                "compare_type": compare_type,
+            },
         )
 
         with context.begin_transaction():
@@ -0,0 +1,133 @@
+"""covering indexes of time series tables
+
+Replaces the (cell_id, ts) and (sensor_id, ts) indexes of power_data,
+teros_data and data with indexes including the columns read by time range, so
+these reads are index-only scans, and drops the single column ts indexes. Time
+ranges are already narrowed down by partition pruning.
+
+Indexes are built without blocking writes: concurrently, or per partition and
+attached to the index of a partitioned table. Tables still migrated to
+partitioning get the same indexes on their partitioned copy.
+
+Revision ID: 0d47fa52316d
+Revises: e0767c57e457
+Create Date: 2026-10-18 17:27:41.991197
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0d47fa52316d"
+down_revision = "e0767c57e457"
+branch_labels = None
+depends_on = None
+
+# key column and columns included in the index of each table
+COVERING = {
+    "power_data": ("cell_id", ("id", "current", "voltage")),
+    "teros_data": ("cell_id", ("id", "vwc", "raw_vwc", "temp", "ec")),
+    "data": ("sensor_id", ("id", "float_val", "int_val")),
+}
+
+
+def _relkind(conn, name):
+    return conn.execute(
+        sa.text("SELECT relkind FROM pg_class WHERE relname = :name"),
+        {"name": name},
+    ).scalar()
+
+
+def _create_index(conn, name, table, definition, leaf):
+    """Creates an index concurrently, per partition if table is partitioned
+
+    Partition indexes are named {partition}_{leaf}.
+    """
+
+    if _relkind(conn, table) != "p":
+        indexes = [(name, table)]
+    else:
+        op.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+        partitions = conn.execute(
+            sa.text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST(:table AS regclass) "
+                "AND NOT EXISTS (SELECT 1 FROM pg_inherits h "
+                "JOIN pg_index x ON x.indexrelid = h.inhrelid "
+                "WHERE h.inhparent = CAST(:name AS regclass) "
+                "AND x.indrelid = c.oid)"
+            ),
+            {"table": table, "name": name},
+        ).scalars()
+        indexes = [(f"{partition}_{leaf}", partition) for partition in partitions]
+
+    for index, relation in indexes:
+        valid = conn.execute(
+            sa.text(
+                "SELECT i.indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+            ),
+            {"name": index},
+        ).scalar()
+        if valid is False:
+            # left behind by an interrupted build
+            op.execute(f"DROP INDEX CONCURRENTLY {index}")
+        op.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {relation} "
+            f"{definition}"
+        )
+        if index != name:
+            op.execute(f"ALTER INDEX {name} ATTACH PARTITION {index}")
+
+
+def _drop_index(conn, name, table):
+    # indexes of partitioned tables cannot be dropped concurrently, dropping
+    # them only locks the table for a moment
+    if _relkind(conn, table) == "p":
+        op.execute(f"DROP INDEX IF EXISTS {name}")
+    else:
+        op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def _tables(conn, table):
+    """The table and its partitioned copy while it is migrated, with the
+    suffix of their index names"""
+
+    for name, suffix in ((table, ""), (f"{table}_partitioned", "_partitioned")):
+        if _relkind(conn, name) is not None:
+            yield name, suffix
+
+
+def upgrade():
+    conn = op.get_bind()
+    with op.get_context().autocommit_block():
+        for table, (key, include) in COVERING.items():
+            for name, suffix in _tables(conn, table):
+                index = f"idx_{table}_{key}_ts{suffix}"
+                covering = f"idx_{table}_{key}_ts_covering{suffix}"
+                _create_index(
+                    conn,
+                    covering,
+                    name,
+                    f"({key}, ts) INCLUDE ({', '.join(include)})",
+                    f"{key}_ts_covering",
+                )
+                _drop_index(conn, index, name)
+                op.execute(f"ALTER INDEX {covering} RENAME TO {index}")
+                _drop_index(conn, f"ix_{table}_ts{suffix}", name)
+
+
+def downgrade():
+    conn = op.get_bind()
+    with op.get_context().autocommit_block():
+        for table, (key, _) in COVERING.items():
+            for name, suffix in _tables(conn, table):
+                index = f"idx_{table}_{key}_ts{suffix}"
+                plain = f"idx_{table}_{key}_ts_plain{suffix}"
+                _create_index(conn, plain, name, f"({key}, ts)", f"{key}_ts")
+                _drop_index(conn, index, name)
+                op.execute(f"ALTER INDEX {plain} RENAME TO {index}")
+                _create_index(conn, f"ix_{table}_ts{suffix}", name, "(ts)", "ts")
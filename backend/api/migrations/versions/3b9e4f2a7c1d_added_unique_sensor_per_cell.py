@@ -0,0 +1,69 @@
+"""added unique sensor per cell
+
+Revision ID: 3b9e4f2a7c1d
+Revises: 14612231efb8
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3b9e4f2a7c1d"
+down_revision = "14612231efb8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # Merge duplicate sensors into the oldest one so the constraint can be
+    # created. Duplicates were possible when two uploads created the same
+    # sensor concurrently.
+    bind.execute(
+        sa.text(
+            """
+            WITH ranked AS (
+                SELECT
+                    id,
+                    MIN(id) OVER (PARTITION BY cell_id, name, measurement) AS keep_id
+                FROM sensor
+            )
+            UPDATE data
+            SET sensor_id = ranked.keep_id
+            FROM ranked
+            WHERE data.sensor_id = ranked.id AND ranked.id <> ranked.keep_id
+            """
+        )
+    )
+    bind.execute(
+        sa.text(
+            """
+            DELETE FROM sensor
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT
+                        id,
+                        MIN(id) OVER (
+                            PARTITION BY cell_id, name, measurement
+                        ) AS keep_id
+                    FROM sensor
+                ) ranked
+                WHERE id <> keep_id
+            )
+            """
+        )
+    )
+
+    with op.batch_alter_table("sensor", schema=None) as batch_op:
+        batch_op.create_unique_constraint(
+            "uq_sensor_cell_id_name_measurement", ["cell_id", "name", "measurement"]
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("sensor", schema=None) as batch_op:
+        batch_op.drop_constraint("uq_sensor_cell_id_name_measurement", type_="unique")
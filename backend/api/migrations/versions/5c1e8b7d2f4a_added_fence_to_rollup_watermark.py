@@ -0,0 +1,41 @@
+"""added fence to rollup watermark
+
+Bounds the rollup watermark by the ids of committed transactions rather than
+by the server timestamp of the rows, see utils/rollup.py.
+
+Revision ID: 5c1e8b7d2f4a
+Revises: 0d47fa52316d
+Create Date: 2026-10-18 18:20:14.518320
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "5c1e8b7d2f4a"
+down_revision = "0d47fa52316d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("rollup_watermark", schema=None) as batch_op:
+        # rows rolled up so far were committed under the previous lag
+        batch_op.add_column(
+            sa.Column("settled_id", sa.BigInteger(), server_default="0", nullable=False)
+        )
+        batch_op.add_column(sa.Column("fence_id", sa.BigInteger(), nullable=True))
+        batch_op.add_column(
+            sa.Column("fence_xids", postgresql.ARRAY(sa.Text()), nullable=True)
+        )
+    op.execute("UPDATE rollup_watermark SET settled_id = last_id")
+
+
+def downgrade():
+    with op.batch_alter_table("rollup_watermark", schema=None) as batch_op:
+        batch_op.drop_column("fence_xids")
+        batch_op.drop_column("fence_id")
+        batch_op.drop_column("settled_id")
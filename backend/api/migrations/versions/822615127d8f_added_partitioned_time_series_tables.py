@@ -0,0 +1,128 @@
+"""added partitioned time series tables
+
+Creates an empty copy of power_data, teros_data and data partitioned by month
+of ts, named {table}_partitioned, with a trigger mirroring the writes to each
+table into its copy. The existing rows are copied and the tables swapped by
+python -m api.utils.partition --migrate, see api/utils/partition.py.
+
+Revision ID: 822615127d8f
+Revises: 3d6330cea020
+Create Date: 2026-10-18 17:17:26.245651
+
+"""
+
+import re
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+from dateutil.relativedelta import relativedelta
+
+
+# revision identifiers, used by Alembic.
+revision = "822615127d8f"
+down_revision = "3d6330cea020"
+branch_labels = None
+depends_on = None
+
+TABLES = ("power_data", "teros_data", "data")
+
+# months created ahead of the current month, like api/utils/partition.py
+PREMAKE = 3
+
+MIRROR_FUNCTION = """
+CREATE FUNCTION mirror_to_partitioned() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        EXECUTE format(
+            'DELETE FROM %I WHERE id = $1 AND ts = $2',
+            TG_TABLE_NAME || '_partitioned'
+        ) USING OLD.id, OLD.ts;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        EXECUTE format(
+            'INSERT INTO %I SELECT ($1).* ON CONFLICT DO NOTHING',
+            TG_TABLE_NAME || '_partitioned'
+        ) USING NEW;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+
+def upgrade():
+    conn = op.get_bind()
+    op.execute(MIRROR_FUNCTION)
+
+    current = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    months = [current + relativedelta(months=i) for i in range(PREMAKE + 1)]
+
+    for table in TABLES:
+        shadow = f"{table}_partitioned"
+        op.execute(
+            f"CREATE TABLE {shadow} (LIKE {table} INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (ts)"
+        )
+        op.execute(
+            f"ALTER TABLE {shadow} ADD CONSTRAINT {table}_pkey_partitioned "
+            "PRIMARY KEY (id, ts)"
+        )
+
+        # foreign keys and indexes of the table, renamed by the swap
+        fkeys = conn.execute(
+            sa.text(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'"
+            ),
+            {"table": table},
+        )
+        for name, definition in fkeys.all():
+            op.execute(f"ALTER TABLE {shadow} ADD CONSTRAINT {name} {definition}")
+
+        indexes = conn.execute(
+            sa.text(
+                "SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indrelid = CAST(:table AS regclass) AND NOT i.indisprimary"
+            ),
+            {"table": table},
+        )
+        for name, definition in indexes.all():
+            definition = definition.replace(f" {name} ", f" {name}_partitioned ", 1)
+            definition = re.sub(
+                rf" ON (\w+\.)?{table} ", rf" ON \g<1>{shadow} ", definition, count=1
+            )
+            op.execute(definition)
+
+        op.execute(f"CREATE TABLE {table}_default PARTITION OF {shadow} DEFAULT")
+        for month in months:
+            op.execute(
+                f"CREATE TABLE {table}_p{month:%Y%m} PARTITION OF {shadow} "
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+                f"TO ('{month + relativedelta(months=1):%Y-%m-%d}')"
+            )
+
+        op.execute(
+            f"CREATE TRIGGER {table}_mirror AFTER INSERT OR UPDATE OR DELETE "
+            f"ON {table} FOR EACH ROW EXECUTE FUNCTION mirror_to_partitioned()"
+        )
+
+
+def downgrade():
+    conn = op.get_bind()
+    for table in TABLES:
+        kind = conn.execute(
+            sa.text("SELECT relkind FROM pg_class WHERE relname = :table"),
+            {"table": table},
+        ).scalar()
+        if kind == "p":
+            raise RuntimeError(
+                f"{table} was swapped with its partitioned copy, rename "
+                f"{table}_unpartitioned back to {table} by hand"
+            )
+
+    for table in TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_mirror ON {table}")
+        op.execute(f"DROP TABLE IF EXISTS {table}_partitioned")
+    op.execute("DROP FUNCTION IF EXISTS mirror_to_partitioned()")
@@ -0,0 +1,73 @@
+"""widened time series ids to bigint
+
+Adds an empty bigint column id_big to power_data, teros_data and data, and to
+their partitioned copies while they are migrated, with a trigger setting it to
+the id of every written row. The existing rows are backfilled and the columns
+swapped by python -m api.utils.bigint_ids --migrate, see
+api/utils/bigint_ids.py.
+
+Revision ID: e0767c57e457
+Revises: 822615127d8f
+Create Date: 2026-10-18 17:22:56.946985
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e0767c57e457"
+down_revision = "822615127d8f"
+branch_labels = None
+depends_on = None
+
+TABLES = ("power_data", "teros_data", "data")
+
+COPY_FUNCTION = """
+CREATE FUNCTION copy_id_to_id_big() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.id_big := NEW.id;
+    RETURN NEW;
+END
+$$
+"""
+
+
+def _id_type(conn, table):
+    return conn.execute(
+        sa.text(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = to_regclass(:table) AND attname = 'id'"
+        ),
+        {"table": table},
+    ).scalar()
+
+
+def upgrade():
+    conn = op.get_bind()
+    op.execute(COPY_FUNCTION)
+
+    for table in TABLES:
+        # both tables have the column while partitioning is migrated, the
+        # mirror trigger copies whole rows
+        for name in (table, f"{table}_partitioned"):
+            if _id_type(conn, name) != "integer":
+                continue
+            # no default, so the rows are not rewritten
+            op.execute(f"ALTER TABLE {name} ADD COLUMN id_big bigint")
+            op.execute(
+                f"CREATE TRIGGER {table}_id_big BEFORE INSERT OR UPDATE ON {name} "
+                "FOR EACH ROW EXECUTE FUNCTION copy_id_to_id_big()"
+            )
+
+
+def downgrade():
+    # ids already widened by the swap are kept, the previous revision works
+    # with bigint ids. Tables swapped for their partitioned copy since the
+    # upgrade are kept as {table}_unpartitioned.
+    for table in TABLES:
+        for name in (table, f"{table}_partitioned", f"{table}_unpartitioned"):
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_id_big ON {name}")
+            op.execute(f"ALTER TABLE IF EXISTS {name} DROP COLUMN IF EXISTS id_big")
+    op.execute("DROP FUNCTION IF EXISTS copy_id_to_id_big()")
@@ -10,6 +10,7 @@ from . import data as data  # noqa: E402,F401
 from . import logger as logger  # noqa: E402,F401
 from . import oauth_token as oauth_token  # noqa: E402,F401
 from . import power_data as power_data  # noqa: E402,F401
+from . import rollup as rollup  # noqa: E402,F401
 from . import sensor as sensor  # noqa: E402,F401
 from . import teros_data as teros_data  # noqa: E402,F401
 from . import user as user  # noqa: E402,F401
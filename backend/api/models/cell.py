@@ -1,4 +1,6 @@
 from ..models import db
+from ..utils.existence_cache import ExistenceCache
+from sqlalchemy import event
 
 """"This is the reference; we stole this from commenter
 https://stackoverflow.com/questions/5756559/how-to-build-many-to-many-relations-using-sqlalchemy-a-good-example"""
@@ -113,6 +115,16 @@ class Cell(db.Model):
         db.session.commit()
 
 
+# existence of cells checked on the ingest path
+cell_cache = ExistenceCache(Cell)
+
+
+@event.listens_for(Cell, "after_insert")
+@event.listens_for(Cell, "after_delete")
+def _invalidate_cell_cache(_mapper, _connection, target):
+    cell_cache.invalidate(target.id)
+
+
 class Tag(db.Model):
     __tablename__ = "tag"
 
@@ -1,17 +1,29 @@
 from ..models import db
+from .partition import register_partitions
+from .rollup import register_rollup
 
 
 class Data(db.Model):
     """Table of data"""
 
     __tablename__ = "data"
-    __table_args__ = (db.Index("idx_data_sensor_id_ts", "sensor_id", "ts"),)
+    __table_args__ = (
+        # includes the columns read by time range for index-only scans
+        db.Index(
+            "idx_data_sensor_id_ts",
+            "sensor_id",
+            "ts",
+            postgresql_include=["id", "float_val", "int_val"],
+        ),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
 
-    id = db.Column(db.Integer, primary_key=True)
+    # partitioned by month, see models/partition.py
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     sensor_id = db.Column(
         db.Integer, db.ForeignKey("sensor.id", ondelete="CASCADE"), nullable=False
     )
-    ts = db.Column(db.DateTime, nullable=False, index=True)
+    ts = db.Column(db.DateTime, primary_key=True)
     ts_server = db.Column(db.DateTime, server_default=db.func.now(), index=True)
     float_val = db.Column(db.Float, nullable=True)
     int_val = db.Column(db.Integer, nullable=True)
@@ -27,3 +39,13 @@ class Data(db.Model):
     def save(self):
         db.session.add(self)
         db.session.commit()
+
+
+register_partitions(Data)
+
+register_rollup(
+    "data",
+    Data,
+    Data.sensor_id,
+    {"value": db.func.coalesce(Data.float_val, Data.int_val)},
+)
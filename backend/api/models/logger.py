@@ -1,7 +1,8 @@
 from ..models import db
+from ..utils.existence_cache import ExistenceCache
 from .user import User
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import func
+from sqlalchemy import event, func
 from datetime import datetime
 import uuid
 
@@ -78,3 +79,13 @@ class Logger(db.Model):
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+
+
+# existence of loggers checked on the ingest path
+logger_cache = ExistenceCache(Logger)
+
+
+@event.listens_for(Logger, "after_insert")
+@event.listens_for(Logger, "after_delete")
+def _invalidate_logger_cache(_mapper, _connection, target):
+    logger_cache.invalidate(target.id)
@@ -0,0 +1,55 @@
+"""Monthly range partitions of the time-series tables
+
+power_data, teros_data and data are partitioned by range of ``ts`` into one
+partition per month, named ``{table}_pYYYYMM``, and a default partition
+``{table}_default`` holding rows outside of the existing months, e.g. of
+loggers with a wrong clock. Every partition has its own small indexes, queries
+with a ``ts`` range only scan the partitions of the range and old months are
+removed by dropping their partition.
+
+The primary key of a partitioned table includes the partition key, so the
+tables have a composite (id, ts) primary key. Ids are still unique, they are
+drawn from a single sequence.
+
+Partitions are maintained by utils/partition.py, which also migrates existing
+unpartitioned tables.
+"""
+
+from sqlalchemy import DDL, event
+
+PARTITIONED_TABLES = {}
+
+
+def partition_name(table: str, month) -> str:
+    """Name of the partition of table holding the rows of month"""
+
+    return f"{table}_p{month:%Y%m}"
+
+
+def default_partition_name(table: str) -> str:
+    """Name of the partition of table holding rows outside of its months"""
+
+    return f"{table}_default"
+
+
+def register_partitions(model):
+    """Registers a time-series model partitioned by month
+
+    The default partition is created with the table so rows can be inserted
+    before any monthly partition exists.
+
+    Args:
+        model: Model whose table is declared with
+            postgresql_partition_by="RANGE (ts)"
+    """
+
+    table = model.__table__
+    PARTITIONED_TABLES[table.name] = table
+    event.listen(
+        table,
+        "after_create",
+        DDL(
+            f"CREATE TABLE {default_partition_name(table.name)} "
+            f"PARTITION OF {table.name} DEFAULT"
+        ),
+    )
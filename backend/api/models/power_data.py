@@ -1,23 +1,47 @@
 from ..models import db
 from sqlalchemy.sql import func
-from .cell import Cell
-from .logger import Logger
+from sqlalchemy.exc import IntegrityError
+from .cell import Cell, cell_cache
+from .logger import Logger, logger_cache
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from ..utils.aggregate import aggregate_columns, extra_aggregates
+from ..utils.downsample import downsample_rows
+from ..utils.pagination import (
+    after_key,
+    encode_cursor,
+    encode_stream_cursor,
+    page_size,
+    streamed,
+)
+from ..utils.query_cache import query_cache
+from ..utils.resample import AUTO, auto_resample, bucket
+from .partition import register_partitions
+from .rollup import register_rollup, rollup_select
 
 
 class PowerData(db.Model):
     """Table for power measurements"""
 
     __tablename__ = "power_data"
-    __table_args__ = (db.Index("idx_power_data_cell_id_ts", "cell_id", "ts"),)
+    __table_args__ = (
+        # includes the columns read by time range for index-only scans
+        db.Index(
+            "idx_power_data_cell_id_ts",
+            "cell_id",
+            "ts",
+            postgresql_include=["id", "current", "voltage"],
+        ),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
 
-    id = db.Column(db.Integer, primary_key=True)
+    # partitioned by month, see models/partition.py
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     logger_id = db.Column(db.Integer, db.ForeignKey("logger.id"))
     cell_id = db.Column(
         db.Integer, db.ForeignKey("cell.id", ondelete="CASCADE"), nullable=False
     )
-    ts = db.Column(db.DateTime, nullable=False, index=True)
+    ts = db.Column(db.DateTime, primary_key=True)
     ts_server = db.Column(db.DateTime, server_default=db.func.now(), index=True)
     current = db.Column(db.Float)
     voltage = db.Column(db.Float)
@@ -50,21 +74,30 @@ class PowerData(db.Model):
         return power_data
 
     @staticmethod
-    def add_protobuf_power_data(logger_id, cell_id, ts, v, i):
+    def add_protobuf_power_data(logger_id, cell_id, ts, v, i, commit=True):
         """add new data point for power table
-        creates new logger or cell if they don't exist
+        returns None if the logger or cell don't exist
+
+        When commit is False the row is only added to the session so that
+        multiple measurements can be written in a single transaction.
         """
-        cur_logger = Logger.query.filter_by(id=logger_id).first()
-        cur_cell = Cell.query.filter_by(id=cell_id).first()
-        if cur_cell is None:
+        if not cell_cache.exists(cell_id):
             return None
-        if cur_logger is None:
+        if not logger_cache.exists(logger_id):
             return None
         power_data = PowerData(
-            logger_id=cur_logger.id, cell_id=cur_cell.id, ts=ts, voltage=v, current=i
+            logger_id=logger_id, cell_id=cell_id, ts=ts, voltage=v, current=i
         )
         db.session.add(power_data)
-        db.session.commit()
+        if commit:
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # the cell or logger was deleted by another worker
+                db.session.rollback()
+                cell_cache.invalidate(cell_id)
+                logger_cache.invalidate(logger_id)
+                return None
         return power_data
 
     def get_power_data_obj(
@@ -73,6 +106,13 @@ class PowerData(db.Model):
         start_time=None,
         end_time=None,
         stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
     ):
         """gets power data as a list of objects
 
@@ -81,78 +121,366 @@ class PowerData(db.Model):
         timestamp is from the measurement itself. When True, no data aggregation
         is preformed and the timestamp is when the measurement is inserted into
         the server.
+
+        The resample argument is a fixed unit or an interval such as 15m, see
+        utils/resample.py. Interval buckets are aligned to origin. With auto,
+        the interval giving about points buckets is chosen and returned as
+        resample.
+
+        Resampled data includes the aggregates of agg other than the average,
+        as {measurement}_{aggregate} lists, see utils/aggregate.py.
+
+        When downsample is set to one of utils.downsample.DOWNSAMPLE_METHODS, a
+        subset of at most points raw measurements is returned instead of
+        resampled averages.
+
+        Streamed data includes a cursor token of the ts_server and id of the
+        last row. When it is passed back as after only rows inserted since are
+        returned, once they were inserted utils.pagination.STREAM_LAG seconds
+        ago so a row of a transaction committing after the poll is not
+        skipped. Streamed rows are ordered by ts_server and id like the
+        cursor.
+
+        Raw data is paginated, at most limit rows are returned (capped by
+        utils.pagination.MAX_PAGE_SIZE) along with the next token to pass as
+        the cursor of the following page, None on the last page.
         """
 
-        if start_time is None:
-            start_time = datetime.now() - relativedelta(months=1)
-        if end_time is None:
-            end_time = datetime.now()
+        auto = resample == AUTO
+        if auto:
+            resample = auto_resample(
+                db.session,
+                PowerData.cell_id,
+                PowerData.ts,
+                [cell_id],
+                start_time,
+                end_time,
+                points,
+            )
+
+        def query(start_time, end_time):
+            return PowerData.get_power_data_cells(
+                [cell_id],
+                resample=resample,
+                start_time=start_time,
+                end_time=end_time,
+                stream=stream,
+                downsample=downsample,
+                points=points,
+                after=after,
+                limit=limit,
+                cursor=cursor,
+                origin=origin,
+                agg=agg,
+            )[cell_id]
+
+        data = query_cache.fetch(
+            "power_data",
+            cell_id,
+            query,
+            start_time,
+            end_time,
+            resample=resample,
+            stream=stream,
+            downsample=downsample,
+            points=points,
+            limit=limit,
+            cursor=cursor,
+            origin=origin,
+            agg=agg,
+        )
+        if auto:
+            data["resample"] = resample
+        return data
+
+    def get_power_data_cells(
+        cell_ids,
+        resample="hour",
+        start_time=None,
+        end_time=None,
+        stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
+    ):
+        """gets power data of multiple cells in a single query
+
+        Arguments are the same as get_power_data_obj, points applies to each
+        cell.
+
+        Returns:
+            Dictionary of cell id to the data of the cell, cells without data
+            have empty lists.
+        """
 
         data = {
-            "timestamp": [],
-            "v": [],
-            "i": [],
-            "p": [],
+            cell_id: {
+                "timestamp": [],
+                "v": [],
+                "i": [],
+                "p": [],
+            }
+            for cell_id in cell_ids
         }
+        if stream:
+            for cell_data in data.values():
+                cell_data["cursor"] = after
+
+        if resample == AUTO:
+            resample = auto_resample(
+                db.session,
+                PowerData.cell_id,
+                PowerData.ts,
+                cell_ids,
+                start_time,
+                end_time,
+                points,
+            )
+            # the chosen interval is reported with the data
+            for cell_data in data.values():
+                cell_data["resample"] = resample
+
+        extra = extra_aggregates(agg, resample, stream, downsample)
+        extra_keys = [f"{key}_{name}" for key in ("v", "i", "p") for name in extra]
+        for cell_data in data.values():
+            for key in extra_keys:
+                cell_data[key] = []
+
+        paged = not stream and resample == "none" and not downsample
+        if paged:
+            limit = page_size(limit)
+            for cell_data in data.values():
+                cell_data["next"] = None
+
+        # turn into dictionary
+        last = None
+        # ts_server and id of the last streamed row of each cell
+        last_keys = {}
+        for row in PowerData.get_power_data_rows(
+            cell_ids,
+            resample=resample,
+            start_time=start_time,
+            end_time=end_time,
+            stream=stream,
+            downsample=downsample,
+            points=points,
+            after=after,
+            limit=limit if paged else None,
+            cursor=cursor,
+            origin=origin,
+            agg=agg,
+        ):
+            if paged:
+                if limit == 0:
+                    # more rows are left
+                    token = encode_cursor(*last)
+                    for cell_data in data.values():
+                        cell_data["next"] = token
+                    break
+                limit -= 1
+                last = (row["cell_id"], row["timestamp"], row["id"])
+
+            cell_data = data[row["cell_id"]]
+            cell_data["timestamp"].append(row["timestamp"])
+            cell_data["v"].append(row["v"])
+            cell_data["i"].append(row["i"])
+            cell_data["p"].append(row["p"])
+            for key in extra_keys:
+                cell_data[key].append(row[key])
+            if stream:
+                key = (row["timestamp"], row["id"])
+                last_keys[row["cell_id"]] = max(last_keys.get(row["cell_id"], key), key)
+
+        for cell_id, key in last_keys.items():
+            data[cell_id]["cursor"] = encode_stream_cursor(*key)
+
+        return data
+
+    def get_power_data_rows(
+        cell_ids,
+        resample="hour",
+        start_time=None,
+        end_time=None,
+        stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
+    ):
+        """gets power data of cells one measurement at a time
+
+        Rows are fetched from a server-side cursor as they are iterated, so
+        memory does not grow with the range. Arguments are the same as
+        get_power_data_cells, except that raw rows are only paginated when a
+        limit is given. One row more than the limit is returned to tell if
+        there is a next page.
+
+        Yields:
+            Dictionary with the cell_id, timestamp, v, i and p of a
+            measurement, ordered by cell and timestamp. Streamed and paginated
+            rows also include their id, resampled rows the aggregates of agg.
+        """
+
+        if start_time is None:
+            start_time = datetime.utcnow() - relativedelta(months=1)
+        if end_time is None:
+            end_time = datetime.utcnow()
 
         stmt = None
 
+        if resample == AUTO:
+            resample = auto_resample(
+                db.session,
+                PowerData.cell_id,
+                PowerData.ts,
+                cell_ids,
+                start_time,
+                end_time,
+                points,
+            )
+
+        # measurement columns with the scale of their unit
+        scales = {"voltage": 1e3, "current": 1e6, "power": 1e6}
+        extra = extra_aggregates(agg, resample, stream, downsample)
+
+        rolled = None
+        if not stream and resample != "none" and not downsample:
+            rolled = rollup_select(
+                "power", cell_ids, resample, start_time, end_time, origin, extra
+            )
+
+        in_range = PowerData.cell_id.in_(cell_ids) & PowerData.ts.between(
+            start_time, end_time
+        )
+
         if not stream:
             # select from actual timestamp and aggregate data
-            if resample == "none":
+            if resample == "none" or downsample:
                 # resampling is not required: select data without aggregate functions
                 stmt = (
                     db.select(
+                        PowerData.id,
+                        PowerData.cell_id,
                         PowerData.ts.label("ts"),
                         (PowerData.voltage * 1e3).label("voltage"),
                         (PowerData.current * 1e6).label("current"),
                         (PowerData.voltage * PowerData.current * 1e6).label("power"),
                     )
-                    .where(
-                        (PowerData.cell_id == cell_id)
-                        & (PowerData.ts.between(start_time, end_time))
-                    )
-                    .order_by(PowerData.ts)
+                    .where(in_range)
+                    .order_by(PowerData.cell_id, PowerData.ts)
                 )
+                if limit is not None and not downsample:
+                    # keyset pagination on (cell_id, ts, id)
+                    if cursor is not None:
+                        stmt = stmt.where(
+                            after_key(
+                                PowerData.cell_id, PowerData.ts, PowerData.id, cursor
+                            )
+                        )
+                    stmt = stmt.order_by(PowerData.id).limit(limit + 1)
+            elif rolled is not None:
+                # aggregate from the rollups
+                rolled = rolled.subquery()
+                stmt = db.select(
+                    rolled.c.series_id.label("cell_id"),
+                    rolled.c.ts,
+                    (rolled.c.voltage * 1e3).label("voltage"),
+                    (rolled.c.current * 1e6).label("current"),
+                    (rolled.c.power * 1e6).label("power"),
+                    *(
+                        (
+                            rolled.c[f"{col}_{name}"]
+                            * (scale if name != "count" else 1)
+                        ).label(f"{col}_{name}")
+                        for col, scale in scales.items()
+                        for name in extra
+                    ),
+                ).order_by(rolled.c.series_id, rolled.c.ts)
             else:
                 # Handle normal resampling case
-                date_trunc = db.func.date_trunc(resample, PowerData.ts)
+                ts_bucket = bucket(resample, PowerData.ts, origin)
+                measurements = {
+                    "voltage": PowerData.voltage * 1e3,
+                    "current": PowerData.current * 1e6,
+                    "power": PowerData.voltage * PowerData.current * 1e6,
+                }
                 stmt = (
                     db.select(
-                        date_trunc.label("ts"),
+                        PowerData.cell_id,
+                        ts_bucket.label("ts"),
                         func.avg(PowerData.voltage * 1e3).label("voltage"),
                         func.avg(PowerData.current * 1e6).label("current"),
                         func.avg((PowerData.voltage * PowerData.current * 1e6)).label(
                             "power"
                         ),
+                        *aggregate_columns(measurements, extra, PowerData.ts),
                     )
-                    .where(
-                        (PowerData.cell_id == cell_id)
-                        & (PowerData.ts.between(start_time, end_time))
-                    )
-                    .group_by(date_trunc)
-                    .order_by(date_trunc)
+                    .where(in_range)
+                    .group_by(PowerData.cell_id, ts_bucket)
+                    .order_by(PowerData.cell_id, ts_bucket)
                 )
         else:
-            # select based off server timestamp for streaming data
+            # select based off server timestamp for streaming data, rows
+            # inserted since the previous poll with after
+            in_range &= streamed(PowerData.ts_server, PowerData.id, after)
             stmt = (
                 db.select(
+                    PowerData.id,
+                    PowerData.cell_id,
                     PowerData.ts_server.label("ts"),
                     (PowerData.voltage * 1e3).label("voltage"),
                     (PowerData.current * 1e6).label("current"),
                     (PowerData.voltage * PowerData.current * 1e6).label("power"),
                 )
-                .where(
-                    (PowerData.cell_id == cell_id)
-                    & (PowerData.ts.between(start_time, end_time))
-                )
-                .order_by(PowerData.ts_server)
+                .where(in_range)
+                .order_by(PowerData.ts_server, PowerData.id)
             )
-        # turn into dictionary
-        for row in db.session.execute(stmt).yield_per(1000):
-            data["timestamp"].append(row.ts)
-            data["v"].append(row.voltage)
-            data["i"].append(row.current)
-            data["p"].append(row.power)
+        if downsample and not stream:
+            rows = downsample_rows(
+                db.session,
+                stmt,
+                downsample,
+                ["power", "voltage", "current"],
+                start_time,
+                end_time,
+                points,
+                partition="cell_id",
+            )
+        else:
+            rows = db.session.execute(stmt).yield_per(1000)
 
-        return data
+        for row in rows:
+            meas = {
+                "cell_id": row.cell_id,
+                "timestamp": row.ts,
+                "v": row.voltage,
+                "i": row.current,
+                "p": row.power,
+            }
+            for key, col in zip(("v", "i", "p"), scales):
+                for name in extra:
+                    meas[f"{key}_{name}"] = row._mapping[f"{col}_{name}"]
+            if stream or limit is not None:
+                meas["id"] = row.id
+            yield meas
+
+
+register_partitions(PowerData)
+
+register_rollup(
+    "power",
+    PowerData,
+    PowerData.cell_id,
+    {
+        "voltage": PowerData.voltage,
+        "current": PowerData.current,
+        "power": PowerData.voltage * PowerData.current,
+    },
+)
@@ -0,0 +1,300 @@
+"""Rollups of the time-series tables
+
+Resampled queries average the raw rows of the range on every request. Rollups
+store the count, sum, minimum and maximum of each measurement per minute, hour
+and day bucket so resampled queries read a handful of rows per bucket instead.
+
+The rollups are maintained by utils/rollup.py, which aggregates the rows
+inserted since the last run and advances a watermark on the row ids. Queries
+combine the rollups of the buckets fully inside the requested range with the
+raw rows of the partial buckets at the range edges and of the rows past the
+watermark, so results are the same as aggregating the raw rows.
+"""
+
+from __future__ import annotations
+
+from datetime import timedelta
+from typing import NamedTuple
+
+from sqlalchemy import (
+    BigInteger,
+    and_,
+    case,
+    cast,
+    func,
+    literal_column,
+    or_,
+    select,
+    union_all,
+)
+
+from ..models import db
+from ..utils.aggregate import ROLLUP_AGGREGATES
+from ..utils.resample import DEFAULT_ORIGIN, bucket, naive_origin, parse_interval
+
+ROLLUP_RESOLUTIONS = ("minute", "hour", "day")
+
+# coarsest rollup each resample level can be computed from, others read raw
+RESAMPLE_RESOLUTION = {
+    "minute": "minute",
+    "hour": "hour",
+    "day": "day",
+    "week": "day",
+    "month": "day",
+    "quarter": "day",
+    "year": "day",
+}
+
+
+def rollup_resolution(resample: str, origin=None) -> str | None:
+    """Coarsest rollup a resample level can be computed from
+
+    Interval buckets are computed from the coarsest rollup whose buckets each
+    fall inside a single interval bucket, i.e. the width of the interval and the
+    offset of its origin are multiples of the rollup resolution.
+
+    Returns:
+        Resolution of ROLLUP_RESOLUTIONS or None if the level has no rollup.
+    """
+
+    width = parse_interval(resample)
+    if width is None:
+        return RESAMPLE_RESOLUTION.get(resample)
+
+    offset = naive_origin(origin) - DEFAULT_ORIGIN
+    for resolution in reversed(ROLLUP_RESOLUTIONS):
+        step = timedelta(**{f"{resolution}s": 1})
+        if not width % step and not offset % step:
+            return resolution
+    return None
+
+
+class Rollup(db.Model):
+    """Table of measurement aggregates per time bucket
+
+    The series is the cell of power and TEROS measurements and the sensor of
+    generic measurements.
+    """
+
+    __tablename__ = "rollup"
+
+    source = db.Column(db.Text(), primary_key=True)
+    series_id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.Text(), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    measurement = db.Column(db.Text(), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    sum = db.Column(db.Float)
+    min = db.Column(db.Float)
+    max = db.Column(db.Float)
+
+
+class RollupWatermark(db.Model):
+    """Table of the last row id aggregated into the rollups of a source
+
+    Ids up to settled_id belong to committed or rolled back transactions. The
+    fence is the last id handed out by the sequence of the table and the
+    virtual transaction ids in progress when it was read, its ids are settled
+    once these transactions ended, see utils/rollup.py.
+    """
+
+    __tablename__ = "rollup_watermark"
+
+    source = db.Column(db.Text(), primary_key=True)
+    last_id = db.Column(db.BigInteger, nullable=False)
+    settled_id = db.Column(db.BigInteger, nullable=False, server_default="0")
+    fence_id = db.Column(db.BigInteger)
+    fence_xids = db.Column(db.ARRAY(db.Text()))
+
+
+class RollupSource(NamedTuple):
+    """Time-series table with rollups
+
+    Attributes:
+        name: Name of the source in the rollup table
+        table: Time-series table with id, ts and ts_server columns
+        series: Column of the table identifying the series
+        measurements: Dictionary of measurement name to SQL expression of its
+            value
+    """
+
+    name: str
+    table: object
+    series: object
+    measurements: dict
+
+
+ROLLUP_SOURCES = {}
+
+
+def register_rollup(name: str, model, series, measurements: dict):
+    """Registers a time-series model for rollups"""
+
+    ROLLUP_SOURCES[name] = RollupSource(name, model.__table__, series, measurements)
+
+
+def rollup_watermark(name: str):
+    """Last row id of the source in the rollups, None if never rolled up"""
+
+    return db.session.execute(
+        select(RollupWatermark.last_id).where(RollupWatermark.source == name)
+    ).scalar()
+
+
+def rollup_select(
+    name: str,
+    series_ids: list,
+    resample: str,
+    start_time,
+    end_time,
+    origin=None,
+    aggregates=(),
+):
+    """Resampled averages of series computed from their rollups
+
+    Args:
+        name: Name of a registered source
+        series_ids: Ids of the cells or sensors
+        resample: Fixed unit or interval, see rollup_resolution
+        start_time: Start of the range, inclusive
+        end_time: End of the range, inclusive
+        origin: Origin of interval buckets, see utils/resample.py
+        aggregates: Aggregates other than the average, see utils/aggregate.py
+
+    Returns:
+        Select statement of series_id, ts, the average of each measurement and
+        its other aggregates labelled {measurement}_{aggregate}, ordered by
+        series_id and ts. None when the resample level has no rollup, an
+        aggregate is not in ROLLUP_AGGREGATES or the source was never rolled
+        up, the caller then aggregates the raw rows.
+    """
+
+    if any(name not in ROLLUP_AGGREGATES for name in aggregates):
+        return None
+
+    resolution = rollup_resolution(resample, origin)
+    if resolution is None:
+        return None
+
+    watermark = rollup_watermark(name)
+    if watermark is None:
+        return None
+
+    source = ROLLUP_SOURCES[name]
+    table = source.table
+    ts = table.c.ts
+    start = cast(start_time, ts.type)
+    end = cast(end_time, ts.type)
+
+    # buckets fully inside the range are read from the rollups
+    start_bucket = func.date_trunc(resolution, start)
+    full_start = case(
+        (
+            start_bucket < start,
+            start_bucket + literal_column(f"interval '1 {resolution}'"),
+        ),
+        else_=start_bucket,
+    )
+    full_end = func.date_trunc(resolution, end)
+
+    # columns of the parts, the minimum and maximum only when requested
+    extremes = [agg for agg in ("min", "max") if agg in aggregates]
+
+    rollup = Rollup.__table__
+    rollup_ts = bucket(resample, rollup.c.bucket, origin)
+
+    def rolled_columns(measurement):
+        is_measurement = rollup.c.measurement == measurement
+        yield (
+            func.sum(rollup.c.count)
+            .filter(is_measurement)
+            .label(f"{measurement}_count")
+        )
+        yield func.sum(rollup.c.sum).filter(is_measurement).label(f"{measurement}_sum")
+        for agg in extremes:
+            yield (
+                getattr(func, agg)(rollup.c[agg])
+                .filter(is_measurement)
+                .label(f"{measurement}_{agg}")
+            )
+
+    rolled = (
+        select(
+            rollup.c.series_id,
+            rollup_ts.label("ts"),
+            *(
+                col
+                for measurement in source.measurements
+                for col in rolled_columns(measurement)
+            ),
+        )
+        .where(
+            (rollup.c.source == name)
+            & (rollup.c.series_id.in_(series_ids))
+            & (rollup.c.resolution == resolution)
+            & (rollup.c.bucket >= full_start)
+            & (rollup.c.bucket < full_end)
+        )
+        .group_by(rollup.c.series_id, rollup_ts)
+    )
+
+    raw_ts = bucket(resample, ts, origin)
+
+    def raw(condition):
+        return (
+            select(
+                source.series.label("series_id"),
+                raw_ts.label("ts"),
+                *(
+                    col
+                    for measurement, expr in source.measurements.items()
+                    for col in (
+                        func.count(expr).label(f"{measurement}_count"),
+                        func.sum(expr).label(f"{measurement}_sum"),
+                        *(
+                            getattr(func, agg)(expr).label(f"{measurement}_{agg}")
+                            for agg in extremes
+                        ),
+                    )
+                ),
+            )
+            .where(source.series.in_(series_ids) & condition)
+            .group_by(source.series, raw_ts)
+        )
+
+    # partial buckets at the edges of the range
+    edges = raw(
+        ts.between(start, end) & or_(ts < full_start, ts >= full_end),
+    )
+    # rows of full buckets that are not rolled up yet
+    tail = raw(and_(table.c.id > watermark, ts >= full_start, ts < full_end))
+
+    parts = union_all(rolled, edges, tail).subquery()
+
+    def columns(measurement):
+        count = func.sum(parts.c[f"{measurement}_count"])
+        yield (func.sum(parts.c[f"{measurement}_sum"]) / func.nullif(count, 0)).label(
+            measurement
+        )
+        for agg in aggregates:
+            if agg == "count":
+                col = cast(count, BigInteger)
+            elif agg in extremes:
+                col = getattr(func, agg)(parts.c[f"{measurement}_{agg}"])
+            else:
+                continue
+            yield col.label(f"{measurement}_{agg}")
+
+    return (
+        select(
+            parts.c.series_id,
+            parts.c.ts,
+            *(
+                col
+                for measurement in source.measurements
+                for col in columns(measurement)
+            ),
+        )
+        .group_by(parts.c.series_id, parts.c.ts)
+        .order_by(parts.c.series_id, parts.c.ts)
+    )
@@ -1,15 +1,42 @@
+import heapq
+from operator import attrgetter
+
 from ..models import db
-from .cell import Cell
+from .cell import Cell, cell_cache
 from .data import Data
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from ..utils.aggregate import aggregate_columns, extra_aggregates
+from ..utils.downsample import downsample_rows
+from ..utils.pagination import (
+    after_key,
+    encode_cursor,
+    encode_stream_cursor,
+    page_size,
+    streamed,
+)
+from ..utils.query_cache import query_cache
+from ..utils.resample import AUTO, auto_resample, bucket
+from .rollup import rollup_select
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
 
 
 class Sensor(db.Model):
     """Table of sensors"""
 
     __tablename__ = "sensor"
-    __table_args__ = (db.Index("idx_sensor_cell_id", "cell_id"),)
+    __table_args__ = (
+        db.Index("idx_sensor_cell_id", "cell_id"),
+        db.UniqueConstraint(
+            "cell_id",
+            "name",
+            "measurement",
+            name="uq_sensor_cell_id_name_measurement",
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     cell_id = db.Column(
@@ -46,88 +73,429 @@ class Sensor(db.Model):
         start_time=None,
         end_time=None,
         stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
     ):
-        """gets sensor data as a list of objects"""
+        """gets sensor data as a list of objects
 
-        if start_time is None:
-            start_time = datetime.now() - relativedelta(months=1)
-        if end_time is None:
-            end_time = datetime.now()
+        The resample argument is a fixed unit or an interval such as 15m, see
+        utils/resample.py. Interval buckets are aligned to origin. With auto,
+        the interval giving about points buckets is chosen and returned as
+        resample.
+
+        Resampled data includes the aggregates of agg other than the average,
+        as data_{aggregate} lists, see utils/aggregate.py.
 
-        data = {
-            "timestamp": [],
-            "data": [],
-            "measurement": "",
-            "unit": "",
-            "type": "",
-        }
+        When downsample is set to one of utils.downsample.DOWNSAMPLE_METHODS, a
+        subset of at most points raw measurements is returned instead of
+        resampled averages. Text data is never downsampled.
+
+        Streamed data includes a cursor token of the ts_server and id of the
+        last row. When it is passed back as after only rows inserted since are
+        returned, once they were inserted utils.pagination.STREAM_LAG seconds
+        ago so a row of a transaction committing after the poll is not
+        skipped. Streamed rows are ordered by ts_server and id like the
+        cursor.
+
+        Raw data is paginated, at most limit rows are returned (capped by
+        utils.pagination.MAX_PAGE_SIZE) along with the next token to pass as
+        the cursor of the following page, None on the last page.
+        """
 
         cur_sensor = Sensor.query.filter_by(
             name=name, measurement=measurement, cell_id=cell_id
         ).first()
 
         if cur_sensor is None:
-            return data
+            return {
+                "timestamp": [],
+                "data": [],
+                "measurement": "",
+                "unit": "",
+                "type": "",
+            }
+
+        auto = resample == AUTO
+        if auto:
+            resample = auto_resample(
+                db.session,
+                Data.sensor_id,
+                Data.ts,
+                [cur_sensor.id],
+                start_time,
+                end_time,
+                points,
+            )
+
+        def query(start_time, end_time):
+            return Sensor.get_sensors_data_obj(
+                [cur_sensor],
+                resample=resample,
+                start_time=start_time,
+                end_time=end_time,
+                stream=stream,
+                downsample=downsample,
+                points=points,
+                after=after,
+                limit=limit,
+                cursor=cursor,
+                origin=origin,
+                agg=agg,
+            )[cur_sensor.id]
+
+        data = query_cache.fetch(
+            "data",
+            cur_sensor.id,
+            query,
+            start_time,
+            end_time,
+            resample=resample,
+            stream=stream,
+            downsample=downsample,
+            points=points,
+            limit=limit,
+            cursor=cursor,
+            origin=origin,
+            agg=agg,
+        )
+        if auto:
+            data["resample"] = resample
+        return data
+
+    @staticmethod
+    def get_sensor_data_rows(
+        name,
+        cell_id,
+        measurement,
+        resample="hour",
+        start_time=None,
+        end_time=None,
+        stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        origin=None,
+        agg=None,
+    ):
+        """gets sensor data one measurement at a time
+
+        Rows are fetched from a server-side cursor as they are iterated, so
+        memory does not grow with the range. Arguments are the same as
+        get_sensor_data_obj, raw rows are not paginated.
+
+        Yields:
+            Dictionary with the timestamp and data of a measurement, ordered
+            by timestamp. Streamed rows also include their id, resampled rows
+            the aggregates of agg as data_{aggregate}.
+        """
+
+        cur_sensor = Sensor.query.filter_by(
+            name=name, measurement=measurement, cell_id=cell_id
+        ).first()
+        if cur_sensor is None:
+            return
+
+        if resample == AUTO:
+            resample = auto_resample(
+                db.session,
+                Data.sensor_id,
+                Data.ts,
+                [cur_sensor.id],
+                start_time,
+                end_time,
+                points,
+            )
+        if cur_sensor.data_type == "text":
+            downsample = None
+
+        extra = extra_aggregates(agg, resample, stream, downsample)
+        for row in Sensor._get_data_rows(
+            [cur_sensor.id],
+            cur_sensor.data_type,
+            resample=resample,
+            start_time=start_time,
+            end_time=end_time,
+            stream=stream,
+            downsample=downsample,
+            points=points,
+            after=after,
+            origin=origin,
+            agg=agg,
+        ):
+            meas = {"timestamp": row.ts, "data": row.data}
+            for agg_name in extra:
+                meas[f"data_{agg_name}"] = row._mapping[f"data_{agg_name}"]
+            if stream:
+                meas["id"] = row.id
+            yield meas
+
+    @staticmethod
+    def get_sensors_data_obj(
+        sensors,
+        resample="hour",
+        start_time=None,
+        end_time=None,
+        stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
+    ):
+        """gets the data of multiple sensors
+
+        The sensors of each data type are read in a single query grouped by
+        sensor. Arguments are the same as get_sensor_data_obj, points applies
+        to each sensor and a page of raw data spans all sensors.
+
+        Returns:
+            Dictionary of sensor id to the data of the sensor in the format of
+            get_sensor_data_obj.
+        """
+
+        data = {}
+        sensor_ids = {}
+        for sensor in sensors:
+            data[sensor.id] = {
+                "timestamp": [],
+                "data": [],
+                "measurement": sensor.measurement,
+                "unit": sensor.unit,
+                "type": sensor.data_type,
+            }
+            if stream:
+                data[sensor.id]["cursor"] = after
+            sensor_ids.setdefault(sensor.data_type, []).append(sensor.id)
+
+        if resample == AUTO:
+            resample = auto_resample(
+                db.session,
+                Data.sensor_id,
+                Data.ts,
+                list(data),
+                start_time,
+                end_time,
+                points,
+            )
+            # the chosen interval is reported with the data
+            for sensor_data in data.values():
+                sensor_data["resample"] = resample
+
+        extra_keys = [
+            f"data_{name}"
+            for name in extra_aggregates(agg, resample, stream, downsample)
+        ]
+        for sensor_data in data.values():
+            for key in extra_keys:
+                sensor_data[key] = []
+
+        paged = not stream and resample == "none" and not downsample
+        if paged:
+            limit = page_size(limit)
+            for sensor_data in data.values():
+                sensor_data["next"] = None
+
+        queries = [
+            Sensor._get_data_rows(
+                ids,
+                data_type,
+                resample=resample,
+                start_time=start_time,
+                end_time=end_time,
+                stream=stream,
+                downsample=downsample,
+                points=points,
+                after=after,
+                limit=limit if paged else None,
+                cursor=cursor,
+                origin=origin,
+                agg=agg,
+            )
+            for data_type, ids in sensor_ids.items()
+        ]
+        if paged:
+            # pages are ordered across data types
+            rows = heapq.merge(*queries, key=attrgetter("sensor_id", "ts", "id"))
+        else:
+            rows = (row for query in queries for row in query)
+
+        last = None
+        # ts_server and id of the last streamed row of each sensor
+        last_keys = {}
+        for row in rows:
+            if paged:
+                if limit == 0:
+                    # more rows are left
+                    token = encode_cursor(*last)
+                    for sensor_data in data.values():
+                        sensor_data["next"] = token
+                    break
+                limit -= 1
+                last = (row.sensor_id, row.ts, row.id)
+
+            sensor_data = data[row.sensor_id]
+            sensor_data["timestamp"].append(row.ts)
+            sensor_data["data"].append(row.data)
+            for key in extra_keys:
+                sensor_data[key].append(row._mapping[key])
+            if stream:
+                key = (row.ts_server, row.id)
+                last_keys[row.sensor_id] = max(last_keys.get(row.sensor_id, key), key)
+
+        for sensor_id, key in last_keys.items():
+            data[sensor_id]["cursor"] = encode_stream_cursor(*key)
 
-        if cur_sensor.data_type == "float":
+        return data
+
+    @staticmethod
+    def _get_data_rows(
+        sensor_ids,
+        data_type,
+        resample="hour",
+        start_time=None,
+        end_time=None,
+        stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
+    ):
+        """rows of sensor_id, ts and data of sensors sharing a data type
+
+        Streamed and raw rows also include their id and resampled rows the
+        aggregates of agg, as data_{aggregate}. Raw rows are only paginated
+        when a limit is given, one row more than the limit is returned to tell
+        if there is a next page.
+        """
+
+        if start_time is None:
+            start_time = datetime.utcnow() - relativedelta(months=1)
+        if end_time is None:
+            end_time = datetime.utcnow()
+
+        if data_type == "float":
             t_data = Data.float_val
-        elif cur_sensor.data_type == "int":
+        elif data_type == "int":
             t_data = Data.int_val
-        elif cur_sensor.data_type == "text":
+        elif data_type == "text":
             t_data = Data.text_val
+            downsample = None
+
+        if resample == AUTO:
+            resample = auto_resample(
+                db.session,
+                Data.sensor_id,
+                Data.ts,
+                sensor_ids,
+                start_time,
+                end_time,
+                points,
+            )
+
+        extra = extra_aggregates(agg, resample, stream, downsample)
+
+        rolled = None
+        if not stream and resample != "none" and not downsample and data_type != "text":
+            rolled = rollup_select(
+                "data", sensor_ids, resample, start_time, end_time, origin, extra
+            )
+
+        in_range = Data.sensor_id.in_(sensor_ids) & Data.ts.between(
+            start_time, end_time
+        )
+
         if not stream:
             # select from actual timestamp and aggregate data
-            if resample == "none":
+            if resample == "none" or downsample:
                 # resampling is not required: select data without aggregate functions
                 stmt = (
                     db.select(
+                        Data.id,
+                        Data.sensor_id,
                         Data.ts.label("ts"),
                         t_data.label("data"),
                     )
-                    .where(Data.sensor_id == cur_sensor.id)
-                    .filter(Data.ts.between(start_time, end_time))
+                    .where(in_range)
+                    .order_by(Data.sensor_id, Data.ts)
                 )
+                if limit is not None and not downsample:
+                    # keyset pagination on (sensor_id, ts, id)
+                    if cursor is not None:
+                        stmt = stmt.where(
+                            after_key(Data.sensor_id, Data.ts, Data.id, cursor)
+                        )
+                    stmt = stmt.order_by(Data.id).limit(limit + 1)
+            elif rolled is not None:
+                # aggregate from the rollups
+                rolled = rolled.subquery()
+                stmt = db.select(
+                    rolled.c.series_id.label("sensor_id"),
+                    rolled.c.ts,
+                    rolled.c.value.label("data"),
+                    *(
+                        rolled.c[f"value_{name}"].label(f"data_{name}")
+                        for name in extra
+                    ),
+                ).order_by(rolled.c.series_id, rolled.c.ts)
             else:
                 # handle normal resampling case
-                resampled = (
+                ts_bucket = bucket(resample, Data.ts, origin)
+                stmt = (
                     db.select(
-                        db.func.date_trunc(resample, Data.ts).label("ts"),
+                        Data.sensor_id,
+                        ts_bucket.label("ts"),
                         db.func.avg(t_data).label("data"),
+                        *aggregate_columns({"data": t_data}, extra, Data.ts),
                     )
-                    .where(Data.sensor_id == cur_sensor.id)
-                    .filter(Data.ts.between(start_time, end_time))
-                    .group_by(db.func.date_trunc(resample, Data.ts))
-                    .subquery()
+                    .where(in_range)
+                    .group_by(Data.sensor_id, ts_bucket)
+                    .order_by(Data.sensor_id, ts_bucket)
                 )
-
-                stmt = db.select(
-                    resampled.c.ts.label("ts"),
-                    (resampled.c.data).label("data"),
-                ).order_by(resampled.c.ts)
         else:
             # select based off server timestamp for streaming data
-            # need due to no central clock on sensors
+            # need due to no central clock on sensors, rows inserted since
+            # the previous poll with after
+            in_range &= streamed(Data.ts_server, Data.id, after)
             stmt = (
                 db.select(
+                    Data.id,
+                    Data.sensor_id,
                     Data.ts.label("ts"),
+                    Data.ts_server,
                     t_data.label("data"),
                 )
-                .where(Data.sensor_id == cur_sensor.id)
-                .filter(Data.ts.between(start_time, end_time))
+                .where(in_range)
+                .order_by(Data.ts_server, Data.id)
             )
-        for row in db.session.execute(stmt):
-            data["timestamp"].append(row.ts)
-            data["data"].append(row.data)
-        data["measurement"] = cur_sensor.measurement
-        data["unit"] = cur_sensor.unit
-        data["type"] = cur_sensor.data_type
-        return data
+        if downsample and not stream:
+            return downsample_rows(
+                db.session,
+                stmt,
+                downsample,
+                ["data"],
+                start_time,
+                end_time,
+                points,
+                partition="sensor_id",
+            )
+        return db.session.execute(stmt).yield_per(1000)
 
     @staticmethod
     def add_data(
         meas_name: str,
         meas_unit: str,
         meas_dict: dict,
+        commit: bool = True,
     ):
         """Adds new data point for sensor
 
@@ -140,67 +508,233 @@ class Sensor(db.Model):
 
             meas: Dictionary of measurement
             meas_type: Type of measurement to add to database
+            commit: Commit the data point. When False the data point is only
+                added to the session so multiple measurements can be written
+                in a single transaction.
 
         Returns:
             The created Sensor object
         """
 
+        return Sensor.add_measurements(meas_dict, ((meas_name, meas_unit),), commit)[0]
+
+    @staticmethod
+    def add_measurements(meas_dict: dict, measurements, commit: bool = True) -> list:
+        """Adds the data points of all measurements of a reading
+
+        All data points share the sensor name (the reading type), cell and
+        timestamp of meas_dict and are committed together.
+
+        Params:
+
+            meas_dict: Dictionary of the reading, the value of each measurement
+                is in meas_dict["data"]
+            measurements: Iterable of (measurement name, unit) tuples
+            commit: Commit the data points. When False the data points are
+                only added to the session so multiple readings can be written
+                in a single transaction.
+
+        Returns:
+            List of the created Data objects, None for all of them when the cell
+            does not exist or a value does not match the data type of its
+            sensor.
+        """
+
         name = meas_dict["type"]
         cell_id = meas_dict["cellId"]
-        meas_data = meas_dict["data"][meas_name]
-        meas_type = type(meas_data).__name__
         ts = datetime.fromtimestamp(meas_dict["ts"])
 
-        # check if cell exists
-        cur_cell = Cell.query.filter_by(id=cell_id).first()
-        if cur_cell is None:
-            return None
+        obj_list = []
+        for meas_name, meas_unit in measurements:
+            meas_data = meas_dict["data"][meas_name]
+            meas_type = type(meas_data).__name__
 
-        # check if sensor exists that has the same name, measurement, and
-        # cell_id
-        cur_sensor = Sensor.query.filter_by(
+            # a cached sensor implies the cell exists since sensors are deleted
+            # along with their cell
+            entry = sensor_registry.get(cell_id, name, meas_name)
+            if entry is None:
+                # check if cell exists
+                if not cell_cache.exists(cell_id):
+                    for obj in obj_list:
+                        db.session.expunge(obj)
+                    return [None] * len(measurements)
+
+                # get or create the sensor that has the same name, measurement,
+                # and cell_id
+                entry = sensor_registry.resolve(
+                    cell_id, name, meas_name, meas_unit, meas_type
+                )
+            sensor_id, data_type = entry
+            if data_type != meas_type:
+                # the value would be stored in a column the sensor is not read
+                # from
+                for obj in obj_list:
+                    db.session.expunge(obj)
+                return [None] * len(measurements)
+
+            # add data based on measurement type
+            sensor_data = Data(sensor_id=sensor_id, ts=ts)
+            if meas_type == "float":
+                sensor_data.float_val = meas_data
+            elif meas_type == "int":
+                sensor_data.int_val = meas_data
+            elif meas_type == "text":
+                sensor_data.text_val = meas_data
+            db.session.add(sensor_data)
+            obj_list.append(sensor_data)
+
+        if commit:
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # the cell was deleted by another worker after it was cached
+                db.session.rollback()
+                sensor_registry.invalidate_cell(cell_id)
+                cell_cache.invalidate(cell_id)
+                return [None] * len(obj_list)
+        return obj_list
+
+
+class SensorRegistry:
+    """Per worker cache of sensors used on the ingest path
+
+    Maps (cell_id, name, measurement) to the sensor id and data type so that
+    inserting a data point does not require looking up the cell and sensor.
+    Missing sensors are created atomically with INSERT ... ON CONFLICT on the
+    unique (cell_id, name, measurement) constraint.
+
+    Sensors resolved inside a transaction are only published to the cache
+    once the transaction commits, so a rolled back sensor is never cached.
+    All sensors are loaded on the first lookup rather than when the app is
+    created, which also runs before the tables exist (e.g. flask db upgrade).
+    """
+
+    _PENDING_KEY = "sensor_registry_pending"
+
+    def __init__(self):
+        self._sensors = {}
+        self._warmed = False
+
+    def warm(self):
+        """Loads all sensors into the cache
+
+        Failures are ignored (e.g. the table does not exist yet) and the cache
+        is filled lazily instead.
+        """
+
+        self._warmed = True
+
+        stmt = db.select(
+            Sensor.id,
+            Sensor.cell_id,
+            Sensor.name,
+            Sensor.measurement,
+            Sensor.data_type,
+        )
+        try:
+            with db.engine.connect() as conn:
+                rows = conn.execute(stmt).all()
+        except SQLAlchemyError as e:
+            print(f"[sensor_registry] unable to warm cache: {e}", flush=True)
+            return
+
+        for row in rows:
+            key = (row.cell_id, row.name, row.measurement)
+            self._sensors[key] = (row.id, row.data_type)
+
+    def get(self, cell_id, name, measurement):
+        """Gets a cached sensor
+
+        Returns:
+            Tuple of (sensor id, data type) or None if not cached.
+        """
+
+        if not self._warmed:
+            self.warm()
+
+        key = (cell_id, name, measurement)
+        pending = db.session.info.get(self._PENDING_KEY)
+        if pending and key in pending:
+            return pending[key]
+        return self._sensors.get(key)
+
+    def resolve(self, cell_id, name, measurement, unit, data_type):
+        """Gets or creates a sensor in the current transaction
+
+        The cell must exist. The no-op update on conflict makes RETURNING
+        produce the id of an existing sensor.
+
+        Returns:
+            Tuple of (sensor id, data type).
+        """
+
+        stmt = insert(Sensor).values(
+            cell_id=cell_id,
             name=name,
-            measurement=meas_name,
-            cell_id=cur_cell.id,
-        ).first()
+            measurement=measurement,
+            unit=unit,
+            data_type=data_type,
+        )
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_sensor_cell_id_name_measurement",
+            set_={"name": stmt.excluded.name},
+        ).returning(Sensor.id, Sensor.data_type)
+        row = db.session.execute(stmt).one()
 
-        # create if doesn't exist
-        if cur_sensor is None:
-            new_sensor = Sensor(
-                name=name,
-                cell_id=cur_cell.id,
-                measurement=meas_name,
-                unit=meas_unit,
-                data_type=meas_type,
-            )
-            new_sensor.save()
-            cur_sensor = Sensor.query.filter_by(
-                name=name,
-                measurement=meas_name,
-                cell_id=cur_cell.id,
-            ).first()
-
-        # add data based on measurement type
-        if meas_type == "float":
-            sensor_data = Data(
-                sensor_id=cur_sensor.id,
-                # measurement=measurement,
-                ts=ts,
-                float_val=meas_data,
-            )
-        elif meas_type == "int":
-            sensor_data = Data(
-                sensor_id=cur_sensor.id,
-                # measurement=measurement,
-                ts=ts,
-                int_val=meas_data,
-            )
-        elif meas_type == "text":
-            sensor_data = Data(
-                sensor_id=cur_sensor.id,
-                # measurement=measurement,
-                ts=ts,
-                text_val=meas_data,
-            )
-        sensor_data.save()
-        return sensor_data
+        entry = (row.id, row.data_type)
+        pending = db.session.info.setdefault(self._PENDING_KEY, {})
+        pending[(cell_id, name, measurement)] = entry
+        return entry
+
+    def publish(self, session):
+        """Publishes sensors resolved in a committed transaction"""
+
+        pending = session.info.pop(self._PENDING_KEY, None)
+        if pending:
+            self._sensors.update(pending)
+
+    def discard(self, session):
+        """Drops sensors resolved in a rolled back transaction"""
+
+        session.info.pop(self._PENDING_KEY, None)
+
+    def invalidate_cell(self, cell_id):
+        """Drops all sensors of a cell"""
+
+        for key in [key for key in self._sensors if key[0] == cell_id]:
+            self._sensors.pop(key, None)
+
+    def invalidate_sensor(self, sensor_id):
+        """Drops a sensor by id"""
+
+        for key in [key for key, v in self._sensors.items() if v[0] == sensor_id]:
+            self._sensors.pop(key, None)
+
+    def clear(self):
+        """Drops all cached sensors, they are loaded again on the next lookup"""
+
+        self._sensors.clear()
+        self._warmed = False
+
+
+sensor_registry = SensorRegistry()
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_sensors(session):
+    sensor_registry.publish(session)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_sensors(session):
+    sensor_registry.discard(session)
+
+
+@event.listens_for(Sensor, "after_delete")
+def _invalidate_sensor(_mapper, _connection, target):
+    sensor_registry.invalidate_sensor(target.id)
+
+
+@event.listens_for(Cell, "after_delete")
+def _invalidate_cell_sensors(_mapper, _connection, target):
+    sensor_registry.invalidate_cell(target.id)
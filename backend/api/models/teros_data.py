@@ -1,22 +1,46 @@
 from ..models import db
 from sqlalchemy.sql import func
 from sqlalchemy import case, and_
-from .cell import Cell
+from sqlalchemy.exc import IntegrityError
+from .cell import Cell, cell_cache
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from ..utils.aggregate import aggregate_columns, extra_aggregates
+from ..utils.downsample import downsample_rows
+from ..utils.pagination import (
+    after_key,
+    encode_cursor,
+    encode_stream_cursor,
+    page_size,
+    streamed,
+)
+from ..utils.query_cache import query_cache
+from ..utils.resample import AUTO, auto_resample, bucket
+from .partition import register_partitions
+from .rollup import register_rollup, rollup_select
 
 
 class TEROSData(db.Model):
     """Table for TEROS-12 Data"""
 
     __tablename__ = "teros_data"
-    __table_args__ = (db.Index("idx_teros_data_cell_id_ts", "cell_id", "ts"),)
+    __table_args__ = (
+        # includes the columns read by time range for index-only scans
+        db.Index(
+            "idx_teros_data_cell_id_ts",
+            "cell_id",
+            "ts",
+            postgresql_include=["id", "vwc", "raw_vwc", "temp", "ec"],
+        ),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
 
-    id = db.Column(db.Integer, primary_key=True)
+    # partitioned by month, see models/partition.py
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     cell_id = db.Column(
         db.Integer, db.ForeignKey("cell.id", ondelete="CASCADE"), nullable=False
     )
-    ts = db.Column(db.DateTime, nullable=False, index=True)
+    ts = db.Column(db.DateTime, primary_key=True)
     ts_server = db.Column(db.DateTime, server_default=func.now(), index=True)
     vwc = db.Column(db.Float)
     raw_vwc = db.Column(db.Float)
@@ -26,6 +50,9 @@ class TEROSData(db.Model):
 
     cell = db.relationship("Cell")
 
+    # measurements of resampled queries
+    _MEASUREMENTS = ("vwc", "temp", "ec", "raw_vwc")
+
     def __repr__(self):
         return f"TEROSData(id={self.id!r}, ts={self.ts!r})"
 
@@ -70,12 +97,19 @@ class TEROSData(db.Model):
         return teros_data
 
     @staticmethod
-    def add_protobuf_teros_data(cell_id, ts, vwc, raw_vwc, temp, ec, water_pot):
-        cur_cell = Cell.query.filter_by(id=cell_id).first()
-        if cur_cell is None:
+    def add_protobuf_teros_data(
+        cell_id, ts, vwc, raw_vwc, temp, ec, water_pot, commit=True
+    ):
+        """add new data point for teros table
+        returns None if the cell doesn't exist
+
+        When commit is False the row is only added to the session so that
+        multiple measurements can be written in a single transaction.
+        """
+        if not cell_cache.exists(cell_id):
             return None
         teros_data = TEROSData(
-            cell_id=cur_cell.id,
+            cell_id=cell_id,
             ts=ts,
             raw_vwc=raw_vwc,
             vwc=vwc,
@@ -84,7 +118,14 @@ class TEROSData(db.Model):
             water_pot=water_pot,
         )
         db.session.add(teros_data)
-        db.session.commit()
+        if commit:
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # the cell was deleted by another worker
+                db.session.rollback()
+                cell_cache.invalidate(cell_id)
+                return None
         return teros_data
 
     def get_teros_data_obj(
@@ -93,6 +134,13 @@ class TEROSData(db.Model):
         start_time=None,
         end_time=None,
         stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
     ):
         """gets teros data as a list of objects
 
@@ -101,83 +149,373 @@ class TEROSData(db.Model):
         timestamp is from the measurement itself. When True, no data aggregation
         is preformed and the timestamp is when the measurement is inserted into
         the server.
+
+        The resample argument is a fixed unit or an interval such as 15m, see
+        utils/resample.py. Interval buckets are aligned to origin. With auto,
+        the interval giving about points buckets is chosen and returned as
+        resample.
+
+        Resampled data includes the aggregates of agg other than the average,
+        as {measurement}_{aggregate} lists, see utils/aggregate.py.
+
+        When downsample is set to one of utils.downsample.DOWNSAMPLE_METHODS, a
+        subset of at most points raw measurements is returned instead of
+        resampled averages.
+
+        Streamed data includes a cursor token of the ts_server and id of the
+        last row. When it is passed back as after only rows inserted since are
+        returned, once they were inserted utils.pagination.STREAM_LAG seconds
+        ago so a row of a transaction committing after the poll is not
+        skipped. Streamed rows are ordered by ts_server and id like the
+        cursor.
+
+        Raw data is paginated, at most limit rows are returned (capped by
+        utils.pagination.MAX_PAGE_SIZE) along with the next token to pass as
+        the cursor of the following page, None on the last page.
         """
 
-        if start_time is None:
-            start_time = datetime.now() - relativedelta(months=1)
-        if end_time is None:
-            end_time = datetime.now()
+        auto = resample == AUTO
+        if auto:
+            resample = auto_resample(
+                db.session,
+                TEROSData.cell_id,
+                TEROSData.ts,
+                [cell_id],
+                start_time,
+                end_time,
+                points,
+            )
+
+        def query(start_time, end_time):
+            return TEROSData.get_teros_data_cells(
+                [cell_id],
+                resample=resample,
+                start_time=start_time,
+                end_time=end_time,
+                stream=stream,
+                downsample=downsample,
+                points=points,
+                after=after,
+                limit=limit,
+                cursor=cursor,
+                origin=origin,
+                agg=agg,
+            )[cell_id]
+
+        data = query_cache.fetch(
+            "teros_data",
+            cell_id,
+            query,
+            start_time,
+            end_time,
+            resample=resample,
+            stream=stream,
+            downsample=downsample,
+            points=points,
+            limit=limit,
+            cursor=cursor,
+            origin=origin,
+            agg=agg,
+        )
+        if auto:
+            data["resample"] = resample
+        return data
+
+    def get_teros_data_cells(
+        cell_ids,
+        resample="hour",
+        start_time=None,
+        end_time=None,
+        stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
+    ):
+        """gets teros data of multiple cells in a single query
+
+        Arguments are the same as get_teros_data_obj, points applies to each
+        cell.
+
+        Returns:
+            Dictionary of cell id to the data of the cell, cells without data
+            have empty lists.
+        """
 
         data = {
-            "timestamp": [],
-            "vwc": [],
-            "temp": [],
-            "ec": [],
-            "raw_vwc": [],
-            "vwc_unit": "%",
-            "raw_vwc_unit": "raw",
+            cell_id: {
+                "timestamp": [],
+                "vwc": [],
+                "temp": [],
+                "ec": [],
+                "raw_vwc": [],
+                "vwc_unit": "%",
+                "raw_vwc_unit": "raw",
+            }
+            for cell_id in cell_ids
         }
+        if stream:
+            for cell_data in data.values():
+                cell_data["cursor"] = after
+
+        if resample == AUTO:
+            resample = auto_resample(
+                db.session,
+                TEROSData.cell_id,
+                TEROSData.ts,
+                cell_ids,
+                start_time,
+                end_time,
+                points,
+            )
+            # the chosen interval is reported with the data
+            for cell_data in data.values():
+                cell_data["resample"] = resample
+
+        extra = extra_aggregates(agg, resample, stream, downsample)
+        extra_keys = [
+            f"{key}_{name}" for key in TEROSData._MEASUREMENTS for name in extra
+        ]
+        for cell_data in data.values():
+            for key in extra_keys:
+                cell_data[key] = []
+
+        paged = not stream and resample == "none" and not downsample
+        if paged:
+            limit = page_size(limit)
+            for cell_data in data.values():
+                cell_data["next"] = None
+
+        last = None
+        # ts_server and id of the last streamed row of each cell
+        last_keys = {}
+        for row in TEROSData.get_teros_data_rows(
+            cell_ids,
+            resample=resample,
+            start_time=start_time,
+            end_time=end_time,
+            stream=stream,
+            downsample=downsample,
+            points=points,
+            after=after,
+            limit=limit if paged else None,
+            cursor=cursor,
+            origin=origin,
+            agg=agg,
+        ):
+            if paged:
+                if limit == 0:
+                    # more rows are left
+                    token = encode_cursor(*last)
+                    for cell_data in data.values():
+                        cell_data["next"] = token
+                    break
+                limit -= 1
+                last = (row["cell_id"], row["timestamp"], row["id"])
+
+            cell_data = data[row["cell_id"]]
+            cell_data["timestamp"].append(row["timestamp"])
+            cell_data["vwc"].append(row["vwc"])
+            cell_data["temp"].append(row["temp"])
+            cell_data["ec"].append(row["ec"])
+            cell_data["raw_vwc"].append(row["raw_vwc"])
+            for key in extra_keys:
+                cell_data[key].append(row[key])
+            if stream:
+                key = (row["timestamp"], row["id"])
+                last_keys[row["cell_id"]] = max(last_keys.get(row["cell_id"], key), key)
+
+        for cell_id, key in last_keys.items():
+            data[cell_id]["cursor"] = encode_stream_cursor(*key)
+        return data
+
+    def get_teros_data_rows(
+        cell_ids,
+        resample="hour",
+        start_time=None,
+        end_time=None,
+        stream=False,
+        downsample=None,
+        points=1000,
+        after=None,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
+    ):
+        """gets teros data of cells one measurement at a time
+
+        Rows are fetched from a server-side cursor as they are iterated, so
+        memory does not grow with the range. Arguments are the same as
+        get_teros_data_cells, except that raw rows are only paginated when a
+        limit is given. One row more than the limit is returned to tell if
+        there is a next page.
+
+        Yields:
+            Dictionary with the cell_id, timestamp, vwc, temp, ec and raw_vwc
+            of a measurement, ordered by cell and timestamp. Streamed and
+            paginated rows also include their id, resampled rows the aggregates
+            of agg.
+        """
+
+        if start_time is None:
+            start_time = datetime.utcnow() - relativedelta(months=1)
+        if end_time is None:
+            end_time = datetime.utcnow()
 
         stmt = None
 
+        if resample == AUTO:
+            resample = auto_resample(
+                db.session,
+                TEROSData.cell_id,
+                TEROSData.ts,
+                cell_ids,
+                start_time,
+                end_time,
+                points,
+            )
+
+        extra = extra_aggregates(agg, resample, stream, downsample)
+
+        rolled = None
+        if not stream and resample != "none" and not downsample:
+            rolled = rollup_select(
+                "teros", cell_ids, resample, start_time, end_time, origin, extra
+            )
+
+        in_range = TEROSData.cell_id.in_(cell_ids) & TEROSData.ts.between(
+            start_time, end_time
+        )
+
         if not stream:
-            if resample == "none":
+            if resample == "none" or downsample:
                 # resampling is not required: select data without aggregate functions
                 stmt = (
                     db.select(
+                        TEROSData.id,
+                        TEROSData.cell_id,
                         TEROSData.ts.label("ts"),
                         TEROSData.vwc.label("vwc"),
                         TEROSData.temp.label("temp"),
                         TEROSData.ec.label("ec"),
                         TEROSData.raw_vwc.label("raw_vwc"),
                     )
-                    .where(
-                        (TEROSData.cell_id == cell_id)
-                        & (TEROSData.ts.between(start_time, end_time))
-                    )
-                    .order_by(TEROSData.ts)
+                    .where(in_range)
+                    .order_by(TEROSData.cell_id, TEROSData.ts)
                 )
+                if limit is not None and not downsample:
+                    # keyset pagination on (cell_id, ts, id)
+                    if cursor is not None:
+                        stmt = stmt.where(
+                            after_key(
+                                TEROSData.cell_id, TEROSData.ts, TEROSData.id, cursor
+                            )
+                        )
+                    stmt = stmt.order_by(TEROSData.id).limit(limit + 1)
+            elif rolled is not None:
+                # aggregate from the rollups, vwc is normalized when rolled up
+                rolled = rolled.subquery()
+                stmt = db.select(
+                    rolled.c.series_id.label("cell_id"),
+                    rolled.c.ts,
+                    rolled.c.vwc,
+                    rolled.c.temp,
+                    rolled.c.ec,
+                    rolled.c.raw_vwc,
+                    *(
+                        rolled.c[f"{key}_{name}"]
+                        for key in TEROSData._MEASUREMENTS
+                        for name in extra
+                    ),
+                ).order_by(rolled.c.series_id, rolled.c.ts)
             else:
                 # Handle normal resampling case
-                date_trunc = func.date_trunc(resample, TEROSData.ts).label("ts")
+                ts_bucket = bucket(resample, TEROSData.ts, origin)
                 normalized_vwc = TEROSData._to_percent_if_fraction_expr(TEROSData.vwc)
+                measurements = {
+                    "vwc": normalized_vwc,
+                    "temp": TEROSData.temp,
+                    "ec": TEROSData.ec,
+                    "raw_vwc": TEROSData.raw_vwc,
+                }
                 stmt = (
                     db.select(
-                        date_trunc.label("ts"),
+                        TEROSData.cell_id,
+                        ts_bucket.label("ts"),
                         func.avg(normalized_vwc).label("vwc"),
                         func.avg(TEROSData.temp).label("temp"),
                         func.avg(TEROSData.ec).label("ec"),
                         func.avg(TEROSData.raw_vwc).label("raw_vwc"),
+                        *aggregate_columns(measurements, extra, TEROSData.ts),
                     )
-                    .where(
-                        (TEROSData.cell_id == cell_id)
-                        & (TEROSData.ts.between(start_time, end_time))
-                    )
-                    .group_by(date_trunc)
-                    .order_by(date_trunc)
+                    .where(in_range)
+                    .group_by(TEROSData.cell_id, ts_bucket)
+                    .order_by(TEROSData.cell_id, ts_bucket)
                 )
         else:
-            # using server timestamps
+            # using server timestamps, rows inserted since the previous poll
+            # with after
+            in_range &= streamed(TEROSData.ts_server, TEROSData.id, after)
             stmt = (
                 db.select(
+                    TEROSData.id,
+                    TEROSData.cell_id,
                     TEROSData.ts_server.label("ts"),
                     TEROSData.vwc.label("vwc"),
                     TEROSData.temp.label("temp"),
                     TEROSData.ec.label("ec"),
                     TEROSData.raw_vwc.label("raw_vwc"),
                 )
-                .where(
-                    (TEROSData.cell_id == cell_id)
-                    & (TEROSData.ts.between(start_time, end_time))
-                )
-                .order_by(TEROSData.ts)
+                .where(in_range)
+                .order_by(TEROSData.ts_server, TEROSData.id)
             )
 
-        for row in db.session.execute(stmt).yield_per(1000):
-            data["timestamp"].append(row.ts)
-            data["vwc"].append(TEROSData._to_percent_if_fraction(row.vwc))
-            data["temp"].append(row.temp)
-            # returns decimals as integers for chart parsing
-            data["ec"].append(int(row.ec) if row.ec is not None else None)
-            data["raw_vwc"].append(row.raw_vwc)
-        return data
+        if downsample and not stream:
+            rows = downsample_rows(
+                db.session,
+                stmt,
+                downsample,
+                ["vwc", "temp", "ec", "raw_vwc"],
+                start_time,
+                end_time,
+                points,
+                partition="cell_id",
+            )
+        else:
+            rows = db.session.execute(stmt).yield_per(1000)
+
+        for row in rows:
+            meas = {
+                "cell_id": row.cell_id,
+                "timestamp": row.ts,
+                "vwc": TEROSData._to_percent_if_fraction(row.vwc),
+                "temp": row.temp,
+                # returns decimals as integers for chart parsing
+                "ec": int(row.ec) if row.ec is not None else None,
+                "raw_vwc": row.raw_vwc,
+            }
+            for key in TEROSData._MEASUREMENTS:
+                for name in extra:
+                    meas[f"{key}_{name}"] = row._mapping[f"{key}_{name}"]
+            if stream or limit is not None:
+                meas["id"] = row.id
+            yield meas
+
+
+register_partitions(TEROSData)
+
+register_rollup(
+    "teros",
+    TEROSData,
+    TEROSData.cell_id,
+    {
+        "vwc": TEROSData._to_percent_if_fraction_expr(TEROSData.vwc),
+        "temp": TEROSData.temp,
+        "ec": TEROSData.ec,
+        "raw_vwc": TEROSData.raw_vwc,
+    },
+)
@@ -4,7 +4,7 @@ from ..auth.auth import authenticate_apikey_or_jwt
 from ..schemas.cell_schema import CellSchema
 
 # from ..conn import engine
-from ..models.cell import Cell as CellModel, Tag as TagModel
+from ..models.cell import Cell as CellModel, Tag as TagModel, cell_cache
 from ..schemas.add_cell_schema import AddCellSchema
 
 cells_schema = CellSchema(many=True)
@@ -147,6 +147,7 @@ class Cell(Resource):
                     return {"message": "tag_ids must be a list"}, 400
 
             cell.save()
+            cell_cache.invalidate(cellId)
             return {"message": "Successfully updated cell"}
         except Exception as e:
             return {"message": "Error updating cell", "error": str(e)}, 500
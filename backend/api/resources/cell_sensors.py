@@ -1,11 +1,55 @@
+from flask import request
 from flask_restful import Resource
 from ..models.sensor import Sensor
 from ..schemas.sensor_schema import SensorSchema
+from ..schemas.get_cell_sensor_data_schema import GetCellSensorDataSchema
+from ..utils.columnar import timeseries_response
 
 sensor_schema = SensorSchema(many=True)
+get_cell_sensor_data = GetCellSensorDataSchema()
 
 
 class Cell_Sensors(Resource):
     def get(self, cell_id):
         sensors = Sensor.query.filter_by(cell_id=cell_id).all()
         return sensor_schema.dump(sensors)
+
+
+class Cell_Sensor_Data(Resource):
+    def get(self, cell_id):
+        """Gets the data of all sensors of a cell
+
+        The sensors can be filtered with comma separated lists of names and
+        measurements. The data is keyed by the panel id of the sensor catalog,
+        s:{sensor_id}.
+        """
+
+        v_args = get_cell_sensor_data.load(request.args)
+
+        query = Sensor.query.filter_by(cell_id=cell_id)
+        if "names" in v_args:
+            query = query.filter(Sensor.name.in_(v_args["names"].split(",")))
+        if "measurements" in v_args:
+            query = query.filter(
+                Sensor.measurement.in_(v_args["measurements"].split(","))
+            )
+        sensors = query.order_by(Sensor.id).all()
+
+        data = Sensor.get_sensors_data_obj(
+            sensors,
+            resample=v_args["resample"],
+            start_time=v_args.get("startTime"),
+            end_time=v_args.get("endTime"),
+            stream=v_args.get("stream", False) or "after" in v_args,
+            downsample=v_args.get("downsample"),
+            points=v_args["points"],
+            after=v_args.get("after"),
+            limit=v_args.get("limit"),
+            cursor=v_args.get("cursor"),
+            origin=v_args.get("origin"),
+            agg=v_args.get("agg"),
+        )
+        return timeseries_response(
+            {f"s:{sensor_id}": sensor_data for sensor_id, sensor_data in data.items()},
+            series=True,
+        )
@@ -78,7 +78,7 @@ class DataAvailability(Resource):
 
         latest_timestamp = max(all_latest)
         earliest_timestamp = min(all_earliest) if all_earliest else None
-        two_weeks_ago = datetime.now() - timedelta(days=14)
+        two_weeks_ago = datetime.utcnow() - timedelta(days=14)
 
         return {
             "latest_timestamp": latest_timestamp.isoformat(),
@@ -0,0 +1,58 @@
+from flask import request
+from flask_restful import Resource
+from ..models.cell import Cell
+from ..models.sensor import Sensor
+from ..schemas.get_export_schema import GetExportSchema
+from ..utils.export import aligned_select, export_columns, export_response
+from ..utils.resample import parse_interval
+
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+
+get_export = GetExportSchema()
+
+
+class Export(Resource):
+    def get(self):
+        """Exports panels of cells aligned on a common grid of buckets
+
+        Builtin panels are exported for every cell of cellIds, sensor panels
+        s:{sensor_id} for their sensor. The response is streamed as csv or
+        parquet, see utils/export.py.
+        """
+
+        v_args = get_export.load(request.args)
+        panels = list(dict.fromkeys(v_args["panels"].split(",")))
+
+        cell_ids = []
+        if "cellIds" in v_args:
+            cell_ids = list(dict.fromkeys(map(int, v_args["cellIds"].split(","))))
+        cells = Cell.query.filter(Cell.id.in_(cell_ids)).order_by(Cell.id).all()
+        if len(cells) < len(cell_ids):
+            return {"message": "Cell not found"}, 404
+
+        sensor_ids = [int(panel[2:]) for panel in panels if panel.startswith("s:")]
+        sensors = {
+            sensor.id: sensor
+            for sensor in Sensor.query.filter(Sensor.id.in_(sensor_ids))
+        }
+        if len(sensors) < len(sensor_ids):
+            return {"message": "Sensor not found"}, 404
+
+        columns = export_columns(cells, panels, sensors)
+        if not columns:
+            return {"message": "No columns to export"}, 400
+
+        end_time = v_args.get("endTime", datetime.utcnow())
+        start_time = v_args.get("startTime", end_time - relativedelta(months=1))
+        tolerance = v_args.get("tolerance")
+        stmt = aligned_select(
+            columns,
+            v_args["resample"],
+            start_time,
+            end_time,
+            origin=v_args.get("origin"),
+            fill=v_args["fill"],
+            tolerance=None if tolerance is None else parse_interval(tolerance),
+        )
+        return export_response(columns, stmt, v_args["format"])
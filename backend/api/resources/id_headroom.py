@@ -0,0 +1,18 @@
+"""Id headroom of the time-series tables
+
+Reports the ids left in each time-series table before its sequence reaches
+the maximum of its id column, when ingest fails. Responds with 503 once a
+table has used ALERT_USED of its ids, see utils/bigint_ids.py to widen them.
+"""
+
+from flask_restful import Resource
+
+from ..models import db
+from ..utils.bigint_ids import ALERT_USED, TABLES, id_headroom
+
+
+class Id_Headroom(Resource):
+    def get(self):
+        tables = {table: id_headroom(db.session, table) for table in TABLES}
+        healthy = all(headroom["used"] < ALERT_USED for headroom in tables.values())
+        return {"healthy": healthy, "tables": tables}, 200 if healthy else 503
@@ -0,0 +1,23 @@
+"""Ingest queue metrics
+
+Exposes the consumer group metrics of the ingest queue, most importantly the
+consumer lag, the number of queued uploads not yet read by a consumer.
+"""
+
+import redis
+from flask_restful import Resource
+
+from ..utils.ingest_queue import ingest_queue
+
+
+class Ingest_Queue(Resource):
+    def get(self):
+        if not ingest_queue.enabled:
+            return {"enabled": False}
+
+        try:
+            stats = ingest_queue.stats()
+        except redis.RedisError as e:
+            return {"enabled": True, "error": str(e)}, 503
+
+        return {"enabled": True, **stats}
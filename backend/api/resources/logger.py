@@ -6,7 +6,7 @@ from sqlalchemy.exc import IntegrityError
 from ..auth.auth import authenticate_apikey_or_jwt
 from ..models import db
 from ..schemas.logger_schema import LoggerSchema
-from ..models.logger import Logger as LoggerModel
+from ..models.logger import Logger as LoggerModel, logger_cache
 from ..schemas.add_logger_schema import AddLoggerSchema
 from ..ttn.end_devices import TTNApi, EntsEndDevice, EndDevice
 
@@ -226,6 +226,7 @@ class Logger(Resource):
 
         # Save to database
         logger.save()
+        logger_cache.invalidate(logger_id)
 
         # Update TTN if it's an ents device and name was changed
         if logger.type and logger.type.lower() == "ents" and "name" in json_data:
@@ -1,7 +1,9 @@
-from flask import request, jsonify
+from flask import request
 from flask_restful import Resource
 from ..schemas.power_data_schema import PowerDataSchema
 from ..schemas.get_cell_data_schema import GetCellDataSchema
+from ..utils.columnar import timeseries_response
+from ..utils.ndjson import ndjson_response, wants_ndjson
 from ..schemas.p_input import PInput
 from ..models.power_data import PowerData
 
@@ -29,12 +31,31 @@ class Power_Data(Resource):
     def get(self, cell_id=0):
         v_args = get_cell_data.load(request.args)
         stream = v_args["stream"] if "stream" in v_args else False
-        return jsonify(
-            PowerData.get_power_data_obj(
-                cell_id,
-                resample=v_args["resample"],
-                start_time=v_args["startTime"],
-                end_time=v_args["endTime"],
-                stream=stream,
+        # the cursor of streamed responses implies stream
+        stream = stream or "after" in v_args
+        args = {
+            "resample": v_args["resample"],
+            "start_time": v_args["startTime"],
+            "end_time": v_args["endTime"],
+            "stream": stream,
+            "downsample": v_args.get("downsample"),
+            "points": v_args["points"],
+            "after": v_args.get("after"),
+            "origin": v_args.get("origin"),
+            "agg": v_args.get("agg"),
+        }
+        # ndjson responses are streamed whole, json responses are paginated
+        page = {"limit": v_args.get("limit"), "cursor": v_args.get("cursor")}
+        if "cellIds" in v_args:
+            # multiple cells in a single query, keyed by cell id
+            cell_ids = list(dict.fromkeys(map(int, v_args["cellIds"].split(","))))
+            if wants_ndjson():
+                return ndjson_response(PowerData.get_power_data_rows(cell_ids, **args))
+            return timeseries_response(
+                PowerData.get_power_data_cells(cell_ids, **args, **page), series=True
             )
+        if wants_ndjson():
+            return ndjson_response(PowerData.get_power_data_rows([cell_id], **args))
+        return timeseries_response(
+            PowerData.get_power_data_obj(cell_id, **args, **page)
         )
@@ -18,6 +18,17 @@ inserted into the appropriate table in the database. A HTTP response is sent
 back containing protobuf binary data with the response message indicating status
 of data.
 
+Batch:
+Loggers uploading a backlog can set the "Batch: true" header and POST multiple
+length-delimited measurement messages at once. The batch is inserted in a single
+transaction and a json response is sent back with the status of each
+measurement.
+
+Queue:
+When the ingest queue is enabled (INGEST_QUEUE_URL), uploads are validated and
+appended to a Redis stream and a 202 response is returned. The measurements are
+inserted by the queue consumer, see utils/ingest_queue.py.
+
 TODO:
 - Integrate downlinks to device to ack the data as successfully inserted into
 the db and data can be cleared from local non-volatile storage. See
@@ -28,13 +39,21 @@ Author: John Madden <jmadden173@pm.me>
 
 import base64
 
-from flask import request, jsonify, Response
+from flask import request, Response
 from flask_restful import Resource
 
-from .util import process_measurement, process_generic_measurement
+from .util import (
+    process_measurement,
+    process_generic_measurement,
+    process_measurement_batch_bytes,
+    queue_measurement,
+)
 
 from ..models.sensor import Sensor
 from ..schemas.get_sensor_data_schema import GetSensorDataSchema
+from ..utils.columnar import timeseries_response
+from ..utils.ndjson import ndjson_response, wants_ndjson
+from ..utils.ingest_queue import MEASUREMENT, GENERIC, BATCH
 
 
 class SensorData(Resource):
@@ -45,21 +64,34 @@ class SensorData(Resource):
 
         # get args
         v_args = self.get_sensor_data_schema.load(request.args)
-        stream = v_args.get("stream", False)
+        # the cursor of streamed responses implies stream
+        stream = v_args.get("stream", False) or "after" in v_args
         resample = v_args.get("resample", "hour")
 
+        args = {
+            "name": v_args["name"],
+            "cell_id": v_args["cellId"],
+            "measurement": v_args["measurement"],
+            "resample": resample,
+            "start_time": v_args["startTime"],
+            "end_time": v_args["endTime"],
+            "stream": stream,
+            "downsample": v_args.get("downsample"),
+            "points": v_args["points"],
+            "after": v_args.get("after"),
+            "origin": v_args.get("origin"),
+            "agg": v_args.get("agg"),
+        }
+        # ndjson responses are streamed whole, json responses are paginated
+        if wants_ndjson():
+            return ndjson_response(Sensor.get_sensor_data_rows(**args))
+
         # get data
         sensor_data_obj = Sensor.get_sensor_data_obj(
-            name=v_args["name"],
-            cell_id=v_args["cellId"],
-            measurement=v_args["measurement"],
-            resample=resample,
-            start_time=v_args["startTime"],
-            end_time=v_args["endTime"],
-            stream=stream,
+            **args, limit=v_args.get("limit"), cursor=v_args.get("cursor")
         )
 
-        return jsonify(sensor_data_obj)
+        return timeseries_response(sensor_data_obj)
 
     def post(self):
         """Handle upload post request
@@ -117,13 +149,17 @@ class SensorData(Resource):
                 payload_str = uplink_json["uplink_message"]["frm_payload"]
                 payload = base64.b64decode(payload_str)
 
-                resp = process_measurement(payload)
+                resp = queue_measurement(MEASUREMENT, payload)
+                if resp is None:
+                    resp = process_measurement(payload)
 
             elif uplink_json["uplink_message"]["f_port"] == 2:
                 payload_str = uplink_json["uplink_message"]["frm_payload"]
                 payload = base64.b64decode(payload_str)
 
-                resp = process_generic_measurement(payload)
+                resp = queue_measurement(GENERIC, payload)
+                if resp is None:
+                    resp = process_generic_measurement(payload)
 
             elif uplink_json["uplink_message"]["f_port"] == 202:
                 resp = Response()
@@ -169,13 +205,23 @@ class SensorData(Resource):
             return resp
 
         sensor_type = request.headers.get("SensorVersion", "1")
+        batch = request.headers.get("Batch", "false").lower() == "true"
 
         # process generic measurement
         if sensor_type == "2":
-            resp = process_generic_measurement(data)
+            resp = queue_measurement(GENERIC, data)
+            if resp is None:
+                resp = process_generic_measurement(data)
+        # batch of length-delimited measurements
+        elif batch:
+            resp = queue_measurement(BATCH, data)
+            if resp is None:
+                resp = process_measurement_batch_bytes(data)
         # default to original version
         else:
             # decode and insert into db
-            resp = process_measurement(data)
+            resp = queue_measurement(MEASUREMENT, data)
+            if resp is None:
+                resp = process_measurement(data)
 
         return resp
@@ -1,7 +1,8 @@
 """Sensor endpoint for uploading and getting data
 
 This endpoint is used to upload sensor data in a json format. The data is
-inserted into the database.
+inserted into the database. A list of measurements is inserted as a batch in a
+single transaction.
 
 Authors:
 - John Madden <jmadden173@pm.me>
@@ -11,7 +12,7 @@ Authors:
 from flask import request, jsonify
 from flask_restful import Resource
 
-from .util import process_measurement_json
+from .util import process_measurement_json, process_measurement_batch
 
 from ..models.sensor import Sensor
 from ..schemas.get_sensor_data_schema import GetSensorDataSchema
@@ -86,6 +87,9 @@ class SensorData_Json(Resource):
             raise ValueError("POST request must be application/json")
 
         # decode and insert into db
-        resp = process_measurement_json(data)
+        if isinstance(data, list):
+            resp = process_measurement_batch(data)
+        else:
+            resp = process_measurement_json(data)
 
         return resp
@@ -3,20 +3,36 @@
 author: John Madden <jmadden173@pm.me>
 """
 
+from __future__ import annotations
+
 import os
-from datetime import datetime
+import threading
 
-from flask import Response
+import redis
+from flask import Response, jsonify
+from sqlalchemy.exc import IntegrityError
 from ents.proto import encode_response, decode_measurement
 from ents.proto.sensor import parse_sensor_measurement
 
 
-from ..models.power_data import PowerData
-from ..models.teros_data import TEROSData
-from ..models.sensor import Sensor
-from .. import socketio
+from ..models.cell import cell_cache
+from ..models.logger import logger_cache
+from ..models.sensor import sensor_registry
+from ..utils.bulk_write import (
+    MODEL_TABLES,
+    copy_pending,
+    dedup_enabled,
+    ingest_counts,
+    insert_pending,
+    key_from_object,
+)
+from ..utils.ingest_queue import ingest_queue, MEASUREMENT, GENERIC, BATCH
+from ..utils.sensor_types import add_reading, check_reading, generic_readings
+from .. import db, socketio
 
 DEBUG_SOCKETIO = os.getenv("DEBUG_SOCKETIO", "False").lower() == "true"
+# merge emissions of requests within the window, in milliseconds
+SOCKETIO_EMIT_WINDOW = int(os.getenv("SOCKETIO_EMIT_WINDOW", "0")) / 1000
 
 
 def process_generic_measurement_json(meas: dict) -> Response:
@@ -32,68 +48,44 @@ def process_generic_measurement_json(meas: dict) -> Response:
         Flask response with status code and protobuf encoded response.
     """
 
-    for m in meas:
-        if "unsignedInt" in m:
-            value = m["unsignedInt"]
-        elif "signedInt" in m:
-            value = m["signedInt"]
-        elif "decimal" in m:
-            value = m["decimal"]
-        else:
-            raise ValueError("No valid measurement value found")
-
-        # format a compatible dict
-        meas_dict = {
-            "type": m["type"],
-            "loggerId": m["meta"]["loggerId"],
-            "cellId": m["meta"]["cellId"],
-            "ts": m["meta"]["ts"],
-            "data": {
-                m["name"]: value,
-            },
-            "data_type": {
-                m["name"]: type(value),
-            },
-        }
-
-        obj = Sensor.add_data(m["name"], m["unit"], meas_dict=meas_dict)
-        if not obj:
+    readings = generic_readings(meas)
+    dedup = dedup_enabled()
+
+    # all readings of the message are written in a single transaction
+    with ingest_counts(db.session) as counts:
+        for meas_dict, sensor_type in readings:
+            obj_list = sensor_type.add(meas_dict, sensor_type, commit=False)
+            if None in obj_list:
+                db.session.rollback()
+                resp = Response()
+                resp.status_code = 400
+                resp.data = f"Error adding sensor data for measurement {meas_dict}"
+                return resp
+
+        try:
+            if dedup:
+                insert_pending(db.session)
+            db.session.commit()
+        except IntegrityError:
+            # a cell was deleted by another worker after it was cached
+            db.session.rollback()
+            for meas_dict, _ in readings:
+                invalidate_cached(meas_dict)
             resp = Response()
             resp.status_code = 400
-            resp.data = f"Error adding sensor data for measurement {m}"
+            resp.data = "Error adding sensor data, cell does not exist"
             return resp
-        else:
-            cell_id = meas_dict.get("cellId")
-            if cell_id:
-                try:
-                    measurement_data = {
-                        "type": meas_dict.get("type", "unknown"),
-                        "cellId": cell_id,
-                        "loggerId": meas_dict.get("loggerId"),
-                        "timestamp": meas_dict.get("ts"),
-                        "data": meas_dict.get("data", {}),
-                        "obj_count": len(meas_dict.get("data", {})),
-                    }
-                    room_name = f"cell_{cell_id}"
-
-                    socketio.emit(
-                        "measurement_received", measurement_data, room=room_name
-                    )
 
-                    if DEBUG_SOCKETIO:
-                        has_subscribers = socketio.server.manager.rooms.get(
-                            "/", {}
-                        ).get(room_name)
-                        if has_subscribers:
-                            count = len(has_subscribers)
-                            print(
-                                f"[socketio] emitted to {room_name}:{count} subscribers"
-                            )
-                except Exception as e:
-                    print(f"[socketio] error emitting measurement: {e}")
+    # resent measurements were already sent to clients
+    if counts.new or not counts.duplicate:
+        emits = EmitBuffer()
+        for meas_dict, sensor_type in readings:
+            emits.add(meas_dict, len(sensor_type.measurements))
+        emits.flush()
 
     resp = Response()
     resp.status_code = 200
+    set_count_headers(resp, counts)
     return resp
 
 
@@ -142,6 +134,123 @@ def process_measurement(data: bytes):
     return process_measurement_dict(meas)
 
 
+def process_measurement_batch_bytes(data: bytes) -> Response:
+    """Process a batch of protobuf encoded measurements
+
+    The measurements are length-delimited, see split_delimited, and inserted
+    with process_measurement_batch.
+
+    Args
+        data: Concatenated length-delimited measurement messages
+
+    Returns:
+        Flask response with a json body containing the per measurement status
+        vector.
+    """
+
+    try:
+        msgs = split_delimited(data)
+    except ValueError as e:
+        resp = Response()
+        resp.status_code = 400
+        resp.data = f"Error splitting measurement batch: {e}"
+        return resp
+
+    meas_list = []
+    for msg in msgs:
+        try:
+            meas_list.append(decode_measurement(msg, raw=False))
+        except Exception:
+            meas_list.append(None)
+
+    return process_measurement_batch(meas_list)
+
+
+def references_exist(meas: dict) -> bool:
+    """Whether the cell, and the logger of power readings, of a measurement exist
+
+    Checked through the existence caches, so a row deleted by another worker
+    may still be reported until its entry is invalidated.
+
+    Args:
+        meas: Decoded measurement, or the meta of a generic measurement
+    """
+
+    if not cell_cache.exists(meas.get("cellId")):
+        return False
+    if meas.get("type") == "power":
+        return logger_cache.exists(meas.get("loggerId"))
+    return True
+
+
+def queue_measurement(kind: str, data: bytes) -> Response | None:
+    """Validates an encoded upload and appends it to the ingest queue
+
+    The payload is decoded to reject malformed uploads and uploads of unknown
+    cells or loggers right away but is inserted later by the queue consumer,
+    see utils/ingest_queue.py. Batches with malformed entries or entries of
+    unknown cells or loggers are processed synchronously so the per
+    measurement statuses are returned.
+
+    Args:
+        kind: One of MEASUREMENT, GENERIC or BATCH
+        data: Encoded upload
+
+    Returns:
+        Flask response with status code 202 once queued, 400 when the payload
+        is malformed or 404 when its cell or logger does not exist. None when
+        the queue is disabled or unreachable and the upload should be processed
+        synchronously.
+    """
+
+    if not ingest_queue.enabled:
+        return None
+
+    try:
+        if kind == MEASUREMENT:
+            meas_list = [decode_measurement(data, raw=False)]
+        elif kind == GENERIC:
+            meas = parse_sensor_measurement(data)
+            meas_list = [m["meta"] for m in meas["measurements"]]
+        elif kind == BATCH:
+            msgs = split_delimited(data)
+    except Exception as e:
+        resp = Response()
+        resp.status_code = 400
+        resp.data = f"Error decoding measurement: {e}"
+        return resp
+
+    if kind == BATCH:
+        try:
+            meas_list = [decode_measurement(msg, raw=False) for msg in msgs]
+        except Exception:
+            return None
+        if not all(references_exist(meas) for meas in meas_list):
+            return None
+    elif not all(references_exist(meas) for meas in meas_list):
+        resp = Response()
+        resp.status_code = 404
+        if kind == MEASUREMENT:
+            resp.content_type = "application/octet-stream"
+            resp.data = encode_response(False)
+        else:
+            resp.data = "Error adding sensor data, cell does not exist"
+        return resp
+
+    try:
+        ingest_queue.enqueue(kind, data)
+    except redis.RedisError as e:
+        print(f"[ingest_queue] unable to queue, processing inline: {e}", flush=True)
+        return None
+
+    resp = Response()
+    resp.status_code = 202
+    if kind == MEASUREMENT:
+        resp.content_type = "application/octet-stream"
+        resp.data = encode_response(True)
+    return resp
+
+
 def process_measurement_json(data: dict):
     """Process json measurement
 
@@ -155,158 +264,374 @@ def process_measurement_json(data: dict):
     return process_measurement_dict(data)
 
 
-def process_measurement_dict(meas: dict):
-    obj_list = []
+def add_measurement_dict(meas: dict, commit: bool = True) -> list:
+    """Adds a decoded measurement to the database
+
+    The measurement is written according to its type in the sensor type
+    registry, see utils/sensor_types.py.
 
-    # power measurement
-    if meas["type"] == "power":
-        obj = PowerData.add_protobuf_power_data(
-            meas["loggerId"],
-            meas["cellId"],
-            datetime.fromtimestamp(meas["ts"]),
-            meas["data"]["voltage"],
-            meas["data"]["current"],
-        )
+    Args:
+        meas: Measurement dictionary
+        commit: Commit each row as it is added. When False the rows are only
+            added to the session and the caller is responsible for the commit.
+
+    Returns:
+        List of created objects. Failed inserts are represented by None.
+    """
+
+    return add_reading(meas, commit=commit)
+
+
+def measurement_event(meas: dict, obj_count: int) -> dict:
+    """Formats a measurement for the measurement_received event"""
+
+    return {
+        "type": meas.get("type", "unknown"),
+        "cellId": meas.get("cellId"),
+        "loggerId": meas.get("loggerId"),
+        "timestamp": meas.get("ts"),
+        "data": meas.get("data", {}),
+        "obj_count": obj_count,
+    }
+
+
+def emit_rooms(rooms: dict):
+    """Emits the collected measurements of each room as a single event
+
+    A room with a single measurement receives the measurement_received event
+    with the measurement as payload, otherwise the measurements_received event
+    with the list of measurements. Errors are logged and never propagated so
+    that a socket failure does not fail the insert.
+
+    Args:
+        rooms: Dictionary of room name to list of measurement events
+    """
 
-        obj_list.append(obj)
+    for room_name, events in rooms.items():
+        try:
+            if len(events) == 1:
+                socketio.emit("measurement_received", events[0], room=room_name)
+            else:
+                socketio.emit("measurements_received", events, room=room_name)
+
+            if DEBUG_SOCKETIO:
+                has_subscribers = socketio.server.manager.rooms.get("/", {}).get(
+                    room_name
+                )
+                if has_subscribers:
+                    count = len(has_subscribers)
+                    print(
+                        f"[socketio] emitted {len(events)} measurements to "
+                        f"{room_name}: {count} subscribers"
+                    )
+        except Exception as e:
+            print(f"[socketio] error emitting measurement: {e}")
 
-    # teros12 measurement
-    elif meas["type"] == "teros12":
-        obj = TEROSData.add_protobuf_teros_data(
-            meas["cellId"],
-            datetime.fromtimestamp(meas["ts"]),
-            meas["data"]["vwcAdj"],
-            meas["data"]["vwcRaw"],
-            meas["data"]["temp"],
-            meas["data"]["ec"],
-            None,
-        )
 
-        obj_list.append(obj)
+class EmitWindow:
+    """Merges the emissions of concurrent requests within a time window
 
-    elif meas["type"] == "phytos31":
-        obj1 = Sensor.add_data(meas_name="voltage", meas_unit="V", meas_dict=meas)
+    The first flush opens the window and schedules a background task that
+    emits everything collected once the window has passed, so a burst of
+    uploads to a cell reaches clients as one event.
 
-        obj_list.append(obj1)
+    Attributes:
+        window: Length of the window in seconds
+    """
 
-        obj2 = Sensor.add_data(meas_name="leafWetness", meas_unit="?", meas_dict=meas)
+    def __init__(self, window: float):
+        self.window = window
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.scheduled = False
 
-        obj_list.append(obj2)
+    def add(self, rooms: dict):
+        """Adds events to the window, opening it if needed"""
 
-    elif meas["type"] == "bme280":
-        pressure_obj = Sensor.add_data(
-            meas_name="pressure", meas_unit="hPa", meas_dict=meas
-        )
-        obj_list.append(pressure_obj)
+        with self.lock:
+            for room_name, events in rooms.items():
+                self.rooms.setdefault(room_name, []).extend(events)
+            if self.scheduled:
+                return
+            self.scheduled = True
 
-        temperature_obj = Sensor.add_data(
-            meas_name="temperature", meas_unit="C", meas_dict=meas
-        )
-        obj_list.append(temperature_obj)
+        try:
+            socketio.start_background_task(self._run)
+        except Exception as e:
+            print(f"[socketio] unable to schedule emission, emitting now: {e}")
+            self.flush()
 
-        humidity_obj = Sensor.add_data(
-            meas_name="humidity", meas_unit="%", meas_dict=meas
-        )
-        obj_list.append(humidity_obj)
+    def _run(self):
+        socketio.sleep(self.window)
+        self.flush()
 
-    elif meas["type"] == "teros21":
-        obj = Sensor.add_data(meas_name="matricPot", meas_unit="kPa", meas_dict=meas)
+    def flush(self):
+        """Emits the events collected in the window and closes it"""
 
-        obj_list.append(obj)
+        with self.lock:
+            rooms, self.rooms = self.rooms, {}
+            self.scheduled = False
+        emit_rooms(rooms)
 
-        obj = Sensor.add_data(meas_name="temp", meas_unit="C", meas_dict=meas)
 
-        obj_list.append(obj)
-    elif meas["type"] == "co2":
-        obj = Sensor.add_data(meas_name="CO2", meas_unit="PPM", meas_dict=meas)
+emit_window = EmitWindow(SOCKETIO_EMIT_WINDOW)
 
-        obj_list.append(obj)
 
-        obj = Sensor.add_data(meas_name="state", meas_unit="Boolean", meas_dict=meas)
+class EmitBuffer:
+    """Collects the measurements of a request per room
 
-        obj_list.append(obj)
+    Measurements are added as they are inserted and emitted together by
+    flush, one event per room instead of one per measurement. When
+    SOCKETIO_EMIT_WINDOW is set the events are also merged with those of other
+    requests in the window, see EmitWindow.
 
-        obj = Sensor.add_data(
-            meas_name="Photoresistivity", meas_unit="Ohms", meas_dict=meas
-        )
+    Examples
+    --------
+    ::
 
-    elif meas["type"] == "pcap02":
-        obj = Sensor.add_data(
-            meas_name="Capacitance", meas_unit="Farads", meas_dict=meas
-        )
-        obj_list.append(obj)
+        emits = EmitBuffer()
+        for meas in meas_list:
+            emits.add(meas, obj_count)
+        emits.flush()
+    """
 
-    # sen0257 water pressure measurement
-    elif meas["type"] == "sen0257":
-        pressure_obj = Sensor.add_data(
-            meas_name="pressure", meas_unit="kPa", meas_dict=meas
-        )
+    def __init__(self, window: EmitWindow | None = None):
+        self.rooms = {}
+        self.window = window
 
-        obj_list.append(pressure_obj)
+    def add(self, meas: dict, obj_count: int):
+        """Adds an inserted measurement to the room of its cell
 
-        voltage_obj = Sensor.add_data(
-            meas_name="voltage", meas_unit="V", meas_dict=meas
-        )
+        Args:
+            meas: Measurement dictionary
+            obj_count: Number of objects inserted for the measurement
+        """
 
-        obj_list.append(voltage_obj)
+        cell_id = meas.get("cellId")
+        if not cell_id:
+            return
 
-    # sen0308 soil humidity measurement
-    elif meas["type"] == "sen0308":
-        voltage_obj = Sensor.add_data(
-            meas_name="voltage", meas_unit="V", meas_dict=meas
-        )
+        event = measurement_event(meas, obj_count)
+        self.rooms.setdefault(f"cell_{cell_id}", []).append(event)
 
-        obj_list.append(voltage_obj)
+    def flush(self):
+        """Emits the collected measurements"""
 
-        humidity_obj = Sensor.add_data(
-            meas_name="humidity", meas_unit="%", meas_dict=meas
-        )
+        rooms, self.rooms = self.rooms, {}
+        if not rooms:
+            return
+
+        window = self.window
+        if window is None and emit_window.window > 0:
+            window = emit_window
+        if window is not None:
+            window.add(rooms)
+        else:
+            emit_rooms(rooms)
 
-        obj_list.append(humidity_obj)
 
-    # yfs210c water flow measurement
-    elif meas["type"] == "yfs210c":
-        flow_obj = Sensor.add_data(meas_name="flow", meas_unit="L/Min", meas_dict=meas)
+def set_count_headers(resp: Response, counts):
+    """Reports the number of new and duplicate rows in response headers"""
 
-        obj_list.append(flow_obj)
+    resp.headers["New-Rows"] = str(counts.new)
+    resp.headers["Duplicate-Rows"] = str(counts.duplicate)
 
-    elif meas["type"] == "D10":
-        flow_obj = Sensor.add_data(meas_name="flow", meas_unit="G/Min", meas_dict=meas)
 
-        obj_list.append(flow_obj)
+def process_measurement_dict(meas: dict):
+    dedup = dedup_enabled()
+    with ingest_counts(db.session) as counts:
+        obj_list = add_measurement_dict(meas, commit=not dedup)
+        if dedup and None not in obj_list:
+            try:
+                # skips the rows of a resent measurement
+                insert_pending(db.session)
+                db.session.commit()
+            except IntegrityError:
+                # a cell or logger was deleted by another worker after it was
+                # cached
+                db.session.rollback()
+                invalidate_cached(meas)
+                obj_list = [None] * len(obj_list)
 
     resp = Response()
     resp.content_type = "application/octet-stream"
+    set_count_headers(resp, counts)
     if None in obj_list:
         resp.status_code = 501
         resp.data = encode_response(False)
     else:
+        # a resend is acknowledged like the original upload
         resp.status_code = 200
         resp.data = encode_response(True)
 
-        cell_id = meas.get("cellId")
-        if cell_id:
-            try:
-                measurement_data = {
-                    "type": meas.get("type", "unknown"),
-                    "cellId": cell_id,
-                    "loggerId": meas.get("loggerId"),
-                    "timestamp": meas.get("ts"),
-                    "data": meas.get("data", {}),
-                    "obj_count": len([obj for obj in obj_list if obj is not None]),
-                }
-                room_name = f"cell_{cell_id}"
-
-                socketio.emit("measurement_received", measurement_data, room=room_name)
-
-                if DEBUG_SOCKETIO:
-                    has_subscribers = socketio.server.manager.rooms.get("/", {}).get(
-                        room_name
-                    )
-                    if has_subscribers:
-                        count = len(has_subscribers)
-                        print(f"[socketio] emitted to {room_name}: {count} subscribers")
-            except Exception as e:
-                print(f"[socketio] error emitting measurement: {e}")
+        if counts.new or not counts.duplicate:
+            emits = EmitBuffer()
+            emits.add(meas, len([obj for obj in obj_list if obj is not None]))
+            emits.flush()
+
+    return resp
+
 
+def split_delimited(data: bytes) -> list[bytes]:
+    """Splits a stream of length-delimited protobuf messages
+
+    Each message is prefixed by its length encoded as a base 128 varint, the
+    same framing used by protobuf's writeDelimitedTo.
+
+    Args:
+        data: Concatenated length-delimited messages
+
+    Returns:
+        List of serialized messages.
+
+    Raises:
+        ValueError: When the stream is truncated.
+    """
+
+    msgs = []
+    pos = 0
+    while pos < len(data):
+        length = 0
+        shift = 0
+        while True:
+            if pos >= len(data):
+                raise ValueError("Truncated length prefix")
+            byte = data[pos]
+            pos += 1
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        if pos + length > len(data):
+            raise ValueError("Truncated message")
+        msgs.append(data[pos : pos + length])
+        pos += length
+
+    return msgs
+
+
+def invalidate_cached(meas: dict):
+    """Drops the cached cell, logger and sensors of a measurement
+
+    Used when an insert violates a foreign key, since the existence caches of
+    other workers are not invalidated when a row is deleted.
+    """
+
+    cell_id = meas.get("cellId")
+    sensor_registry.invalidate_cell(cell_id)
+    cell_cache.invalidate(cell_id)
+    logger_cache.invalidate(meas.get("loggerId"))
+
+
+def _claim_key(keys: dict, obj) -> bool:
+    """Checks if the row of obj was inserted, each row is claimed once"""
+
+    table_keys = keys.get(MODEL_TABLES[type(obj)], set())
+    key = key_from_object(obj)
+    if key not in table_keys:
+        return False
+    table_keys.discard(key)
+    return True
+
+
+def process_measurement_batch(meas_list: list) -> Response:
+    """Process a batch of measurements in a single transaction
+
+    Every measurement is added to the session without committing and the whole
+    batch is committed once with the time-series rows written through COPY.
+    Cells, loggers and sensors are resolved through the per worker caches so
+    each is queried at most once per batch. Malformed measurements are
+    rejected up front, see utils.sensor_types.check_reading, and do not
+    prevent the rest of the batch from being inserted. When a cell or logger
+    deleted by another worker is still cached, the foreign key violation drops
+    the cached entries of the batch and the batch is retried once.
+
+    Like the single measurement path, measurements whose rows were all
+    skipped as duplicates are not emitted to clients.
+
+    Per measurement status codes follow the single measurement path: 200 on
+    success, 501 when the cell/logger is unknown and 400 when the measurement
+    is malformed.
+
+    Args:
+        meas_list: List of measurement dictionaries. Entries that are not
+            dictionaries (e.g. failed to decode) are reported as malformed.
+
+    Returns:
+        Flask response with a json body containing the per measurement status
+        vector and the number of new and duplicate rows. Duplicates are only
+        skipped when INGEST_DEDUP is set.
+
+    Raises:
+        IntegrityError: The retried batch still violates a constraint.
+    """
+
+    dedup = dedup_enabled()
+    # malformed entries are rejected before anything is added to the session
+    valid = set()
+    for idx, meas in enumerate(meas_list):
+        if not isinstance(meas, dict):
+            continue
+        try:
+            check_reading(meas)
+        except (KeyError, TypeError, ValueError):
+            continue
+        valid.add(idx)
+
+    invalidated = False
+    while True:
+        status = []
+        inserted = []
+        new_keys = {}
+
+        try:
+            with db.session.no_autoflush:
+                for idx, meas in enumerate(meas_list):
+                    if idx not in valid:
+                        status.append(400)
+                        continue
+
+                    obj_list = add_measurement_dict(meas, commit=False)
+                    if None in obj_list:
+                        status.append(501)
+                    else:
+                        status.append(200)
+                        inserted.append((meas, obj_list))
+
+            # time-series rows are written with COPY rather than row by row
+            # inserts
+            with ingest_counts(db.session) as counts:
+                copy_pending(db.session, dedup=dedup, inserted=new_keys)
+                db.session.commit()
+            break
+        except IntegrityError:
+            # a cell or logger was deleted by another worker after it was
+            # cached, the batch is started over once without the cached
+            # entries so the measurements of the deleted rows are rejected
+            db.session.rollback()
+            if invalidated:
+                raise
+            for idx in valid:
+                invalidate_cached(meas_list[idx])
+            invalidated = True
+
+    emits = EmitBuffer()
+    for meas, obj_list in inserted:
+        if dedup:
+            # resent measurements were already sent to clients
+            obj_list = [obj for obj in obj_list if _claim_key(new_keys, obj)]
+        if obj_list:
+            emits.add(meas, len(obj_list))
+    emits.flush()
+
+    resp = jsonify(
+        {
+            "status": status,
+            "inserted": len(inserted),
+            "failed": len(status) - len(inserted),
+            "new": counts.new,
+            "duplicate": counts.duplicate,
+        }
+    )
+    resp.status_code = 200
     return resp
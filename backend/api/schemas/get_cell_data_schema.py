@@ -1,28 +1,32 @@
 from . import ma
 from marshmallow import validate
+from ..utils.aggregate import Aggregates
+from ..utils.downsample import DOWNSAMPLE_METHODS
+from ..utils.pagination import Cursor, StreamCursor
+from ..utils.resample import validate_resample
 
 
 class GetCellDataSchema(ma.SQLAlchemySchema):
     """validates get request for cell data"""
 
-    cellIds = ma.Str()
-    resample = ma.Str(
-        required=False,
-        validate=validate.OneOf(
-            [
-                "none",
-                "second",
-                "minute",
-                "hour",
-                "day",
-                "week",
-                "month",
-                "quarter",
-                "year",
-            ]
-        ),
-        load_default="hour",
-    )
+    # comma separated list of cell ids
+    cellIds = ma.Str(validate=validate.Regexp(r"^\d+(,\d+)*$"))
+    # fixed unit or interval such as 15m
+    resample = ma.Str(required=False, validate=validate_resample, load_default="hour")
+    # origin of interval buckets
+    origin = ma.DateTime("rfc", required=False)
+    # comma separated aggregates of resampled data besides the average
+    agg = Aggregates(required=False)
     startTime = ma.DateTime("rfc", required=False)
     endTime = ma.DateTime("rfc", required=False)
     stream = ma.Bool(required=False)
+    downsample = ma.Str(required=False, validate=validate.OneOf(DOWNSAMPLE_METHODS))
+    points = ma.Int(
+        required=False, validate=validate.Range(min=4, max=100000), load_default=1000
+    )
+    # id of the last row of the previous streamed response
+    after = StreamCursor(required=False)
+    # page size of raw data, capped by MAX_PAGE_SIZE
+    limit = ma.Int(required=False, validate=validate.Range(min=1))
+    # next token of the previous page of raw data
+    cursor = Cursor(required=False)
@@ -0,0 +1,33 @@
+from . import ma
+from marshmallow import validate
+from ..utils.aggregate import Aggregates
+from ..utils.downsample import DOWNSAMPLE_METHODS
+from ..utils.pagination import Cursor, StreamCursor
+from ..utils.resample import validate_resample
+
+
+class GetCellSensorDataSchema(ma.SQLAlchemySchema):
+    """validates get request for the sensor data of a cell"""
+
+    # comma separated lists of sensor names and measurements
+    names = ma.Str(required=False)
+    measurements = ma.Str(required=False)
+    # fixed unit or interval such as 15m
+    resample = ma.Str(required=False, validate=validate_resample, load_default="hour")
+    # origin of interval buckets
+    origin = ma.DateTime("rfc", required=False)
+    # comma separated aggregates of resampled data besides the average
+    agg = Aggregates(required=False)
+    startTime = ma.DateTime("rfc", required=False)
+    endTime = ma.DateTime("rfc", required=False)
+    stream = ma.Bool(required=False)
+    downsample = ma.Str(required=False, validate=validate.OneOf(DOWNSAMPLE_METHODS))
+    points = ma.Int(
+        required=False, validate=validate.Range(min=4, max=100000), load_default=1000
+    )
+    # id of the last row of the previous streamed response
+    after = StreamCursor(required=False)
+    # page size of raw data, capped by MAX_PAGE_SIZE
+    limit = ma.Int(required=False, validate=validate.Range(min=1))
+    # next token of the previous page of raw data
+    cursor = Cursor(required=False)
@@ -0,0 +1,57 @@
+import re
+
+from . import ma
+from marshmallow import ValidationError, validate
+from ..utils.export import FILL_METHODS, PANELS
+from ..utils.resample import RESAMPLE_UNITS, parse_interval
+
+_SENSOR_PANEL = re.compile(r"^s:\d+$")
+
+
+def validate_panels(value: str):
+    """Validator of comma separated builtin panels and s:{sensor_id} panels"""
+
+    for panel in value.split(","):
+        if panel not in PANELS and _SENSOR_PANEL.match(panel) is None:
+            raise ValidationError(f"Unknown panel: {panel}")
+
+
+def validate_export_resample(value: str):
+    """Validator of the resample level of exports, which always resample"""
+
+    if value not in RESAMPLE_UNITS[1:] and parse_interval(value) is None:
+        raise ValidationError(
+            f"Must be one of: {', '.join(RESAMPLE_UNITS[1:])} or an interval"
+            " such as 15m."
+        )
+
+
+def validate_tolerance(value: str):
+    if parse_interval(value) is None:
+        raise ValidationError("Must be an interval such as 15m.")
+
+
+class GetExportSchema(ma.SQLAlchemySchema):
+    """validates get request for exports"""
+
+    # comma separated list of cell ids of the builtin panels
+    cellIds = ma.Str(validate=validate.Regexp(r"^\d+(,\d+)*$"))
+    # comma separated builtin panels and s:{sensor_id} sensors
+    panels = ma.Str(required=True, validate=validate_panels)
+    startTime = ma.DateTime("rfc", required=False)
+    endTime = ma.DateTime("rfc", required=False)
+    # fixed unit or interval such as 15m of the common grid
+    resample = ma.Str(
+        required=False, validate=validate_export_resample, load_default="hour"
+    )
+    # origin of interval buckets
+    origin = ma.DateTime("rfc", required=False)
+    # fill of buckets without a value
+    fill = ma.Str(
+        required=False, validate=validate.OneOf(FILL_METHODS), load_default="none"
+    )
+    # maximum distance of filled values, such as 1h
+    tolerance = ma.Str(required=False, validate=validate_tolerance)
+    format = ma.Str(
+        required=False, validate=validate.OneOf(("csv", "parquet")), load_default="csv"
+    )
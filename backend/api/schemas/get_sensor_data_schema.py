@@ -1,4 +1,9 @@
 from . import ma
+from marshmallow import validate
+from ..utils.aggregate import Aggregates
+from ..utils.downsample import DOWNSAMPLE_METHODS
+from ..utils.pagination import Cursor, StreamCursor
+from ..utils.resample import validate_resample
 
 
 class GetSensorDataSchema(ma.SQLAlchemySchema):
@@ -7,7 +12,22 @@ class GetSensorDataSchema(ma.SQLAlchemySchema):
     cellId = ma.Int()
     name = ma.String()
     measurement = ma.String()
-    resample = ma.String(required=False)
+    # fixed unit or interval such as 15m
+    resample = ma.String(required=False, validate=validate_resample)
+    # origin of interval buckets
+    origin = ma.DateTime("rfc", required=False)
+    # comma separated aggregates of resampled data besides the average
+    agg = Aggregates(required=False)
     startTime = ma.DateTime("rfc", required=False)
     endTime = ma.DateTime("rfc", required=False)
     stream = ma.Bool(required=False)
+    downsample = ma.String(required=False, validate=validate.OneOf(DOWNSAMPLE_METHODS))
+    points = ma.Int(
+        required=False, validate=validate.Range(min=4, max=100000), load_default=1000
+    )
+    # id of the last row of the previous streamed response
+    after = StreamCursor(required=False)
+    # page size of raw data, capped by MAX_PAGE_SIZE
+    limit = ma.Int(required=False, validate=validate.Range(min=1))
+    # next token of the previous page of raw data
+    cursor = Cursor(required=False)
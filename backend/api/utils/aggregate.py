@@ -0,0 +1,127 @@
+"""Aggregates of resampled time-series queries
+
+Resampled queries return the average of each measurement per bucket. The
+``agg`` argument adds other aggregates of the same buckets, computed in the
+same grouped scan and returned as parallel columns named
+``{measurement}_{aggregate}``, e.g. ``v_min``, ``v_max`` and ``v_count`` for
+``agg=min,max,count``. The average stays in the measurement column so charts
+reading it are unchanged.
+
+Supported aggregates are avg, min, max, count (of non-null values), stddev
+(sample standard deviation), first and last (by timestamp) and percentiles
+``p1`` to ``p99`` (continuous, interpolated between values). Combinations of
+avg, min, max and count are read from the rollups, others scan the raw rows.
+Raw reads are not aggregated and ignore ``agg``.
+
+All aggregates are computed in the grouped scan. First and last are the
+minimum and maximum of ``ARRAY[epoch of ts, value]`` per bucket, which keeps a
+single pair per bucket instead of collecting and sorting its values.
+Percentiles are exact, they sort the values of each bucket.
+"""
+
+import re
+
+from marshmallow import ValidationError, fields
+from sqlalchemy import Float, cast, extract, func
+from sqlalchemy.dialects.postgresql import ARRAY, array
+
+AGGREGATES = ("avg", "min", "max", "count", "stddev", "first", "last")
+
+# aggregates that can be computed from the rollups
+ROLLUP_AGGREGATES = ("avg", "min", "max", "count")
+
+_PERCENTILE = re.compile(r"^p([1-9][0-9]?)$")
+
+
+def parse_aggregates(value: str) -> list:
+    """Aggregates of a comma separated list, without duplicates
+
+    Raises:
+        ValueError: When an aggregate is not supported.
+    """
+
+    aggregates = list(dict.fromkeys(value.split(",")))
+    for name in aggregates:
+        if name not in AGGREGATES and _PERCENTILE.match(name) is None:
+            raise ValueError(f"Unknown aggregate: {name}")
+    return aggregates
+
+
+def extra_aggregates(agg, resample: str, stream=False, downsample=None) -> list:
+    """Aggregates returned next to the average, none for raw reads
+
+    Args:
+        agg: List of aggregates or None
+        resample: Resolved resample level of the query
+        stream: Whether the query is a live stream query
+        downsample: Downsampling method of the query
+    """
+
+    if not agg or stream or downsample or resample == "none":
+        return []
+    return [name for name in agg if name != "avg"]
+
+
+def _edge(func_, expr, ts):
+    """Value of expr at the minimum or maximum ts of a group, func_ is min or max
+
+    Measurements are numeric, so the value is paired with the timestamp in a
+    float array and cast back to the type of expr.
+    """
+
+    pair = array([cast(extract("epoch", ts), Float), cast(expr, Float)])
+    return cast(func_(pair, type_=ARRAY(Float))[2], expr.type)
+
+
+def aggregate(name: str, expr, ts):
+    """SQL aggregate of expr per group
+
+    Args:
+        name: Aggregate, see AGGREGATES, or percentile
+        expr: Measurement expression
+        ts: Timestamp column ordering first and last
+    """
+
+    if name == "min":
+        return func.min(expr)
+    if name == "max":
+        return func.max(expr)
+    if name == "count":
+        return func.count(expr)
+    if name == "stddev":
+        return cast(func.stddev_samp(expr), Float)
+    if name == "first":
+        return _edge(func.min, expr, ts)
+    if name == "last":
+        return _edge(func.max, expr, ts)
+    match = _PERCENTILE.match(name)
+    if match is not None:
+        return func.percentile_cont(int(match.group(1)) / 100).within_group(expr)
+    raise ValueError(f"Unknown aggregate: {name}")
+
+
+def aggregate_columns(measurements: dict, aggregates: list, ts) -> list:
+    """Labelled aggregate columns {measurement}_{aggregate}
+
+    Args:
+        measurements: Dictionary of label to measurement expression
+        aggregates: Aggregates other than avg
+        ts: Timestamp column ordering first and last
+    """
+
+    return [
+        aggregate(name, expr, ts).label(f"{label}_{name}")
+        for label, expr in measurements.items()
+        for name in aggregates
+    ]
+
+
+class Aggregates(fields.Str):
+    """Query argument of comma separated aggregates, deserialized into a list"""
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        value = super()._deserialize(value, attr, data, **kwargs)
+        try:
+            return parse_aggregates(value)
+        except ValueError as e:
+            raise ValidationError(str(e)) from e
@@ -0,0 +1,143 @@
+"""Benchmark of the time-series write paths
+
+Loads RocketLogger csv files and writes their rows into power_data and
+teros_data with bulk_save_objects, text COPY and binary COPY. Each method runs
+in its own transaction that is rolled back afterwards, so the benchmark leaves
+no rows behind.
+
+Examples
+--------
+Benchmark the sample data repeated 100 times::
+
+    $ python -m api.utils.bench_bulk_write --header-rows 1 --repeat 100 \\
+        data/imwut_*.csv
+
+Help prompt for utility::
+
+    $ python -m api.utils.bench_bulk_write -h
+"""
+
+import csv
+import time
+
+from sqlalchemy.orm import Session
+
+from ..conn import engine
+from ..models.power_data import PowerData
+from ..models.teros_data import TEROSData
+from .bulk_write import copy_rows
+from .get_or_create import get_or_create_cell, get_or_create_logger
+from .import_cell_data import parse_row
+
+METHODS = ("orm", "copy-text", "copy-binary")
+
+
+def load_rows(paths, header_rows=11):
+    """Parses csv files into a list of (power, teros) tuples"""
+
+    rows = []
+    for path in paths:
+        with open(path, newline="", encoding="UTF-8") as csvfile:
+            data_reader = csv.reader(csvfile)
+            for _ in range(header_rows):
+                next(data_reader)
+            rows.extend(parse_row(row) for row in data_reader)
+    return rows
+
+
+def write_orm(sess, logger_id, cell_id, rows):
+    objs = []
+    for power, teros in rows:
+        ts, current, voltage = power
+        objs.append(
+            PowerData(
+                logger_id=logger_id,
+                cell_id=cell_id,
+                ts=ts,
+                current=current,
+                voltage=voltage,
+            )
+        )
+        ts, vwc, raw_vwc, temp, ec, water_pot = teros
+        objs.append(
+            TEROSData(
+                cell_id=cell_id,
+                ts=ts,
+                vwc=vwc,
+                raw_vwc=raw_vwc,
+                temp=temp,
+                ec=ec,
+                water_pot=water_pot,
+            )
+        )
+    sess.bulk_save_objects(objs)
+    sess.flush()
+
+
+def write_copy(sess, logger_id, cell_id, rows, binary):
+    copy_rows(
+        sess,
+        "power_data",
+        ((logger_id, cell_id, *p) for p, _ in rows),
+        binary=binary,
+    )
+    copy_rows(sess, "teros_data", ((cell_id, *t) for _, t in rows), binary=binary)
+
+
+def run(method, rows):
+    """Times a write method
+
+    Returns
+    -------
+    float
+        Seconds spent writing the rows.
+    """
+
+    with Session(engine) as sess:
+        logger = get_or_create_logger(sess, "bench_bulk_write")
+        cell = get_or_create_cell(sess, "bench_bulk_write")
+
+        start = time.perf_counter()
+        if method == "orm":
+            write_orm(sess, logger.id, cell.id, rows)
+        else:
+            write_copy(sess, logger.id, cell.id, rows, method == "copy-binary")
+        elapsed = time.perf_counter() - start
+
+        sess.rollback()
+
+    return elapsed
+
+
+def main(paths, repeat=1, header_rows=11, methods=METHODS):
+    rows = load_rows(paths, header_rows) * repeat
+    # each csv row is written to both power_data and teros_data
+    nrows = len(rows) * 2
+
+    print(f"{nrows} rows from {len(paths)} files")
+    for method in methods:
+        elapsed = run(method, rows)
+        print(f"{method:>12}: {elapsed:8.3f} s {nrows / elapsed:12.0f} rows/s")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bulk write benchmark")
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Number of times the data is repeated"
+    )
+    parser.add_argument(
+        "--header-rows", type=int, default=11, help="Number of header rows to skip"
+    )
+    parser.add_argument(
+        "--method",
+        action="append",
+        choices=METHODS,
+        help="Method to benchmark, can be repeated (default: all)",
+    )
+    parser.add_argument("paths", nargs="+", help="Paths to cell data csv")
+
+    args = parser.parse_args()
+
+    main(args.paths, args.repeat, args.header_rows, args.method or METHODS)
@@ -0,0 +1,437 @@
+"""Widens the ids of the time-series tables to bigint and reports id headroom
+
+power_data, teros_data and data were created with integer serial ids, which
+run out after 2^31 - 1 rows. Ingest fails once a sequence reaches the maximum
+of its column, so the ids are widened to bigint online.
+
+Migration
+---------
+The migration widening the ids (``flask db upgrade``) adds an empty bigint
+column ``id_big`` to each table and a trigger setting it to the id of every
+inserted or updated row. Changing the type of the id in place would rewrite
+the table under an exclusive lock, instead:
+
+1. The column is set for the existing rows in batches of ids, each in its own
+   transaction, while the application keeps writing to the table.
+2. The unique index of the new primary key is built concurrently for each
+   partition and a NOT NULL check of the column is validated without blocking
+   writes.
+3. In a short transaction the old primary key and id are dropped, ``id_big``
+   is renamed to ``id``, the sequence is widened and the primary key is added
+   using the indexes built beforehand.
+
+Ids are unchanged, so rollup watermarks and pagination cursors stay valid. The
+tables have to be partitioned first, see utils/partition.py.
+
+Examples
+--------
+Print the remaining ids of each table::
+
+    $ python -m api.utils.bigint_ids
+
+Widen the ids of all tables::
+
+    $ python -m api.utils.bigint_ids --migrate
+
+Help prompt for utility::
+
+    $ python -m api.utils.bigint_ids -h
+"""
+
+from sqlalchemy import text
+
+from ..conn import engine
+from .partition import partitioned_table, partitions
+
+TABLES = ("power_data", "teros_data", "data")
+
+# ids used before the headroom of a table is reported as unhealthy
+ALERT_USED = 0.8
+
+SHADOW_COLUMN = "id_big"
+
+_TYPE_MAX = {"integer": 2**31 - 1, "bigint": 2**63 - 1}
+
+
+def id_type(conn, table: str) -> str:
+    """SQL type of the id column of table"""
+
+    return conn.execute(
+        text(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = CAST(:table AS regclass) AND attname = 'id'"
+        ),
+        {"table": table},
+    ).scalar()
+
+
+def has_shadow_column(conn, table: str) -> bool:
+    """Whether table has the bigint copy of its id"""
+
+    return (
+        conn.execute(
+            text(
+                "SELECT 1 FROM pg_attribute WHERE attrelid = CAST(:table AS regclass) "
+                "AND attname = :column AND NOT attisdropped"
+            ),
+            {"table": table, "column": SHADOW_COLUMN},
+        ).scalar()
+        is not None
+    )
+
+
+def id_headroom(conn, table: str) -> dict:
+    """Remaining ids of a table
+
+    The last id is read from the sequence of the table, ids are limited by the
+    type of the id column and the maximum of the sequence.
+
+    Returns:
+        Dictionary with the type of the id, the last and maximum ids, the
+        number of remaining ids and the fraction of ids used.
+    """
+
+    type_, last_id, seq_max = conn.execute(
+        text(
+            "SELECT format_type(a.atttypid, a.atttypmod), "
+            "pg_sequence_last_value(s.seqrelid), s.seqmax "
+            "FROM pg_attribute a, pg_sequence s "
+            "WHERE a.attrelid = CAST(:table AS regclass) AND a.attname = 'id' "
+            "AND s.seqrelid = CAST(pg_get_serial_sequence(:table, 'id') AS regclass)"
+        ),
+        {"table": table},
+    ).one()
+
+    last_id = last_id or 0
+    max_id = min(_TYPE_MAX.get(type_, seq_max), seq_max)
+    return {
+        "type": type_,
+        "last_id": last_id,
+        "max_id": max_id,
+        "remaining": max_id - last_id,
+        "used": round(last_id / max_id, 6),
+    }
+
+
+def backfill(table: str, batch_size: int = 100000, start_id: int = 0, eng=engine):
+    """Sets the bigint copy of the id of the existing rows
+
+    Rows are updated in batches of ids, each in its own transaction. Rows
+    written since the migration are skipped, their copy is set by the trigger.
+
+    Args:
+        table: Name of the time-series table
+        batch_size: Number of rows per batch
+        start_id: Only update rows with a greater id, to resume a backfill
+        eng: SQLAlchemy engine
+
+    Returns:
+        Number of updated rows.
+    """
+
+    updated = 0
+    last_id = start_id
+    while True:
+        with eng.begin() as conn:
+            upper = conn.execute(
+                text(
+                    f"SELECT max(id) FROM (SELECT id FROM {table} WHERE id > :lo "
+                    "ORDER BY id LIMIT :n) batch"
+                ),
+                {"lo": last_id, "n": batch_size},
+            ).scalar()
+            if upper is None:
+                return updated
+
+            updated += conn.execute(
+                text(
+                    f"UPDATE {table} SET {SHADOW_COLUMN} = id "
+                    f"WHERE id > :lo AND id <= :hi AND {SHADOW_COLUMN} IS NULL"
+                ),
+                {"lo": last_id, "hi": upper},
+            ).rowcount
+            last_id = upper
+        print(f"{table}: updated up to id {last_id}", flush=True)
+
+
+def _index_name(partition: str) -> str:
+    return f"{partition}_{SHADOW_COLUMN}_key"
+
+
+def _index_state(conn, name: str):
+    """Returns None if the index does not exist, else whether it is valid"""
+
+    return conn.execute(
+        text(
+            "SELECT i.indisvalid FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+        ),
+        {"name": name},
+    ).scalar()
+
+
+def _index_states(conn, table: str) -> dict:
+    """Dictionary of the partitions of table to whether their unique index on
+    the bigint id is valid, None if it does not exist"""
+
+    return {
+        partition: _index_state(conn, _index_name(partition))
+        for partition in partitions(conn, table)
+    }
+
+
+def _id_indexes(conn, table: str) -> list:
+    """Indexes of table other than the primary key on the id
+
+    Returns:
+        List of the name, uniqueness, key columns and included columns of
+        each index.
+    """
+
+    rows = conn.execute(
+        text(
+            "SELECT c.relname, i.indisunique, i.indnkeyatts, "
+            "array_agg(a.attname ORDER BY k.n) "
+            "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "CROSS JOIN LATERAL unnest(CAST(i.indkey AS int2[])) "
+            "WITH ORDINALITY k(attnum, n) "
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum "
+            "WHERE i.indrelid = CAST(:table AS regclass) AND NOT i.indisprimary "
+            "GROUP BY c.relname, i.indisunique, i.indnkeyatts "
+            "HAVING bool_or(a.attname = 'id') ORDER BY c.relname"
+        ),
+        {"table": table},
+    )
+    return [
+        (name, unique, columns[:keys], columns[keys:])
+        for name, unique, keys, columns in rows
+    ]
+
+
+def _copy_name(index: str) -> str:
+    return f"{index}_{SHADOW_COLUMN}"
+
+
+def _copy_index(conn, table: str, index, unique, columns, include):
+    """Builds a copy of an index on the bigint id, per partition concurrently
+
+    The copy of the partitioned table is valid once the copy of every
+    partition is attached to it.
+    """
+
+    def names(columns):
+        return ", ".join(SHADOW_COLUMN if col == "id" else col for col in columns)
+
+    copy = _copy_name(index)
+    definition = f"({names(columns)})"
+    if include:
+        definition += f" INCLUDE ({names(include)})"
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+
+    conn.execute(
+        text(f"CREATE {kind} IF NOT EXISTS {copy} ON ONLY {table} {definition}")
+    )
+    attached = set(
+        conn.execute(
+            text(
+                "SELECT CAST(i.indrelid AS regclass)::text FROM pg_inherits h "
+                "JOIN pg_index i ON i.indexrelid = h.inhrelid "
+                "WHERE h.inhparent = CAST(:copy AS regclass)"
+            ),
+            {"copy": copy},
+        ).scalars()
+    )
+    for partition in partitions(conn, table):
+        if partition in attached:
+            continue
+        leaf = f"{partition}_{'_'.join(columns)}_{SHADOW_COLUMN}"
+        if _index_state(conn, leaf) is False:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY {leaf}"))
+        conn.execute(
+            text(
+                f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {leaf} "
+                f"ON {partition} {definition}"
+            )
+        )
+        conn.execute(text(f"ALTER INDEX {copy} ATTACH PARTITION {leaf}"))
+
+
+def prepare(table: str, lock_timeout: str = "5s", eng=engine):
+    """Builds the indexes and NOT NULL check of the new primary key online
+
+    The unique index of each partition is built concurrently, as are copies
+    on the bigint id of the other indexes including the id, such as the
+    covering indexes of the models. The check is added without checking the
+    existing rows, which only locks the table for a moment, then validated
+    while writes continue.
+    """
+
+    with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for partition, valid in _index_states(conn, table).items():
+            if valid is False:
+                # left behind by an interrupted build
+                conn.execute(text(f"DROP INDEX CONCURRENTLY {_index_name(partition)}"))
+            if not valid:
+                conn.execute(
+                    text(
+                        f"CREATE UNIQUE INDEX CONCURRENTLY {_index_name(partition)} "
+                        f"ON {partition} ({SHADOW_COLUMN}, ts)"
+                    )
+                )
+        for index in _id_indexes(conn, table):
+            _copy_index(conn, table, *index)
+
+    check = f"{table}_{SHADOW_COLUMN}_not_null"
+    with eng.begin() as conn:
+        conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+        conn.execute(
+            text(
+                f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {check}, "
+                f"ADD CONSTRAINT {check} CHECK ({SHADOW_COLUMN} IS NOT NULL) NOT VALID"
+            )
+        )
+    with eng.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}"))
+
+
+def swap(table: str, lock_timeout: str = "5s", eng=engine):
+    """Replaces the integer id of a prepared table with its bigint copy
+
+    Writes to the table wait while it is locked, which fails instead of
+    queueing behind long running queries after lock_timeout. Nothing is
+    scanned or rebuilt while the table is locked.
+
+    Raises:
+        RuntimeError: When a partition or index was created since prepare,
+            prepare again.
+    """
+
+    check = f"{table}_{SHADOW_COLUMN}_not_null"
+    with eng.begin() as conn:
+        conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+        conn.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+
+        states = _index_states(conn, table)
+        missing = [
+            _index_name(partition) for partition, valid in states.items() if not valid
+        ]
+        indexes = [index for index, *_ in _id_indexes(conn, table)]
+        missing += [
+            _copy_name(index)
+            for index in indexes
+            if not _index_state(conn, _copy_name(index))
+        ]
+        if missing:
+            raise RuntimeError(f"{table}: missing indexes {', '.join(missing)}")
+        sequence = conn.execute(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}
+        ).scalar()
+
+        conn.execute(text(f"DROP TRIGGER {table}_{SHADOW_COLUMN} ON {table}"))
+        conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {table}_pkey"))
+        # proven by the validated check instead of a scan
+        conn.execute(
+            text(f"ALTER TABLE {table} ALTER COLUMN {SHADOW_COLUMN} SET NOT NULL")
+        )
+        conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {check}"))
+
+        conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN id TO id_int"))
+        conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN {SHADOW_COLUMN} TO id"))
+        conn.execute(
+            text(
+                f"ALTER TABLE {table} ALTER COLUMN id "
+                f"SET DEFAULT nextval('{sequence}'::regclass)"
+            )
+        )
+        conn.execute(text(f"ALTER SEQUENCE {sequence} AS bigint OWNED BY {table}.id"))
+        # drops the indexes including the old id
+        conn.execute(text(f"ALTER TABLE {table} DROP COLUMN id_int"))
+        for index in indexes:
+            conn.execute(text(f"ALTER INDEX {_copy_name(index)} RENAME TO {index}"))
+
+        # the primary key of a partitioned table cannot use an existing index,
+        # it adopts the primary keys of its partitions
+        for partition in partitions(conn, table):
+            conn.execute(
+                text(
+                    f"ALTER TABLE {partition} ADD CONSTRAINT {partition}_pkey "
+                    f"PRIMARY KEY USING INDEX {_index_name(partition)}"
+                )
+            )
+        conn.execute(
+            text(
+                f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, ts)"
+            )
+        )
+
+
+def migrate(table: str, batch_size: int = 100000, start_id: int = 0, eng=engine):
+    """Backfills, prepares and swaps the id of a table, see the module docs
+
+    Returns:
+        Number of backfilled rows.
+    """
+
+    with eng.connect() as conn:
+        if id_type(conn, table) == "bigint":
+            return 0
+        if not has_shadow_column(conn, table):
+            raise RuntimeError(f"{table} has no {SHADOW_COLUMN}, run flask db upgrade")
+        if partitioned_table(conn, table) != table:
+            raise RuntimeError(
+                f"{table} is not partitioned, run python -m api.utils.partition "
+                "--migrate"
+            )
+
+    updated = backfill(table, batch_size=batch_size, start_id=start_id, eng=eng)
+    prepare(table, eng=eng)
+    swap(table, eng=eng)
+    return updated
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time-series id utility")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100000,
+        help="Number of rows per batch of --migrate",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Widen the integer ids of the tables to bigint",
+    )
+    parser.add_argument(
+        "--start-id",
+        type=int,
+        default=0,
+        help="Resume --migrate after the rows with ids up to START_ID",
+    )
+    parser.add_argument(
+        "tables",
+        nargs="*",
+        default=list(TABLES),
+        help=f"Tables, any of {', '.join(TABLES)} (default: all)",
+    )
+
+    args = parser.parse_args()
+    for table in args.tables:
+        if table not in TABLES:
+            parser.error(f"invalid table: {table}")
+
+    if args.migrate:
+        for table in args.tables:
+            rows = migrate(table, batch_size=args.batch_size, start_id=args.start_id)
+            print(f"{table}: backfilled {rows} rows", flush=True)
+
+    with engine.connect() as conn:
+        for table in args.tables:
+            headroom = id_headroom(conn, table)
+            print(
+                f"{table}: {headroom['type']} ids, {headroom['remaining']} left "
+                f"({headroom['used']:.2%} used)",
+                flush=True,
+            )
@@ -0,0 +1,550 @@
+"""Bulk writer for the time-series tables
+
+Streams rows into power_data, teros_data and data with COPY FROM STDIN. Rows
+are encoded lazily while postgres reads the stream, so arbitrarily large
+inputs are written with bounded memory. Binary COPY is used by default since
+every column of the time-series tables has a fixed binary representation; the
+text format is kept as a fallback.
+
+When INGEST_DEDUP is set, rows conflicting with the unique indexes created by
+utils/dedup.py are skipped by the ingest paths: COPY goes through a staging
+table and the rows of single measurements are written with INSERT ... ON
+CONFLICT DO NOTHING by insert_pending. Other ORM writes are flushed as usual.
+The number of new and duplicate rows is available through ingest_counts.
+
+Aware timestamps are converted to UTC, naive ones are written as they are.
+
+Examples
+--------
+Write rows inside an ORM session so they are part of its transaction::
+
+    from api.utils.bulk_write import copy_rows
+
+    copy_rows(sess, "power_data", rows)
+
+where each row is a tuple in the order of ``TABLE_COLUMNS["power_data"]``.
+"""
+
+from __future__ import annotations
+
+import io
+import struct
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, scoped_session
+
+from ..models import db
+from ..models.data import Data
+from ..models.power_data import PowerData
+from ..models.teros_data import TEROSData
+from .query_cache import SERIES_COLUMNS, track_series
+
+# columns written for each table, ts_server and id are filled in by defaults
+TABLE_COLUMNS = {
+    "power_data": (
+        ("logger_id", "int4"),
+        ("cell_id", "int4"),
+        ("ts", "timestamp"),
+        ("current", "float8"),
+        ("voltage", "float8"),
+    ),
+    "teros_data": (
+        ("cell_id", "int4"),
+        ("ts", "timestamp"),
+        ("vwc", "float8"),
+        ("raw_vwc", "float8"),
+        ("temp", "float8"),
+        ("ec", "int4"),
+        ("water_pot", "float8"),
+    ),
+    "data": (
+        ("sensor_id", "int4"),
+        ("ts", "timestamp"),
+        ("float_val", "float8"),
+        ("int_val", "int4"),
+        ("text_val", "text"),
+    ),
+}
+
+# natural key of each table, unique once utils/dedup.py has been run
+TABLE_KEYS = {
+    "power_data": ("cell_id", "ts"),
+    "teros_data": ("cell_id", "ts"),
+    "data": ("sensor_id", "ts"),
+}
+
+MODEL_TABLES = {
+    PowerData: "power_data",
+    TEROSData: "teros_data",
+    Data: "data",
+}
+
+_PG_EPOCH = datetime(2000, 1, 1)
+_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_BINARY_TRAILER = struct.pack("!h", -1)
+_NULL = struct.pack("!i", -1)
+
+
+def _encode_int4(value) -> bytes:
+    # round like postgres does when casting a float to an integer
+    return struct.pack("!ii", 4, round(value))
+
+
+def _encode_float8(value) -> bytes:
+    return struct.pack("!id", 8, float(value))
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _encode_timestamp(value) -> bytes:
+    delta = _naive_utc(value) - _PG_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+    return struct.pack("!iq", 8, micros)
+
+
+def _encode_text(value) -> bytes:
+    data = str(value).encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+_BINARY_ENCODERS = {
+    "int4": _encode_int4,
+    "float8": _encode_float8,
+    "timestamp": _encode_timestamp,
+    "text": _encode_text,
+}
+
+_TEXT_ESCAPES = str.maketrans(
+    {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"},
+)
+
+
+def _text_field(value, pg_type) -> str:
+    if value is None:
+        return "\\N"
+    if pg_type == "timestamp":
+        return _naive_utc(value).isoformat()
+    if pg_type == "float8":
+        return repr(float(value))
+    if pg_type == "int4":
+        return str(round(value))
+    return str(value).translate(_TEXT_ESCAPES)
+
+
+def encode_binary(rows, types):
+    """Encodes rows in the binary COPY format
+
+    Args:
+        rows: Iterable of row tuples
+        types: Postgres type of each column
+
+    Yields:
+        Chunks of the binary COPY stream.
+    """
+
+    encoders = [_BINARY_ENCODERS[t] for t in types]
+    field_count = struct.pack("!h", len(encoders))
+
+    yield _BINARY_HEADER
+    for row in rows:
+        parts = [field_count]
+        for encode, value in zip(encoders, row):
+            parts.append(_NULL if value is None else encode(value))
+        yield b"".join(parts)
+    yield _BINARY_TRAILER
+
+
+def encode_text(rows, types):
+    """Encodes rows in the text COPY format
+
+    Args:
+        rows: Iterable of row tuples
+        types: Postgres type of each column
+
+    Yields:
+        Chunks of the text COPY stream.
+    """
+
+    for row in rows:
+        fields = [_text_field(value, t) for value, t in zip(row, types)]
+        yield ("\t".join(fields) + "\n").encode("utf-8")
+
+
+class _ChunkStream(io.RawIOBase):
+    """File-like object reading from an iterator of byte chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            try:
+                self._buf = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+class _CountingRows:
+    """Iterates rows while counting them"""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self.count = 0
+
+    def __iter__(self):
+        for row in self._rows:
+            self.count += 1
+            yield row
+
+
+def _tracked_rows(conn, table: str, rows):
+    """Records the series of rows written through a session, see query_cache"""
+
+    if not isinstance(conn, (Session, scoped_session)):
+        return rows
+
+    names = [name for name, _ in TABLE_COLUMNS[table]]
+    idx = names.index(SERIES_COLUMNS[table])
+    series = set()
+
+    def tracked():
+        for row in rows:
+            series.add(row[idx])
+            yield row
+        track_series(conn, table, series)
+
+    return tracked()
+
+
+def _dbapi_connection(conn):
+    """Gets the DBAPI connection from a session, connection or DBAPI object"""
+
+    if isinstance(conn, (Session, scoped_session)):
+        conn = conn.connection()
+    if isinstance(conn, Connection):
+        conn = conn.connection
+    if hasattr(conn, "dbapi_connection"):
+        conn = conn.dbapi_connection
+    return conn
+
+
+@contextmanager
+def _wrap_errors(sql: str):
+    """Raises errors of the DBAPI as SQLAlchemy exceptions
+
+    Statements executed on a raw cursor bypass SQLAlchemy, so a foreign key
+    violation would not be an IntegrityError otherwise.
+    """
+
+    try:
+        yield
+    except Exception as e:
+        dbapi = sys.modules.get(type(e).__module__.partition(".")[0])
+        error = getattr(dbapi, "Error", None)
+        if not (isinstance(error, type) and isinstance(e, error)):
+            raise
+        raise DBAPIError.instance(sql, None, e, error) from e
+
+
+def _copy(dbapi_conn, table: str, columns, rows, binary: bool) -> int:
+    names = ", ".join(name for name, _ in columns)
+    types = [t for _, t in columns]
+    fmt = "binary" if binary else "text"
+    sql = f"COPY {table} ({names}) FROM STDIN WITH (FORMAT {fmt})"
+
+    counted = _CountingRows(rows)
+    chunks = encode_binary(counted, types) if binary else encode_text(counted, types)
+
+    with _wrap_errors(sql), dbapi_conn.cursor() as cur:
+        if hasattr(cur, "copy_expert"):
+            # psycopg2
+            cur.copy_expert(sql, _ChunkStream(chunks), size=65536)
+        else:
+            # psycopg 3
+            with cur.copy(sql) as copy:
+                for chunk in chunks:
+                    copy.write(chunk)
+
+    return counted.count
+
+
+def copy_rows(conn, table: str, rows, binary: bool = True) -> int:
+    """Streams rows into a time-series table with COPY FROM STDIN
+
+    The rows are written in the transaction of conn and are not committed.
+
+    Args:
+        conn: SQLAlchemy session or connection, or a DBAPI connection
+        table: One of power_data, teros_data or data
+        rows: Iterable of tuples ordered as TABLE_COLUMNS[table]
+        binary: Use the binary COPY format
+
+    Returns:
+        Number of rows written.
+    """
+
+    rows = _tracked_rows(conn, table, rows)
+    return _copy(_dbapi_connection(conn), table, TABLE_COLUMNS[table], rows, binary)
+
+
+def copy_rows_dedup(
+    conn, table: str, rows, binary: bool = True, keys=None
+) -> tuple[int, int]:
+    """Streams rows into a time-series table skipping duplicates
+
+    The rows are copied into a temporary staging table and moved into the
+    table with INSERT ... ON CONFLICT DO NOTHING, so rows conflicting with the
+    unique index on TABLE_KEYS[table] are skipped. Without the unique index
+    every row is inserted, see utils/dedup.py.
+
+    Args:
+        conn: SQLAlchemy session or connection, or a DBAPI connection
+        table: One of power_data, teros_data or data
+        rows: Iterable of tuples ordered as TABLE_COLUMNS[table]
+        binary: Use the binary COPY format
+        keys: Set the TABLE_KEYS[table] tuples of the inserted rows are added
+            to, rows that were skipped are left out
+
+    Returns:
+        Tuple of the number of new and duplicate rows.
+    """
+
+    columns = TABLE_COLUMNS[table]
+    names = ", ".join(name for name, _ in columns)
+    staging = f"staging_{table}"
+
+    dbapi_conn = _dbapi_connection(conn)
+    with dbapi_conn.cursor() as cur:
+        # kept for the lifetime of the connection and emptied on commit
+        cur.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS "
+            f"AS SELECT {names} FROM {table} WITH NO DATA"
+        )
+        cur.execute(f"TRUNCATE {staging}")
+
+    rows = _tracked_rows(conn, table, rows)
+    count = _copy(dbapi_conn, staging, columns, rows, binary)
+
+    sql = (
+        f"INSERT INTO {table} ({names}) SELECT {names} FROM {staging} "
+        "ON CONFLICT DO NOTHING"
+    )
+    with _wrap_errors(sql), dbapi_conn.cursor() as cur:
+        if keys is None:
+            cur.execute(sql)
+        else:
+            cur.execute(f"{sql} RETURNING {', '.join(TABLE_KEYS[table])}")
+            keys.update(cur.fetchall())
+        new = cur.rowcount
+
+    return new, count - new
+
+
+def row_from_object(obj) -> tuple:
+    """Converts a PowerData, TEROSData or Data object into a COPY row"""
+
+    table = MODEL_TABLES[type(obj)]
+    return tuple(getattr(obj, name) for name, _ in TABLE_COLUMNS[table])
+
+
+def key_from_object(obj) -> tuple:
+    """Gets the TABLE_KEYS tuple of a PowerData, TEROSData or Data object
+
+    Timestamps are naive UTC like the ones written by COPY.
+    """
+
+    table = MODEL_TABLES[type(obj)]
+    return tuple(
+        _naive_utc(value) if isinstance(value, datetime) else value
+        for value in (getattr(obj, name) for name in TABLE_KEYS[table])
+    )
+
+
+class IngestCounts:
+    """Number of new and duplicate time-series rows committed"""
+
+    def __init__(self):
+        self.new = 0
+        self.duplicate = 0
+        # rows written in the current transaction
+        self._uncommitted = [0, 0]
+
+
+_COUNTS_KEY = "ingest_counts"
+
+
+def _add_counts(session, new: int, duplicate: int):
+    counts = session.info.get(_COUNTS_KEY)
+    if counts is not None:
+        counts._uncommitted[0] += new
+        counts._uncommitted[1] += duplicate
+
+
+@contextmanager
+def ingest_counts(session):
+    """Counts the time-series rows written by a session
+
+    Example::
+
+        with ingest_counts(db.session) as counts:
+            ...
+        print(counts.new, counts.duplicate)
+    """
+
+    counts = IngestCounts()
+    if isinstance(session, scoped_session) and not has_app_context():
+        # the scoped session needs an app context, without one no rows are
+        # written through it and nothing is counted
+        yield counts
+        return
+
+    session.info[_COUNTS_KEY] = counts
+    try:
+        yield counts
+    finally:
+        session.info.pop(_COUNTS_KEY, None)
+
+
+def _take_pending(session) -> dict:
+    """Removes pending time-series objects from a session
+
+    Returns:
+        Dictionary of table name to list of rows.
+    """
+
+    pending = {table: [] for table in TABLE_COLUMNS}
+    for obj in list(session.new):
+        table = MODEL_TABLES.get(type(obj))
+        if table is None:
+            continue
+        pending[table].append(row_from_object(obj))
+        session.expunge(obj)
+    return pending
+
+
+def copy_pending(
+    session, binary: bool = True, dedup: bool = False, inserted=None
+) -> int:
+    """Writes pending time-series objects of a session with COPY
+
+    Pending PowerData, TEROSData and Data objects are removed from the session
+    and written with copy_rows in the session's transaction. Other pending
+    objects are left for the regular flush.
+
+    Args:
+        session: SQLAlchemy session
+        binary: Use the binary COPY format
+        dedup: Skip duplicate rows with copy_rows_dedup
+        inserted: Dictionary of table name to set, the keys of the rows
+            inserted when deduplicating are added to it, see copy_rows_dedup
+
+    Returns:
+        Number of new rows written.
+    """
+
+    count = 0
+    for table, rows in _take_pending(session).items():
+        if not rows:
+            continue
+        if dedup:
+            keys = None if inserted is None else inserted.setdefault(table, set())
+            new, duplicate = copy_rows_dedup(
+                session, table, rows, binary=binary, keys=keys
+            )
+        else:
+            new, duplicate = copy_rows(session, table, rows, binary=binary), 0
+        _add_counts(session, new, duplicate)
+        count += new
+    return count
+
+
+def insert_pending(session) -> int:
+    """Inserts pending time-series objects skipping duplicates
+
+    Like copy_pending but with a multi-row INSERT ... ON CONFLICT DO NOTHING,
+    which is cheaper than COPY for the few rows of a single measurement. The
+    objects are removed from the session and are not assigned an id.
+
+    Args:
+        session: SQLAlchemy session
+
+    Returns:
+        Number of new rows written.
+    """
+
+    count = 0
+    for table, rows in _take_pending(session).items():
+        if not rows:
+            continue
+        names = [name for name, _ in TABLE_COLUMNS[table]]
+        idx = names.index(SERIES_COLUMNS[table])
+        track_series(session, table, {row[idx] for row in rows})
+        stmt = (
+            insert(db.metadata.tables[table])
+            .values([dict(zip(names, row)) for row in rows])
+            .on_conflict_do_nothing()
+        )
+        new = session.connection().execute(stmt).rowcount
+        _add_counts(session, new, len(rows) - new)
+        count += new
+    return count
+
+
+def dedup_enabled() -> bool:
+    """Checks if the app is configured to skip duplicate rows (INGEST_DEDUP)"""
+
+    return has_app_context() and bool(current_app.config.get("INGEST_DEDUP"))
+
+
+@event.listens_for(Session, "before_flush")
+def _before_flush(session, flush_context, instances):
+    """Counts pending time-series rows and records them for the query cache
+
+    The rows are flushed as usual, deduplicated writes go through
+    insert_pending and copy_pending instead.
+    """
+
+    new = 0
+    for obj in session.new:
+        table = MODEL_TABLES.get(type(obj))
+        if table is not None:
+            new += 1
+            track_series(session, table, (getattr(obj, SERIES_COLUMNS[table]),))
+    if new:
+        _add_counts(session, new, 0)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    counts = session.info.get(_COUNTS_KEY)
+    if counts is not None:
+        counts.new += counts._uncommitted[0]
+        counts.duplicate += counts._uncommitted[1]
+        counts._uncommitted = [0, 0]
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    # rolled back rows were never written
+    counts = session.info.get(_COUNTS_KEY)
+    if counts is not None:
+        counts._uncommitted = [0, 0]
@@ -0,0 +1,257 @@
+"""Columnar binary responses of the time-series endpoints
+
+The time-series GETs return a dictionary of equal length lists, which is
+verbose as json. Clients sending ``Accept: application/vnd.dirtviz.columnar``
+receive the same columns as little-endian typed arrays instead:
+
+- uint32: length N of the header
+- N bytes: utf-8 json header, padded with spaces so the columns are 8 byte
+  aligned::
+
+    {
+        "length": 3,
+        "columns": [
+            {"name": "timestamp", "type": "int64"},
+            {"name": "v", "type": "float64"},
+        ],
+        "meta": {"unit": "C"},
+    }
+
+- one buffer of length * 8 bytes per column in the order of the header
+
+Timestamps are milliseconds since the unix epoch and other columns are float64
+with NaN for missing values. Entries of the dictionary that are not lists are
+returned in the meta object of the header. Text sensor data has no fixed width
+encoding, its columnar requests are answered with 406 Not Acceptable. In
+JavaScript the columns can be read without copying::
+
+    const view = new DataView(buf);
+    const headerLength = view.getUint32(0, true);
+    const header = JSON.parse(
+        new TextDecoder().decode(new Uint8Array(buf, 4, headerLength))
+    );
+    let offset = 4 + headerLength;
+    for (const col of header.columns) {
+        const Arr = col.type === "int64" ? BigInt64Array : Float64Array;
+        data[col.name] = new Arr(buf, offset, header.length);
+        offset += header.length * 8;
+    }
+
+Clients sending ``Accept: application/vnd.apache.arrow.stream`` receive the
+columns as a single record batch of an Arrow IPC stream instead, timestamps as
+timestamp[ms, UTC], text sensor data as strings and other columns as float64
+with nulls for missing values. The meta object is stored as json under the
+``meta`` key of the schema metadata.
+
+Responses of multiple series, such as the ``cellIds`` reads and the sensors of
+a cell, concatenate the columns of all series in the order of the json keys.
+Their meta object holds a ``series`` list with the key, length and meta object
+of each series::
+
+    {"series": [{"key": "1", "length": 2, "meta": {}}, ...]}
+
+All series need the same columns of the same types, otherwise the request is
+answered with 406 Not Acceptable.
+
+Both formats share the query of the json response: rows are fetched as Python
+objects by the driver and collected into the column lists that are also
+cached, see query_cache.py. The buffers are not filled from the cursor
+directly. The lists are converted into typed buffers by pyarrow, without a
+Python call per value, and the buffers are copied once into the response body.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import struct
+import sys
+from array import array
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from flask import Response, jsonify, request
+from werkzeug.exceptions import NotAcceptable
+
+COLUMNAR_MIMETYPE = "application/vnd.dirtviz.columnar"
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+_TIMESTAMP = pa.timestamp("ms", tz="UTC")
+
+
+def _float64(values: list) -> pa.Array:
+    """Converts a column of numbers to float64, missing values are nulls"""
+
+    try:
+        return pa.array(values, type=pa.float64())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # numeric columns are returned as Decimal
+        return pa.array(
+            [None if value is None else float(value) for value in values],
+            type=pa.float64(),
+        )
+
+
+def _arrays(data: dict):
+    """Splits a dictionary of columns into Arrow arrays and metadata
+
+    The data column of a text sensor, with a type of text, is a string array.
+
+    Returns:
+        Tuple of the list of (name, array) tuples and the metadata dictionary.
+        Naive timestamps are in UTC.
+    """
+
+    arrays = []
+    meta = {}
+    for name, values in data.items():
+        if not isinstance(values, list):
+            meta[name] = values
+        elif name == "timestamp":
+            arrays.append((name, pa.array(values, type=_TIMESTAMP)))
+        elif name == "data" and data.get("type") == "text":
+            arrays.append((name, pa.array(values, type=pa.string())))
+        else:
+            arrays.append((name, _float64(values)))
+    return arrays, meta
+
+
+def _series_arrays(series: dict):
+    """Concatenates the Arrow arrays of multiple series
+
+    Raises:
+        NotAcceptable: When the series have different columns.
+
+    Returns:
+        Tuple of the list of (name, array) tuples and the metadata dictionary
+        with the series list, see the module documentation.
+    """
+
+    columns = None
+    parts = []
+    meta = []
+    for key, data in series.items():
+        arrays, series_meta = _arrays(data)
+        schema = [(name, arr.type) for name, arr in arrays]
+        if columns is None:
+            columns = schema
+        elif schema != columns:
+            raise NotAcceptable("Series have different columns, request json")
+        parts.append([arr for _, arr in arrays])
+        meta.append(
+            {"key": str(key), "length": len(data["timestamp"]), "meta": series_meta}
+        )
+
+    arrays = [
+        (name, pa.concat_arrays([part[i] for part in parts]))
+        for i, (name, _) in enumerate(columns or [])
+    ]
+    return arrays, {"series": meta}
+
+
+def encode_columnar(data: dict, series=False) -> bytes:
+    """Encodes a dictionary of columns in the columnar format
+
+    Args:
+        data: Dictionary with a timestamp list, lists of numbers and metadata
+        series: Whether data is a dictionary of key to such dictionaries
+
+    Raises:
+        NotAcceptable: When a column is text or the series have different
+            columns.
+
+    Returns:
+        Encoded bytes, see the module documentation for the format.
+    """
+
+    arrays, meta = _series_arrays(data) if series else _arrays(data)
+    length = len(arrays[0][1]) if arrays else 0
+
+    columns = []
+    buffers = []
+    for name, arr in arrays:
+        if pa.types.is_string(arr.type):
+            raise NotAcceptable("Text data has no columnar encoding, request json")
+        if name == "timestamp":
+            columns.append({"name": name, "type": "int64"})
+            arr = arr.cast(pa.int64())
+            typecode = "q"
+        else:
+            columns.append({"name": name, "type": "float64"})
+            arr = pc.fill_null(arr, math.nan)
+            typecode = "d"
+
+        # the data buffer of the array, without the validity bitmap
+        buf = memoryview(arr.buffers()[1])[: length * 8]
+        if sys.byteorder == "big":
+            buf = array(typecode, buf)
+            buf.byteswap()
+        buffers.append(buf)
+
+    header = json.dumps({"length": length, "columns": columns, "meta": meta})
+    header = header.encode()
+    # align the columns to 8 bytes
+    header += b" " * (-(4 + len(header)) % 8)
+
+    return b"".join([struct.pack("<I", len(header)), header, *buffers])
+
+
+def encode_arrow(data: dict, series=False) -> bytes:
+    """Encodes a dictionary of columns as an Arrow IPC stream
+
+    Args:
+        data: Dictionary with a timestamp list, lists of values and metadata
+        series: Whether data is a dictionary of key to such dictionaries
+
+    Raises:
+        NotAcceptable: When the series have different columns.
+
+    Returns:
+        Arrow IPC stream of a single record batch, see the module
+        documentation.
+    """
+
+    arrays, meta = _series_arrays(data) if series else _arrays(data)
+    batch = pa.RecordBatch.from_arrays(
+        [arr for _, arr in arrays], names=[name for name, _ in arrays]
+    )
+    batch = batch.replace_schema_metadata({"meta": json.dumps(meta, default=str)})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def response_mimetype() -> str:
+    """Format of a time-series response negotiated with the Accept header
+
+    Returns:
+        application/json unless the request prefers the columnar or Arrow
+        format.
+    """
+
+    return request.accept_mimetypes.best_match(
+        ["application/json", COLUMNAR_MIMETYPE, ARROW_MIMETYPE],
+        default="application/json",
+    )
+
+
+def timeseries_response(data: dict, series=False) -> Response:
+    """Time-series response in the format negotiated with the Accept header
+
+    Args:
+        data: Dictionary of columns and metadata
+        series: Whether data is a dictionary of key to such dictionaries
+    """
+
+    mimetype = response_mimetype()
+    if mimetype == COLUMNAR_MIMETYPE:
+        resp = Response(encode_columnar(data, series), mimetype=mimetype)
+    elif mimetype == ARROW_MIMETYPE:
+        resp = Response(encode_arrow(data, series), mimetype=mimetype)
+    else:
+        resp = jsonify(data)
+    resp.vary.add("Accept")
+    return resp
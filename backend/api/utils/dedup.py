@@ -0,0 +1,228 @@
+"""Removes duplicate time-series rows and creates the unique indexes
+
+Rows of power_data, teros_data and data are duplicates when they share the
+natural key of their table, see bulk_write.TABLE_KEYS. Once the duplicates are
+removed, unique indexes on the keys are created with CREATE INDEX CONCURRENTLY
+so uploads are not blocked. Partitioned tables get an index per partition,
+built concurrently and attached to the index of the table. With the indexes in
+place, setting INGEST_DEDUP makes ingest skip duplicates with INSERT ... ON
+CONFLICT DO NOTHING.
+
+Duplicates are removed in batches of ids, each in its own transaction, keeping
+the row with the lowest id. Rows inserted while the job runs are handled by
+repeating the removal until the index is built.
+
+Examples
+--------
+Remove duplicates and create the indexes for all tables::
+
+    $ python -m api.utils.dedup
+
+Only count the duplicates of the data table::
+
+    $ python -m api.utils.dedup --dry-run data
+
+Help prompt for utility::
+
+    $ python -m api.utils.dedup -h
+"""
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from ..conn import engine
+from .bulk_write import TABLE_KEYS
+from .partition import partitioned_table, partitions
+
+
+def index_name(table: str) -> str:
+    """Name of the unique index on the natural key of a table"""
+
+    return f"uq_{table}_{'_'.join(TABLE_KEYS[table])}"
+
+
+def _duplicate_filter(table: str) -> str:
+    key = TABLE_KEYS[table]
+    match = " AND ".join(f"b.{col} = a.{col}" for col in key)
+    return f"EXISTS (SELECT 1 FROM {table} b WHERE {match} AND b.id < a.id)"
+
+
+def count_duplicates(conn, table: str) -> int:
+    """Counts rows that have a duplicate with a lower id"""
+
+    stmt = text(f"SELECT count(*) FROM {table} a WHERE {_duplicate_filter(table)}")
+    return conn.execute(stmt).scalar()
+
+
+def remove_duplicates(eng, table: str, batch_size: int = 50000) -> int:
+    """Deletes duplicate rows in batches of ids
+
+    Each batch is committed on its own so locks are held briefly.
+
+    Args:
+        eng: SQLAlchemy engine
+        table: One of power_data, teros_data or data
+        batch_size: Number of ids per batch
+
+    Returns:
+        Number of deleted rows.
+    """
+
+    with eng.connect() as conn:
+        max_id = conn.execute(text(f"SELECT max(id) FROM {table}")).scalar() or 0
+
+    stmt = text(
+        f"DELETE FROM {table} a WHERE a.id >= :lo AND a.id < :hi "
+        f"AND {_duplicate_filter(table)}"
+    )
+
+    deleted = 0
+    for lo in range(0, max_id + 1, batch_size):
+        with eng.begin() as conn:
+            deleted += conn.execute(stmt, {"lo": lo, "hi": lo + batch_size}).rowcount
+
+    return deleted
+
+
+def _index_state(conn, name: str):
+    """Returns None if the index does not exist, else whether it is valid"""
+
+    stmt = text(
+        "SELECT i.indisvalid FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+    )
+    return conn.execute(stmt, {"name": name}).scalar()
+
+
+def _create_index(conn, table: str):
+    """Creates the unique index concurrently, per partition if partitioned
+
+    Raises:
+        IntegrityError: When duplicates are left, the invalid index of a
+            partition is rebuilt by the next call.
+    """
+
+    name = index_name(table)
+    cols = ", ".join(TABLE_KEYS[table])
+
+    if partitioned_table(conn, table) != table:
+        conn.execute(
+            text(f"CREATE UNIQUE INDEX CONCURRENTLY {name} ON {table} ({cols})")
+        )
+        return
+
+    # indexes of partitioned tables cannot be built concurrently, the index of
+    # the table is valid once an index of every partition is attached to it
+    conn.execute(
+        text(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON ONLY {table} ({cols})")
+    )
+    attached = set(
+        conn.execute(
+            text(
+                "SELECT CAST(i.indrelid AS regclass)::text FROM pg_inherits h "
+                "JOIN pg_index i ON i.indexrelid = h.inhrelid "
+                "WHERE h.inhparent = CAST(:name AS regclass)"
+            ),
+            {"name": name},
+        ).scalars()
+    )
+    for partition in partitions(conn, table):
+        if partition in attached:
+            continue
+        partition_index = f"uq_{partition}_{'_'.join(TABLE_KEYS[table])}"
+        if _index_state(conn, partition_index) is False:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY {partition_index}"))
+        conn.execute(
+            text(
+                f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} "
+                f"ON {partition} ({cols})"
+            )
+        )
+        conn.execute(text(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}"))
+
+
+def create_unique_index(eng, table: str, batch_size: int = 50000, attempts: int = 5):
+    """Removes duplicates and creates the unique index concurrently
+
+    Building the index fails when a duplicate is inserted while it is built,
+    the invalid index is then dropped and duplicates are removed again.
+
+    Args:
+        eng: SQLAlchemy engine
+        table: One of power_data, teros_data or data
+        batch_size: Number of ids per deletion batch
+        attempts: Number of times the index build is tried
+
+    Returns:
+        Number of deleted rows.
+    """
+
+    name = index_name(table)
+
+    deleted = remove_duplicates(eng, table, batch_size=batch_size)
+
+    for _ in range(attempts):
+        # concurrent index builds cannot run in a transaction
+        with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            state = _index_state(conn, name)
+            if state:
+                return deleted
+            if state is not None and partitioned_table(conn, table) != table:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+
+            try:
+                _create_index(conn, table)
+                return deleted
+            except IntegrityError:
+                pass
+
+        # duplicates were inserted since the last pass, a duplicate of an old
+        # row may have any id so the whole table is checked again
+        deleted += remove_duplicates(eng, table, batch_size=batch_size)
+
+    raise RuntimeError(f"Unable to create {name} after {attempts} attempts")
+
+
+def dedup(tables=tuple(TABLE_KEYS), batch_size=50000, dry_run=False, eng=engine):
+    """Removes duplicates and creates the unique indexes of tables
+
+    Args:
+        tables: Tables to deduplicate
+        batch_size: Number of ids per deletion batch
+        dry_run: Only print the number of duplicates
+        eng: SQLAlchemy engine
+    """
+
+    for table in tables:
+        if dry_run:
+            with eng.connect() as conn:
+                print(f"{table}: {count_duplicates(conn, table)} duplicates")
+            continue
+
+        deleted = create_unique_index(eng, table, batch_size=batch_size)
+        print(f"{table}: deleted {deleted} duplicates, created {index_name(table)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time-series deduplication utility")
+    parser.add_argument(
+        "--batch-size", type=int, default=50000, help="Number of ids per batch"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only count the duplicates"
+    )
+    parser.add_argument(
+        "tables",
+        nargs="*",
+        default=list(TABLE_KEYS),
+        help=f"Tables to deduplicate, any of {', '.join(TABLE_KEYS)} (default: all)",
+    )
+
+    args = parser.parse_args()
+    for table in args.tables:
+        if table not in TABLE_KEYS:
+            parser.error(f"invalid table: {table}")
+
+    dedup(args.tables, batch_size=args.batch_size, dry_run=args.dry_run)
@@ -0,0 +1,207 @@
+"""Shape preserving downsampling of time-series queries
+
+Averaging with ``resample`` smooths out spikes, while ``resample=none`` returns
+every row of the range. Downsampling instead returns a subset of the raw rows
+bounded by a target number of points, typically the width of the chart in
+pixels.
+
+M4:
+The range is split into equal width time buckets and the first, last, minimum
+and maximum row of every value column are kept in each bucket. The selection is
+done in SQL with window functions, so only the selected rows leave the
+database. A line chart drawn from the subset is identical to one drawn from all
+rows at the bucket resolution.
+
+LTTB:
+Largest-Triangle-Three-Buckets keeps one row per bucket, the one forming the
+largest triangle with the row kept in the previous bucket and the average of
+the next bucket. The rows are streamed from the database and the selection is
+done in Python on a single value column. It gives a visually smoother result
+than M4 for the same number of points.
+
+Examples
+--------
+Select the rows of a raw query::
+
+    from api.utils.downsample import downsample_rows
+
+    rows = downsample_rows(
+        db.session, stmt, "m4", ["voltage", "current"], start, end, 1000
+    )
+"""
+
+from itertools import groupby
+from operator import attrgetter
+
+from sqlalchemy import cast, extract, func, or_, select
+
+DOWNSAMPLE_METHODS = ("m4", "lttb")
+
+
+def m4(raw, columns: list, start_time, end_time, points: int, partition=None):
+    """Selects the first, last, minimum and maximum rows of time buckets
+
+    Up to 2 + 2 * len(columns) rows are kept per bucket, the number of buckets
+    is chosen so that at most points rows are returned.
+
+    Args:
+        raw: Subquery with a ts column and the value columns
+        columns: Names of the value columns
+        start_time: Start of the range, first bucket
+        end_time: End of the range, last bucket
+        points: Maximum number of returned rows per series
+        partition: Name of a column identifying the series, the rows of each
+            series are downsampled separately
+
+    Returns:
+        Select statement of the partition, ts and value columns ordered by
+        partition and ts.
+    """
+
+    buckets = max(1, points // (2 + 2 * len(columns)))
+
+    # bounds are compared like the range filter of the raw query
+    lo = extract("epoch", cast(start_time, raw.c.ts.type))
+    # width_bucket requires distinct bounds
+    hi = func.greatest(extract("epoch", cast(end_time, raw.c.ts.type)), lo + 1)
+    # rows at end_time fall in the last bucket rather than an extra one
+    bucket = func.least(
+        func.width_bucket(extract("epoch", raw.c.ts), lo, hi, buckets), buckets
+    )
+
+    orderings = [raw.c.ts.asc(), raw.c.ts.desc()]
+    for col in columns:
+        orderings.append(raw.c[col].asc().nulls_last())
+        orderings.append(raw.c[col].desc().nulls_last())
+
+    keys = [] if partition is None else [partition]
+    ranks = [
+        func.row_number()
+        .over(
+            partition_by=[*(raw.c[key] for key in keys), bucket],
+            order_by=(ordering, raw.c.ts),
+        )
+        .label(f"rank_{i}")
+        for i, ordering in enumerate(orderings)
+    ]
+    ranked = select(
+        *(raw.c[key] for key in keys),
+        raw.c.ts,
+        *(raw.c[col] for col in columns),
+        *ranks,
+    ).subquery()
+
+    return (
+        select(
+            *(ranked.c[key] for key in keys),
+            ranked.c.ts,
+            *(ranked.c[col] for col in columns),
+        )
+        .where(or_(*(ranked.c[rank.name] == 1 for rank in ranks)))
+        .order_by(*(ranked.c[key] for key in keys), ranked.c.ts)
+    )
+
+
+def lttb(rows: list, points: int, column: str) -> list:
+    """Largest-Triangle-Three-Buckets selection of rows
+
+    Rows without a value are skipped. The first and last rows are always kept.
+
+    Args:
+        rows: Rows with a ts and the value column, ordered by ts
+        points: Number of returned rows
+        column: Name of the value column the selection is based on
+
+    Returns:
+        List of the selected rows ordered by ts.
+    """
+
+    xs = []
+    ys = []
+    kept = []
+    for row in rows:
+        y = getattr(row, column)
+        if y is None:
+            continue
+        xs.append(row.ts.timestamp())
+        ys.append(float(y))
+        kept.append(row)
+
+    n = len(kept)
+    if points >= n or points < 3:
+        return kept
+
+    selected = [kept[0]]
+    # the first and last rows are kept, the others are split into buckets
+    every = (n - 2) / (points - 2)
+    a = 0
+    for i in range(points - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+
+        # average of the next bucket, the last row for the last bucket
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, n)
+        if next_start >= next_end:
+            next_start, next_end = n - 1, n
+        count = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / count
+        avg_y = sum(ys[next_start:next_end]) / count
+
+        ax = xs[a]
+        ay = ys[a]
+        max_area = -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                a_next = j
+
+        selected.append(kept[a_next])
+        a = a_next
+
+    selected.append(kept[-1])
+    return selected
+
+
+def downsample_rows(
+    session,
+    stmt,
+    method: str,
+    columns: list,
+    start_time,
+    end_time,
+    points: int,
+    partition=None,
+):
+    """Executes a raw time-series query keeping a downsampled subset
+
+    Args:
+        session: Database session
+        stmt: Select of a ts column and the value columns over the range
+        method: One of DOWNSAMPLE_METHODS
+        columns: Names of the value columns. LTTB selects on the first one.
+        start_time: Start of the range
+        end_time: End of the range
+        points: Target number of rows per series
+        partition: Name of a column of stmt identifying the series, stmt must
+            then be ordered by it and ts
+
+    Returns:
+        Iterable of rows ordered by partition and ts.
+    """
+
+    if method == "m4":
+        return session.execute(
+            m4(stmt.subquery(), columns, start_time, end_time, points, partition)
+        )
+    if method == "lttb":
+        rows = session.execute(stmt).yield_per(1000)
+        if partition is None:
+            return lttb(rows, points, columns[0])
+        return [
+            row
+            for _, series in groupby(rows, key=attrgetter(partition))
+            for row in lttb(series, points, columns[0])
+        ]
+    raise ValueError(f"Unknown downsampling method: {method}")
@@ -0,0 +1,150 @@
+"""Bounded cache of row existence by primary key
+
+Used on the ingest path to reject measurements for unknown cells and loggers
+without querying the database for every measurement. Both positive and
+negative results are cached with separate time to live values so that a row
+created by another worker is accepted shortly after, while the least recently
+used entries are evicted once the cache is full.
+
+Entries must be invalidated when rows are deleted. When
+``EXISTENCE_CACHE_URL`` is set, invalidations are published on a Redis stream
+read by the caches of every worker and ingest process at most every
+``EXISTENCE_CACHE_POLL`` seconds, so a row deleted elsewhere is dropped
+shortly after instead of when its entry expires. Otherwise, or while Redis is
+unreachable, a stale positive entry from another worker is caught by the
+foreign key constraint on insert.
+"""
+
+import os
+import time
+from collections import OrderedDict
+
+import redis
+
+from .. import db
+
+EXISTENCE_CACHE_SIZE = int(os.getenv("EXISTENCE_CACHE_SIZE", "4096"))
+EXISTENCE_CACHE_TTL = float(os.getenv("EXISTENCE_CACHE_TTL", "300"))
+EXISTENCE_CACHE_NEGATIVE_TTL = float(os.getenv("EXISTENCE_CACHE_NEGATIVE_TTL", "30"))
+EXISTENCE_CACHE_POLL = float(os.getenv("EXISTENCE_CACHE_POLL", "1"))
+
+
+class ExistenceCache:
+    """TTL/LRU cache of whether a row of a model exists
+
+    Args:
+        model: Model class queried by primary key on a miss
+        maxsize: Maximum number of cached ids
+        ttl: Seconds a positive result is cached
+        negative_ttl: Seconds a negative result is cached
+        client: Redis client invalidations are shared on, None to only
+            invalidate the cache of this process
+        stream: Name of the stream of invalidations
+        poll: Seconds between reads of the invalidations of other processes
+    """
+
+    def __init__(
+        self,
+        model,
+        maxsize=EXISTENCE_CACHE_SIZE,
+        ttl=EXISTENCE_CACHE_TTL,
+        negative_ttl=EXISTENCE_CACHE_NEGATIVE_TTL,
+        client=None,
+        stream="existence",
+        poll=EXISTENCE_CACHE_POLL,
+    ):
+        self.model = model
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stream = stream
+        self.poll = poll
+        self._entries = OrderedDict()
+        self.connect(client)
+
+    def init_app(self, app):
+        """Configures the shared invalidations from the app config"""
+
+        url = app.config.get("EXISTENCE_CACHE_URL")
+        self.stream = app.config.get("EXISTENCE_CACHE_STREAM", self.stream)
+        self.connect(redis.from_url(url) if url else None)
+
+    def connect(self, client):
+        """Shares invalidations on a Redis client, None to stop sharing
+
+        Only invalidations published after connecting are read, entries
+        cached before are dropped.
+        """
+
+        self.redis = client
+        self._entries.clear()
+        self._last_id = "0-0"
+        self._next_poll = 0
+        if client is None:
+            return
+        try:
+            last = client.xrevrange(self.stream, count=1)
+        except redis.RedisError as e:
+            print(f"[existence_cache] unable to read invalidations: {e}", flush=True)
+            return
+        if last:
+            self._last_id = last[0][0]
+
+    def _read_invalidations(self, now):
+        """Drops the entries invalidated by other processes"""
+
+        self._next_poll = now + self.poll
+        try:
+            resp = self.redis.xread({self.stream: self._last_id}, count=1000)
+        except redis.RedisError as e:
+            print(f"[existence_cache] unable to read invalidations: {e}", flush=True)
+            return
+
+        table = self.model.__tablename__.encode()
+        for entry_id, fields in resp[0][1] if resp else []:
+            self._last_id = entry_id
+            if fields.get(b"table") == table and fields[b"id"].isdigit():
+                self._entries.pop(int(fields[b"id"]), None)
+
+    def exists(self, id) -> bool:
+        """Checks if a row with the primary key exists"""
+
+        now = time.monotonic()
+        if self.redis is not None and now >= self._next_poll:
+            self._read_invalidations(now)
+
+        entry = self._entries.get(id)
+        if entry is not None:
+            exists, expires = entry
+            if expires > now:
+                self._entries.move_to_end(id)
+                return exists
+            del self._entries[id]
+
+        exists = db.session.get(self.model, id) is not None
+        self._entries[id] = (exists, now + (self.ttl if exists else self.negative_ttl))
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        return exists
+
+    def invalidate(self, id):
+        """Drops the cached result for a primary key in every process"""
+
+        self._entries.pop(id, None)
+        if self.redis is None or id is None:
+            return
+        try:
+            self.redis.xadd(
+                self.stream,
+                {"table": self.model.__tablename__, "id": id},
+                maxlen=10000,
+                approximate=True,
+            )
+        except redis.RedisError as e:
+            print(f"[existence_cache] unable to publish invalidation: {e}", flush=True)
+
+    def clear(self):
+        """Drops all cached results"""
+
+        self._entries.clear()
@@ -0,0 +1,448 @@
+"""Time-aligned exports of multiple series
+
+The dashboard CSV export used to align the series of the loaded charts in the
+browser, so series whose device clocks differ by a few seconds never shared a
+row and every value was paired with NAN. Exports instead align the series in
+SQL: every series is resampled onto a common grid of buckets (see
+utils/resample.py) and the grid is joined with the buckets of each series.
+Buckets without a value can be filled from the previous (``ffill``) or closest
+(``nearest``) bucket with a value, within ``tolerance``.
+
+Rows are read from a server-side cursor and written as they are read, as CSV in
+the format of the frontend export (a name, unit and type header row, epoch
+seconds and NAN for missing values) or as Parquet with one row group per chunk,
+so neither the server nor the browser holds all series at once.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Response, stream_with_context
+from sqlalchemy import (
+    DateTime,
+    Interval,
+    and_,
+    case,
+    cast,
+    func,
+    literal,
+    literal_column,
+    select,
+)
+
+from ..models import db
+from ..models.rollup import ROLLUP_SOURCES, rollup_select
+from .resample import bucket, parse_interval
+
+CSV_MIMETYPE = "text/csv"
+PARQUET_MIMETYPE = "application/vnd.apache.parquet"
+
+# missing values of csv exports, like the frontend export
+CSV_MISSING = "NAN"
+
+FILL_METHODS = ("none", "ffill", "nearest")
+
+# rows per chunk of the response
+CHUNK_ROWS = 10000
+
+# steps of the grid of the fixed units, Postgres has no quarter interval
+_UNIT_STEPS = {"quarter": "3 months"}
+
+
+class Column(NamedTuple):
+    """Exported column of a series
+
+    Attributes:
+        source: Name of the rollup source of the series
+        series_id: Id of the cell or sensor
+        measurement: Measurement of the source
+        scale: Factor converting the measurement to unit
+        name: Name in the header
+        unit: Unit in the header
+        type: Type in the header
+    """
+
+    source: str
+    series_id: int
+    measurement: str
+    scale: float
+    name: str
+    unit: str
+    type: str
+
+
+# columns of the builtin panels of a cell as (source, measurement, scale, name,
+# unit, type), sensor panels are s:{sensor_id}
+PANELS = {
+    "power-vi": [
+        ("power", "voltage", 1e3, "Voltage", "mV", "POWER_VOLTAGE"),
+        ("power", "current", 1e6, "Current", "uA", "POWER_CURRENT"),
+    ],
+    "power-p": [("power", "power", 1e6, "Power", "uW", "POWER")],
+    "teros": [
+        ("teros", "vwc", 1, "Volumetric Water Content", "%", "TEROS12_VWC"),
+        ("teros", "ec", 1, "Electrical Conductivity", "uS/cm", "TEROS12_EC"),
+    ],
+    "temp": [("teros", "temp", 1, "Temperature", "C", "TEROS12_TEMP")],
+}
+
+
+def export_columns(cells: list, panels: list, sensors: dict) -> list:
+    """Columns of the panels of cells
+
+    Names are prefixed with the cell name when the columns span multiple cells,
+    like the frontend export.
+
+    Args:
+        cells: Cells with id and name, the builtin panels are exported for each
+        panels: Builtin panel ids and s:{sensor_id} sensor panels
+        sensors: Dictionary of sensor id to the sensors of the sensor panels
+
+    Returns:
+        List of Column in the order of the panels.
+    """
+
+    cell_names = {cell.id: cell.name for cell in cells}
+    for sensor in sensors.values():
+        cell_names.setdefault(sensor.cell_id, sensor.cell.name)
+    multi_cell = len(cell_names) > 1
+
+    def name(cell_id, base):
+        return f"{cell_names[cell_id]} {base}" if multi_cell else base
+
+    columns = []
+    for panel in panels:
+        if panel.startswith("s:"):
+            sensor = sensors[int(panel[2:])]
+            columns.append(
+                Column(
+                    "data",
+                    sensor.id,
+                    "value",
+                    1,
+                    name(sensor.cell_id, sensor.measurement or sensor.name),
+                    sensor.unit or "",
+                    sensor.name.upper(),
+                )
+            )
+            continue
+        for cell in cells:
+            for source, measurement, scale, base, unit, type_ in PANELS[panel]:
+                columns.append(
+                    Column(
+                        source,
+                        cell.id,
+                        measurement,
+                        scale,
+                        name(cell.id, base),
+                        unit,
+                        type_,
+                    )
+                )
+    return columns
+
+
+def _buckets(name: str, series_ids: list, resample, start_time, end_time, origin):
+    """Bucket averages of the series of a source, from the rollups if possible"""
+
+    stmt = rollup_select(name, series_ids, resample, start_time, end_time, origin)
+    if stmt is None:
+        source = ROLLUP_SOURCES[name]
+        ts = source.table.c.ts
+        ts_bucket = bucket(resample, ts, origin)
+        stmt = (
+            select(
+                source.series.label("series_id"),
+                ts_bucket.label("ts"),
+                *(
+                    func.avg(expr).label(measurement)
+                    for measurement, expr in source.measurements.items()
+                ),
+            )
+            .where(source.series.in_(series_ids) & ts.between(start_time, end_time))
+            .group_by(source.series, ts_bucket)
+        )
+    return stmt.cte(f"{name}_buckets")
+
+
+def _fill(aligned, names: list, method: str, tolerance):
+    """Select of aligned with the missing values of names filled"""
+
+    ts = aligned.c.ts
+    groups = []
+    for col in names:
+        value = aligned.c[col]
+        # rows up to the next value share a group led by the value
+        groups.append(func.count(value).over(order_by=ts).label(f"{col}_prev"))
+        if method == "nearest":
+            groups.append(
+                func.count(value).over(order_by=ts.desc()).label(f"{col}_next")
+            )
+    grouped = select(aligned, *groups).subquery("grouped")
+
+    ts = grouped.c.ts
+    leads = []
+    for col in names:
+        value = grouped.c[col]
+        value_ts = case((value.isnot(None), ts))
+        directions = [("prev", ts)]
+        if method == "nearest":
+            directions.append(("next", ts.desc()))
+        for direction, order in directions:
+            window = {
+                "partition_by": grouped.c[f"{col}_{direction}"],
+                "order_by": order,
+            }
+            leads.append(
+                func.first_value(value).over(**window).label(f"{col}_{direction}")
+            )
+            leads.append(
+                func.first_value(value_ts).over(**window).label(f"{col}_{direction}_ts")
+            )
+    led = select(ts, *leads).subquery("led")
+
+    ts = led.c.ts
+    tol = None if tolerance is None else literal(tolerance, Interval())
+
+    def within(distance, lead_ts):
+        found = lead_ts.isnot(None)
+        return found if tol is None else and_(found, distance <= tol)
+
+    filled = []
+    for col in names:
+        prev_ts = led.c[f"{col}_prev_ts"]
+        prev_ok = within(ts - prev_ts, prev_ts)
+        if method == "ffill":
+            value = case((prev_ok, led.c[f"{col}_prev"]))
+        else:
+            next_ts = led.c[f"{col}_next_ts"]
+            next_ok = within(next_ts - ts, next_ts)
+            value = case(
+                (
+                    prev_ok & (~next_ok | (ts - prev_ts <= next_ts - ts)),
+                    led.c[f"{col}_prev"],
+                ),
+                (next_ok, led.c[f"{col}_next"]),
+            )
+        filled.append(value.label(col))
+    return select(ts, *filled)
+
+
+def aligned_select(
+    columns: list,
+    resample: str,
+    start_time,
+    end_time,
+    origin=None,
+    fill="none",
+    tolerance: timedelta | None = None,
+):
+    """Select of the columns aligned on a grid of buckets
+
+    Args:
+        columns: List of Column
+        resample: Fixed unit, except none, or interval of the buckets
+        start_time: Start of the range, inclusive
+        end_time: End of the range, inclusive
+        origin: Origin of interval buckets
+        fill: Fill method of FILL_METHODS
+        tolerance: Maximum distance between a bucket and the bucket it is
+            filled from, unbounded when None
+
+    Returns:
+        Select statement of the bucket ts and one column c{index} per column,
+        ordered by ts.
+    """
+
+    width = parse_interval(resample)
+    step = (
+        literal(width, Interval())
+        if width is not None
+        else literal_column(f"interval '{_UNIT_STEPS.get(resample, '1 ' + resample)}'")
+    )
+    start = cast(start_time, DateTime())
+    grid = (
+        func.generate_series(
+            bucket(resample, start, origin), cast(end_time, DateTime()), step
+        )
+        .table_valued("ts")
+        .render_derived("grid")
+    )
+
+    ids = {}
+    for col in columns:
+        ids.setdefault(col.source, {}).setdefault(col.series_id, None)
+    buckets = {
+        name: _buckets(name, list(series), resample, start_time, end_time, origin)
+        for name, series in ids.items()
+    }
+
+    # one join per series, shared by its measurements
+    joined = grid
+    aliases = {}
+    for name, series in ids.items():
+        for series_id in series:
+            alias = buckets[name].alias(f"{name}_{series_id}")
+            joined = joined.outerjoin(
+                alias, (alias.c.ts == grid.c.ts) & (alias.c.series_id == series_id)
+            )
+            aliases[(name, series_id)] = alias
+
+    names = [f"c{index}" for index in range(len(columns))]
+    values = []
+    for name, col in zip(names, columns):
+        value = aliases[(col.source, col.series_id)].c[col.measurement]
+        if col.scale != 1:
+            value = value * col.scale
+        values.append(value.label(name))
+    stmt = select(grid.c.ts, *values).select_from(joined)
+
+    if fill != "none":
+        stmt = _fill(stmt.subquery("aligned"), names, fill, tolerance)
+    return stmt.order_by(literal_column("ts"))
+
+
+def _epoch_seconds(ts: datetime) -> int:
+    """Seconds since the epoch, naive timestamps are in UTC"""
+
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return int(ts.timestamp())
+
+
+def csv_chunks(columns: list, rows, chunk_rows: int = CHUNK_ROWS):
+    """Encodes aligned rows as csv
+
+    Args:
+        columns: List of Column of the rows
+        rows: Iterable of (ts, *values) rows
+        chunk_rows: Number of rows per yielded chunk
+
+    Yields:
+        Chunks of lines, starting with the name, unit and type header rows.
+    """
+
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(["timestamp", *(col.name for col in columns)])
+    writer.writerow(["s", *(col.unit for col in columns)])
+    writer.writerow(["TIME", *(col.type for col in columns)])
+
+    count = 0
+    for ts, *values in rows:
+        writer.writerow(
+            [
+                _epoch_seconds(ts),
+                *(CSV_MISSING if value is None else float(value) for value in values),
+            ]
+        )
+        count += 1
+        if count >= chunk_rows:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            count = 0
+    yield buf.getvalue()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only stream collecting the bytes written since the last take"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(columns: list, rows, chunk_rows: int = CHUNK_ROWS):
+    """Encodes aligned rows as parquet, one row group per chunk
+
+    Columns are named like the csv header, their unit and type are stored in
+    the field metadata.
+
+    Args:
+        columns: List of Column of the rows
+        rows: Iterable of (ts, *values) rows
+        chunk_rows: Number of rows per row group
+
+    Yields:
+        Bytes of the file as the row groups are written.
+    """
+
+    schema = pa.schema(
+        [
+            pa.field("timestamp", pa.timestamp("ms", tz="UTC")),
+            *(
+                pa.field(
+                    col.name,
+                    pa.float64(),
+                    metadata={"unit": col.unit, "type": col.type},
+                )
+                for col in columns
+            ),
+        ]
+    )
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def write(batch):
+        table = pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(batch, schema)],
+            schema=schema,
+        )
+        writer.write_table(table)
+
+    batch = [[] for _ in schema]
+    for ts, *values in rows:
+        batch[0].append(ts)
+        for column, value in zip(batch[1:], values):
+            column.append(None if value is None else float(value))
+        if len(batch[0]) >= chunk_rows:
+            write(batch)
+            batch = [[] for _ in schema]
+            yield sink.take()
+    if batch[0]:
+        write(batch)
+    writer.close()
+    yield sink.take()
+
+
+def export_response(columns: list, stmt, fmt: str = "csv") -> Response:
+    """Streamed response of an aligned select
+
+    The rows are read from a server-side cursor while the response is written,
+    the request context, and with it the database session, is kept until the
+    last row is written.
+
+    Args:
+        columns: List of Column of the select
+        stmt: Select of aligned_select
+        fmt: csv or parquet
+    """
+
+    def rows():
+        yield from db.session.execute(stmt).yield_per(CHUNK_ROWS)
+
+    if fmt == "parquet":
+        chunks, mimetype = parquet_chunks(columns, rows()), PARQUET_MIMETYPE
+    else:
+        chunks, mimetype = csv_chunks(columns, rows()), CSV_MIMETYPE
+    resp = Response(stream_with_context(chunks), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f"attachment; filename=export.{fmt}"
+    return resp
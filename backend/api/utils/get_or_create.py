@@ -12,7 +12,7 @@ from ..models.logger import Logger
 from ..models.cell import Cell
 
 
-def get_or_create_logger(sess, name, mac=None, hostname=None):
+def get_or_create_logger(sess, name):
     """Get or create Logger object
 
     Returns
@@ -22,15 +22,11 @@ def get_or_create_logger(sess, name, mac=None, hostname=None):
     """
 
     stmt = select(Logger).where(Logger.name == name)
-    if mac:
-        stmt = stmt.where(Logger.mac == mac)
-    if hostname:
-        stmt = stmt.where(Logger.hostname == hostname)
 
     log = sess.execute(stmt).one_or_none()
 
     if not log:
-        log = Logger(name=name, mac=mac, hostname=hostname)
+        log = Logger(name=name)
         sess.add(log)
         sess.flush()
     else:
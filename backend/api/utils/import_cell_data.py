@@ -13,18 +13,47 @@ Help prompt for utility::
 """
 
 import csv
+import os
 from datetime import datetime
+from itertools import islice
 
 from tqdm import tqdm
 from sqlalchemy.orm import Session
 
 from ..conn import engine
-from ..models.power_data import PowerData
-from ..models.teros_data import TEROSData
+from .bulk_write import copy_rows, copy_rows_dedup
 from .get_or_create import get_or_create_cell, get_or_create_logger
+from .query_cache import query_cache
 
 
-def import_cell_data(path, logger_name, cell_name, batch_size=10000):
+def parse_row(row):
+    """Parses a csv row into power and teros COPY rows without ids
+
+    Returns
+    -------
+    tuple
+        (ts, current, voltage) and (ts, vwc, raw_vwc, temp, ec, water_pot)
+    """
+
+    # convert string to timestamp
+    cleaned_ts = row[0][1:-4]
+    ts = datetime.strptime(cleaned_ts, "%d %b %Y %H:%M:%S").replace(tzinfo=None)
+
+    power = (ts, float(row[2]) * 1e-6, float(row[1]) * 1e-3)
+    teros = (ts, float(row[5]), None, float(row[6]), float(row[4]), None)
+
+    return power, teros
+
+
+def import_cell_data(
+    path,
+    logger_name,
+    cell_name,
+    batch_size=10000,
+    header_rows=11,
+    binary=True,
+    dedup=False,
+):
     """Imports raw RocketLogger data in PowerData table. A logger instance for
     the rokcet locker must be created first.
 
@@ -32,6 +61,8 @@ def import_cell_data(path, logger_name, cell_name, batch_size=10000):
     timestamp, Voltage (mV), Current (uA), Power(uW), EC (uS/cm),
     VWC (%), Temperature (C)
 
+    Rows are written with COPY and committed every batch_size rows.
+
     Parameters
     ----------
     path : str
@@ -40,63 +71,62 @@ def import_cell_data(path, logger_name, cell_name, batch_size=10000):
         Logger name for the Rocketlogger
     cell_name : str
         Name of cell.
+    batch_size : int
+        Number of csv rows per transaction.
+    header_rows : int
+        Number of header rows to skip.
+    binary : bool
+        Use the binary COPY format.
+    dedup : bool
+        Skip rows already in the database, requires the unique indexes
+        created by utils/dedup.py.
+
+    Returns
+    -------
+    int
+        Number of csv rows imported.
     """
 
     # pylint: disable=R0801
 
+    count = 0
+
     with open(path, newline="", encoding="UTF-8") as csvfile:
         data_reader = csv.reader(csvfile)
 
         # Skip header
-        for _ in range(11):
+        for _ in range(header_rows):
             next(data_reader)
 
-        tmp = []
-
         with Session(engine) as sess:
             # Get or create objects
             logger = get_or_create_logger(sess, logger_name)
             cell = get_or_create_cell(sess, cell_name)
 
-            for row in tqdm(data_reader):
-                # convert string to timestamp
-                cleaned_ts = row[0][1:-4]
-                # print("\n" + repr(cleaned_ts))
-                ts = datetime.strptime(cleaned_ts, "%d %b %Y %H:%M:%S").replace(
-                    tzinfo=None
-                )
+            copy = copy_rows_dedup if dedup else copy_rows
 
-                tmp.append(
-                    PowerData(
-                        logger_id=logger.id,
-                        cell_id=cell.id,
-                        ts=ts,
-                        current=float(row[2]) * 1e-6,
-                        voltage=float(row[1]) * 1e-3,
-                    )
+            rows = map(parse_row, tqdm(data_reader))
+            while batch := list(islice(rows, batch_size)):
+                copy(
+                    sess,
+                    "power_data",
+                    ((logger.id, cell.id, *p) for p, _ in batch),
+                    binary=binary,
                 )
-
-                tdata = TEROSData(
-                    cell_id=cell.id,
-                    ts=ts,
-                    vwc=float(row[5]),
-                    temp=float(row[6]),
-                    ec=float(row[4]),
+                copy(
+                    sess,
+                    "teros_data",
+                    ((cell.id, *t) for _, t in batch),
+                    binary=binary,
                 )
+                sess.commit()
+                count += len(batch)
 
-                tmp.append(tdata)
-
-                if len(tmp) > batch_size and tmp:
-                    # Save objects
-                    sess.bulk_save_objects(tmp)
-                    sess.commit()
-                    # Reset array
-                    tmp.clear()
-
-            # Save remaining objects
-            sess.bulk_save_objects(tmp)
+            # commit the logger and cell for empty files
             sess.commit()
 
+    return count
+
 
 if __name__ == "__main__":
     import argparse
@@ -105,10 +135,30 @@ if __name__ == "__main__":
     parser.add_argument(
         "--batch-size", type=int, default=10000, help="Batch size of inserts"
     )
+    parser.add_argument(
+        "--header-rows", type=int, default=11, help="Number of header rows to skip"
+    )
+    parser.add_argument(
+        "--text", action="store_true", help="Use the text COPY format instead of binary"
+    )
+    parser.add_argument(
+        "--dedup", action="store_true", help="Skip rows already in the database"
+    )
     parser.add_argument("path", type=str, help="Path to cell data csv")
     parser.add_argument("rl", type=str, help="Name of rocketlogger")
     parser.add_argument("cell", type=str, help="Name of cell")
 
     args = parser.parse_args()
 
-    import_cell_data(args.path, args.rl, args.cell, args.cell2, args.batch_size)
+    # invalidate cached results of the cell
+    query_cache.connect(os.getenv("QUERY_CACHE_URL"))
+
+    import_cell_data(
+        args.path,
+        args.rl,
+        args.cell,
+        batch_size=args.batch_size,
+        header_rows=args.header_rows,
+        binary=not args.text,
+        dedup=args.dedup,
+    )
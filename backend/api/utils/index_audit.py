@@ -0,0 +1,244 @@
+"""Reports the usage, bloat and write cost of the indexes of the time-series
+tables
+
+Every index of power_data, teros_data and data is written by each inserted row,
+so indexes not used by queries only slow down ingest. The report is read from
+the statistics views of the server (pg_stat_user_indexes and
+pg_stat_user_tables), summed over the partitions of each index:
+
+- scans: Number of index scans, an index without scans is reported as unused
+- writes: Rows written to the index, inserts and updates that are not HOT
+- bloat: Estimated fraction of the index size not used by entries, compared
+  with a freshly built index filled to 90%. Indexes with entries inserted in
+  the middle, such as (cell_id, ts), are usually around 30% after page splits.
+  Estimated from pg_stats and the row counts of the last ANALYZE.
+
+Each table reports its rows written and the index entries written per row,
+the write amplification of its indexes.
+
+Statistics are kept per server since their last reset. Check the usage on
+replicas serving reads as well and over a period covering all regular queries
+before dropping an unused index. Unique indexes and primary keys are never
+reported as unused, they enforce constraints.
+
+Examples
+--------
+Report all indexes of the time-series tables::
+
+    $ python -m api.utils.index_audit
+
+Only report the unused indexes of the data table::
+
+    $ python -m api.utils.index_audit --unused data
+
+Help prompt for utility::
+
+    $ python -m api.utils.index_audit -h
+"""
+
+from sqlalchemy import text
+
+from ..conn import engine
+
+TABLES = ("power_data", "teros_data", "data")
+
+# leaf pages of a freshly built btree are filled to 90%
+FILL_FACTOR = 0.9
+
+# bytes of an index tuple header and its line pointer
+TUPLE_OVERHEAD = 12
+
+# bytes of the header and btree data of a page
+PAGE_OVERHEAD = 40
+
+_INDEXES = """
+    WITH RECURSIVE tree(root, leaf) AS (
+        SELECT indexrelid, indexrelid FROM pg_index
+        WHERE indrelid = CAST(:table AS regclass)
+        UNION ALL
+        SELECT t.root, h.inhrelid FROM tree t
+        JOIN pg_inherits h ON h.inhparent = t.leaf
+    )
+    SELECT
+        CAST(t.root AS regclass)::text AS name,
+        bool_or(r.indisunique OR r.indisprimary) AS unique,
+        CAST(coalesce(sum(s.idx_scan), 0) AS bigint) AS scans,
+        CAST(coalesce(sum(s.idx_tup_read), 0) AS bigint) AS tuples_read,
+        max(s.last_idx_scan) AS last_scan,
+        CAST(coalesce(
+            sum(w.n_tup_ins + w.n_tup_upd - w.n_tup_hot_upd), 0
+        ) AS bigint) AS writes,
+        CAST(sum(pg_relation_size(t.leaf)) AS bigint) AS bytes,
+        CAST(sum(e.bytes) AS float8) AS expected_bytes
+    FROM tree t
+    JOIN pg_index r ON r.indexrelid = t.root
+    JOIN pg_class c ON c.oid = t.leaf
+    LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = t.leaf
+    LEFT JOIN pg_stat_user_tables w ON w.relid = s.relid
+    LEFT JOIN LATERAL (
+        -- the metapage and the pages of the entries
+        SELECT b.size * (1 + ceil(
+            greatest(c.reltuples, 0) * (
+                8 * ceil(sum(coalesce(st.avg_width, greatest(a.attlen, 8))) / 8.0)
+                + :overhead
+            ) / :fill / (b.size - :page_overhead)
+        )) AS bytes
+        FROM (SELECT CAST(current_setting('block_size') AS int) AS size) b,
+        pg_index i
+        JOIN pg_class tc ON tc.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = tc.relnamespace
+        CROSS JOIN LATERAL unnest(CAST(i.indkey AS int2[])) k(attnum)
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+        LEFT JOIN pg_stats st ON st.schemaname = n.nspname
+            AND st.tablename = tc.relname
+            AND st.attname = a.attname
+            AND NOT st.inherited
+        WHERE i.indexrelid = t.leaf
+        GROUP BY b.size
+    ) e ON c.relkind = 'i'
+    GROUP BY t.root
+    ORDER BY name
+"""
+
+_TABLE = """
+    WITH RECURSIVE tree(relid) AS (
+        SELECT CAST(CAST(:table AS regclass) AS oid)
+        UNION ALL
+        SELECT h.inhrelid FROM tree t JOIN pg_inherits h ON h.inhparent = t.relid
+    )
+    SELECT
+        CAST(coalesce(sum(s.n_tup_ins + s.n_tup_upd), 0) AS bigint) AS rows_written,
+        CAST(coalesce(sum(
+            (s.n_tup_ins + s.n_tup_upd - s.n_tup_hot_upd)
+            * (SELECT count(*) FROM pg_index i WHERE i.indrelid = t.relid)
+        ), 0) AS bigint) AS index_writes,
+        CAST(sum(pg_relation_size(t.relid)) AS bigint) AS heap_bytes,
+        CAST(sum(pg_indexes_size(t.relid)) AS bigint) AS index_bytes
+    FROM tree t
+    JOIN pg_class c ON c.oid = t.relid AND c.relkind = 'r'
+    LEFT JOIN pg_stat_user_tables s ON s.relid = t.relid
+"""
+
+
+def stats_reset(conn):
+    """Time the statistics of the database were last reset, None if never"""
+
+    return conn.execute(
+        text(
+            "SELECT stats_reset FROM pg_stat_database "
+            "WHERE datname = current_database()"
+        )
+    ).scalar()
+
+
+def index_usage(conn, table: str) -> list:
+    """Usage of the indexes of a table, summed over its partitions
+
+    Returns:
+        List of dictionaries with the name, uniqueness, scans, tuples read,
+        last scan, writes, size in bytes and estimated bloat of each index,
+        see the module documentation. Indexes without scans that are not
+        unique are flagged unused.
+    """
+
+    indexes = []
+    for row in conn.execute(
+        text(_INDEXES),
+        {
+            "table": table,
+            "overhead": TUPLE_OVERHEAD,
+            "page_overhead": PAGE_OVERHEAD,
+            "fill": FILL_FACTOR,
+        },
+    ).mappings():
+        index = dict(row)
+        expected = index.pop("expected_bytes")
+        index["bloat"] = None
+        if expected is not None and index["bytes"]:
+            index["bloat"] = round(max(0.0, 1 - expected / index["bytes"]), 2)
+        index["unused"] = index["scans"] == 0 and not index["unique"]
+        indexes.append(index)
+    return indexes
+
+
+def write_amplification(conn, table: str) -> dict:
+    """Index entries written per row written to a table
+
+    Returns:
+        Dictionary with the rows written, index entries written, index
+        entries per row and the sizes of the table and its indexes in bytes.
+    """
+
+    stats = dict(conn.execute(text(_TABLE), {"table": table}).mappings().one())
+    rows = stats["rows_written"]
+    stats["index_writes_per_row"] = (
+        round(stats["index_writes"] / rows, 2) if rows else None
+    )
+    return stats
+
+
+def _size(n: int) -> str:
+    for unit in ("B", "kB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def report(tables=TABLES, unused=False, eng=engine):
+    """Prints the usage of the indexes of tables
+
+    Args:
+        tables: Names of the tables
+        unused: Only print the unused indexes
+        eng: SQLAlchemy engine
+    """
+
+    with eng.connect() as conn:
+        reset = stats_reset(conn)
+        print(f"statistics since {reset or 'the database was created'}")
+
+        for table in tables:
+            stats = write_amplification(conn, table)
+            per_row = stats["index_writes_per_row"]
+            print(
+                f"{table}: {stats['rows_written']} rows written, "
+                f"{'-' if per_row is None else per_row} index writes per row, "
+                f"indexes {_size(stats['index_bytes'])} "
+                f"of {_size(stats['heap_bytes'])} table"
+            )
+            for index in index_usage(conn, table):
+                if unused and not index["unused"]:
+                    continue
+                bloat = "?" if index["bloat"] is None else f"{index['bloat']:.0%}"
+                flags = [name for name in ("unique", "unused") if index[name]]
+                print(
+                    f"  {index['name']}: {index['scans']} scans, "
+                    f"{index['writes']} writes, {_size(index['bytes'])}, "
+                    f"~{bloat} bloat, last scan {index['last_scan'] or 'never'}"
+                    + (f" [{', '.join(flags)}]" if flags else "")
+                )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time-series index audit utility")
+    parser.add_argument(
+        "--unused",
+        action="store_true",
+        help="Only report indexes without scans",
+    )
+    parser.add_argument(
+        "tables",
+        nargs="*",
+        default=list(TABLES),
+        help=f"Tables, any of {', '.join(TABLES)} (default: all)",
+    )
+
+    args = parser.parse_args()
+    for table in args.tables:
+        if table not in TABLES:
+            parser.error(f"invalid table: {table}")
+
+    report(args.tables, unused=args.unused)
@@ -0,0 +1,439 @@
+"""Asynchronous ingest queue on Redis Streams
+
+When ``INGEST_QUEUE_URL`` is set, the sensor upload endpoint validates
+measurements, appends the raw bytes to a Redis stream and answers with 202
+instead of writing to the database. A consumer process drains the stream in
+batches through the regular ingest functions, so a slow database no longer
+backs up uploads and TTN retries.
+
+Entries are read through a consumer group. An entry is acknowledged once it is
+committed; entries of a consumer that crashed are claimed by another consumer
+after ``min_idle`` and entries that keep failing are moved to a dead letter
+stream.
+
+Examples
+--------
+Run a consumer, multiple consumers with different names can share the group::
+
+    $ INGEST_QUEUE_URL=redis://redis:6379 python -m api.utils.ingest_queue \\
+        --name consumer-1
+
+Live measurement events of the consumer reach dashboard clients when
+``SOCKETIO_MESSAGE_QUEUE`` is set for both the consumer and the web workers.
+
+Help prompt for utility::
+
+    $ python -m api.utils.ingest_queue -h
+"""
+
+from __future__ import annotations
+
+import time
+
+import redis
+
+# kinds of queued payloads
+MEASUREMENT = "measurement"
+GENERIC = "generic"
+BATCH = "batch"
+KINDS = (MEASUREMENT, GENERIC, BATCH)
+
+
+class IngestQueue:
+    """Redis stream of raw measurement uploads
+
+    Args:
+        client: Redis client, the queue is disabled when None
+        stream: Name of the stream
+        group: Name of the consumer group
+        maxlen: Approximate maximum length the stream is trimmed to
+    """
+
+    def __init__(self, client=None, stream="ingest", group="ingest", maxlen=None):
+        self.redis = client
+        self.stream = stream
+        self.group = group
+        self.maxlen = maxlen
+
+    def init_app(self, app):
+        """Configures the queue from the app config"""
+
+        url = app.config.get("INGEST_QUEUE_URL")
+        self.redis = redis.from_url(url) if url else None
+        self.stream = app.config.get("INGEST_STREAM", self.stream)
+        self.group = app.config.get("INGEST_GROUP", self.group)
+        self.maxlen = app.config.get("INGEST_STREAM_MAXLEN", self.maxlen)
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None
+
+    @property
+    def dead_stream(self) -> str:
+        return f"{self.stream}:dead"
+
+    def enqueue(self, kind: str, data: bytes) -> bytes:
+        """Appends a raw payload to the stream
+
+        Returns:
+            Id of the stream entry.
+        """
+
+        if kind not in KINDS:
+            raise ValueError(f"Unknown ingest kind: {kind}")
+
+        return self.redis.xadd(
+            self.stream,
+            {"kind": kind, "data": data},
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+
+    def create_group(self):
+        """Creates the consumer group and stream if they do not exist"""
+
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, consumer: str, count: int, block: int | None = None) -> list:
+        """Reads entries for a consumer
+
+        Entries already delivered to the consumer but not acknowledged (e.g.
+        the previous attempt failed) are returned first, then new entries.
+
+        Args:
+            consumer: Name of the consumer
+            count: Maximum number of entries
+            block: Milliseconds to wait for new entries
+
+        Returns:
+            List of (entry id, kind, data) tuples.
+        """
+
+        resp = self.redis.xreadgroup(
+            self.group, consumer, {self.stream: "0"}, count=count
+        )
+        entries = resp[0][1] if resp else []
+        if not entries:
+            resp = self.redis.xreadgroup(
+                self.group, consumer, {self.stream: ">"}, count=count, block=block
+            )
+            entries = resp[0][1] if resp else []
+
+        return [
+            (entry_id, fields[b"kind"].decode(), fields[b"data"])
+            for entry_id, fields in entries
+            # entries trimmed from the stream are returned without fields
+            if fields
+        ]
+
+    def claim(self, consumer: str, min_idle: int, count: int) -> int:
+        """Claims entries left pending by other consumers
+
+        Args:
+            consumer: Name of the consumer claiming the entries
+            min_idle: Milliseconds an entry must be idle to be claimed
+            count: Maximum number of entries
+
+        Returns:
+            Number of claimed entries.
+        """
+
+        claimed = self.redis.xautoclaim(
+            self.stream, self.group, consumer, min_idle, count=count, justid=True
+        )
+        return len(claimed)
+
+    def deliveries(self, consumer: str, count: int) -> dict:
+        """Number of times each pending entry of a consumer was delivered"""
+
+        pending = self.redis.xpending_range(
+            self.stream,
+            self.group,
+            min="-",
+            max="+",
+            count=count,
+            consumername=consumer,
+        )
+        return {p["message_id"]: p["times_delivered"] for p in pending}
+
+    def ack(self, *entry_ids):
+        """Acknowledges and removes processed entries"""
+
+        if entry_ids:
+            self.redis.xack(self.stream, self.group, *entry_ids)
+            self.redis.xdel(self.stream, *entry_ids)
+
+    def dead_letter(self, entry_id, kind: str, data: bytes, error: str):
+        """Moves an entry that cannot be processed to the dead letter stream"""
+
+        self.redis.xadd(
+            self.dead_stream,
+            {"id": entry_id, "kind": kind, "data": data, "error": error},
+        )
+        self.ack(entry_id)
+
+    def stats(self) -> dict:
+        """Consumer group metrics
+
+        Returns:
+            Dictionary with the stream length, the consumer lag (entries not
+            yet delivered to the group), the number of delivered entries not
+            yet acknowledged, the number of consumers and the length of the
+            dead letter stream. The lag is reported by Redis 7, older versions
+            (6.2 or later) count the undelivered entries with XRANGE.
+        """
+
+        stats = {
+            "stream": self.stream,
+            "group": self.group,
+            "length": self.redis.xlen(self.stream),
+            "lag": None,
+            "pending": 0,
+            "consumers": 0,
+            "dead": self.redis.xlen(self.dead_stream),
+        }
+
+        try:
+            groups = self.redis.xinfo_groups(self.stream)
+        except redis.ResponseError:
+            # stream does not exist yet
+            groups = []
+
+        for group in groups:
+            name = group["name"]
+            if isinstance(name, bytes):
+                name = name.decode()
+            if name == self.group:
+                stats["lag"] = group.get("lag")
+                if stats["lag"] is None:
+                    # Redis < 7 does not report the lag, which Redis 7 also
+                    # leaves unset after entries were deleted
+                    last_id = group["last-delivered-id"]
+                    if isinstance(last_id, bytes):
+                        last_id = last_id.decode()
+                    stats["lag"] = len(
+                        self.redis.xrange(self.stream, min=f"({last_id}", max="+")
+                    )
+                stats["pending"] = group["pending"]
+                stats["consumers"] = group["consumers"]
+
+        return stats
+
+
+ingest_queue = IngestQueue()
+
+
+class IngestError(Exception):
+    """Entries that could not be inserted
+
+    Attributes:
+        errors: Dictionary of entry id to error message
+    """
+
+    def __init__(self, errors: dict):
+        super().__init__(f"{len(errors)} entries failed")
+        self.errors = errors
+
+
+def process_entries(queue: IngestQueue, entries: list):
+    """Inserts queued payloads and acknowledges them
+
+    Protobuf measurements and batches are decoded and inserted together with
+    process_measurement_batch in a single transaction. When the transaction
+    fails, the entries are inserted one at a time so a single failing entry
+    does not hold back the others. Generic measurements go through
+    process_generic_measurement one at a time and are acknowledged
+    individually since each commits on its own.
+
+    Args:
+        queue: Queue the entries were read from
+        entries: List of (entry id, kind, data) tuples
+
+    Raises:
+        IngestError: Entries failed and are left pending to be retried.
+        Database errors of generic measurements are propagated, the entries
+        not acknowledged are then retried.
+    """
+
+    from ents.proto import decode_measurement
+
+    from .. import db
+    from ..resources.util import (
+        process_generic_measurement,
+        process_measurement_batch,
+        split_delimited,
+    )
+
+    def decode(msg):
+        try:
+            return decode_measurement(msg, raw=False)
+        except Exception:
+            return None
+
+    def insert(meas_list):
+        if not meas_list:
+            return
+        resp = process_measurement_batch(meas_list)
+        body = resp.get_json()
+        if body["failed"]:
+            print(
+                f"[ingest_queue] {body['failed']} of {len(meas_list)} "
+                "measurements not inserted",
+                flush=True,
+            )
+        if body["duplicate"]:
+            print(f"[ingest_queue] skipped {body['duplicate']} duplicate rows")
+
+    batch = []
+    for entry_id, kind, data in entries:
+        if kind == GENERIC:
+            resp = process_generic_measurement(data)
+            if resp.status_code != 200:
+                print(f"[ingest_queue] {entry_id}: {resp.get_data(as_text=True)}")
+            queue.ack(entry_id)
+            continue
+
+        meas_list = []
+        if kind == MEASUREMENT:
+            meas_list.append(decode(data))
+        elif kind == BATCH:
+            meas_list.extend(decode(msg) for msg in split_delimited(data))
+        else:
+            print(f"[ingest_queue] {entry_id}: unknown kind {kind}")
+        batch.append((entry_id, meas_list))
+
+    try:
+        insert([meas for _, meas_list in batch for meas in meas_list])
+    except Exception:
+        db.session.rollback()
+        if len(batch) == 1:
+            raise
+
+        errors = {}
+        for entry_id, meas_list in batch:
+            try:
+                insert(meas_list)
+            except Exception as e:
+                db.session.rollback()
+                errors[entry_id] = str(e)
+            else:
+                queue.ack(entry_id)
+        if errors:
+            raise IngestError(errors)
+        return
+
+    queue.ack(*[entry_id for entry_id, _ in batch])
+
+
+def consume(
+    queue: IngestQueue,
+    consumer: str,
+    batch_size: int = 500,
+    block: int = 5000,
+    min_idle: int = 60000,
+    max_deliveries: int = 5,
+    stats_interval: float = 60,
+    once: bool = False,
+):
+    """Drains the queue
+
+    Args:
+        queue: Queue to drain
+        consumer: Name of this consumer within the group
+        batch_size: Maximum number of entries processed per transaction
+        block: Milliseconds to wait for new entries
+        min_idle: Milliseconds after which entries of other consumers are
+            claimed
+        max_deliveries: Deliveries after which a failing entry is moved to
+            the dead letter stream
+        stats_interval: Seconds between printing the queue metrics
+        once: Process a single batch and return, used for testing
+    """
+
+    from .. import db
+
+    queue.create_group()
+    last_stats = 0
+
+    while True:
+        queue.claim(consumer, min_idle, batch_size)
+        entries = queue.read(consumer, batch_size, block=block)
+
+        if entries:
+            try:
+                process_entries(queue, entries)
+            except Exception as e:
+                db.session.rollback()
+                print(f"[ingest_queue] error processing entries: {e}", flush=True)
+
+                # give up on entries that keep failing, acknowledged entries
+                # are no longer pending
+                errors = e.errors if isinstance(e, IngestError) else {}
+                deliveries = queue.deliveries(consumer, batch_size)
+                for entry_id, kind, data in entries:
+                    if deliveries.get(entry_id, 0) >= max_deliveries:
+                        error = errors.get(entry_id, str(e))
+                        queue.dead_letter(entry_id, kind, data, error)
+
+                if not once:
+                    time.sleep(1)
+
+        if time.monotonic() - last_stats > stats_interval:
+            print(f"[ingest_queue] {queue.stats()}", flush=True)
+            last_stats = time.monotonic()
+
+        if once:
+            return
+
+
+if __name__ == "__main__":
+    import argparse
+    import socket
+
+    parser = argparse.ArgumentParser(description="Ingest queue consumer")
+    parser.add_argument(
+        "--name", type=str, default=socket.gethostname(), help="Consumer name"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="Entries per transaction"
+    )
+    parser.add_argument(
+        "--block", type=int, default=5000, help="Milliseconds to wait for entries"
+    )
+    parser.add_argument(
+        "--min-idle",
+        type=int,
+        default=60000,
+        help="Milliseconds before entries of other consumers are claimed",
+    )
+    parser.add_argument(
+        "--max-deliveries",
+        type=int,
+        default=5,
+        help="Deliveries before a failing entry is dead lettered",
+    )
+
+    args = parser.parse_args()
+
+    from .. import create_app
+
+    # the instance configured by create_app, not the one of __main__
+    from .ingest_queue import ingest_queue as app_queue
+
+    # live events are published through SOCKETIO_MESSAGE_QUEUE
+    create_app(emit_only=True)
+    if not app_queue.enabled:
+        raise SystemExit("INGEST_QUEUE_URL is not set")
+
+    consume(
+        app_queue,
+        args.name,
+        batch_size=args.batch_size,
+        block=args.block,
+        min_idle=args.min_idle,
+        max_deliveries=args.max_deliveries,
+    )
@@ -0,0 +1,67 @@
+"""Streamed newline delimited json responses of the time-series endpoints
+
+The json response of a time-series GET is built in memory and only sent once
+the last row is read. Clients sending ``Accept: application/x-ndjson`` receive
+one json object per measurement instead, written while the rows are read from a
+server-side cursor::
+
+    {"timestamp": "Mon, 01 Jan 2024 00:00:00 GMT", "v": 1.0, "i": 2.0, "p": 2.0}
+    {"timestamp": "Mon, 01 Jan 2024 00:01:00 GMT", "v": 1.0, "i": 2.0, "p": 2.0}
+
+Memory stays flat regardless of the range and the first rows are sent right
+away. Values are encoded like the json response.
+"""
+
+from flask import Response, current_app, request, stream_with_context
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# rows written per chunk of the response
+CHUNK_ROWS = 1000
+
+
+def wants_ndjson() -> bool:
+    """Whether the request prefers a streamed ndjson response over json"""
+
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def ndjson_lines(rows, chunk_rows: int = CHUNK_ROWS):
+    """Encodes rows as ndjson
+
+    Args:
+        rows: Iterable of dictionaries
+        chunk_rows: Number of rows per yielded chunk
+
+    Yields:
+        Chunks of lines, each ending with a newline.
+    """
+
+    dumps = current_app.json.dumps
+    lines = []
+    for row in rows:
+        lines.append(dumps(row))
+        if len(lines) >= chunk_rows:
+            lines.append("")
+            yield "\n".join(lines)
+            lines = []
+    if lines:
+        lines.append("")
+        yield "\n".join(lines)
+
+
+def ndjson_response(rows) -> Response:
+    """Streamed ndjson response of rows
+
+    The request context, and with it the database session, is kept until the
+    last row is written.
+
+    Args:
+        rows: Iterable of dictionaries, typically a generator reading the rows
+            from the database
+    """
+
+    resp = Response(stream_with_context(ndjson_lines(rows)), mimetype=NDJSON_MIMETYPE)
+    resp.vary.add("Accept")
+    return resp
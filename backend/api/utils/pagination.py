@@ -0,0 +1,137 @@
+"""Keyset pagination of raw time-series reads
+
+Raw reads (``resample=none``) return at most ``limit`` rows, capped by
+``MAX_PAGE_SIZE``. When more rows are left the response includes a ``next``
+token, which is passed back as ``cursor`` to read the following page. Pages are
+ordered by series, timestamp and row id and the token holds the key of the last
+row, so every page is a range scan starting right after the previous one
+instead of an offset into the whole range.
+
+Examples
+--------
+Walk all raw power data of a cell::
+
+    args = {"resample": "none", "startTime": ..., "endTime": ...}
+    while True:
+        page = requests.get(f"{url}/api/power/{cell_id}", params=args).json()
+        ...
+        if page["next"] is None:
+            break
+        args["cursor"] = page["next"]
+
+Streamed reads (``stream``) return a ``cursor`` token instead, holding the
+ts_server and id of the last row, and are ordered the same way. Passed back as
+``after``, only rows inserted since are returned. ts_server is the start of the
+inserting transaction, so a row can become visible after rows inserted later.
+Polls with ``after`` therefore only return rows inserted ``STREAM_LAG`` seconds
+ago. A row whose transaction takes longer than the lag to commit is missed by
+a poll that already passed it. Streamed reads without ``after`` return the
+newest rows as well, their cursor can pass rows still being committed.
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+import os
+from datetime import datetime
+
+from marshmallow import ValidationError, fields
+from sqlalchemy import func, true, tuple_
+
+# maximum number of rows of a raw read
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "100000"))
+
+# seconds since insertion before a row is streamed
+STREAM_LAG = float(os.getenv("STREAM_LAG", "5"))
+
+
+def page_size(limit: int | None) -> int:
+    """Number of rows of a page, limit capped by MAX_PAGE_SIZE"""
+
+    if limit is None:
+        return MAX_PAGE_SIZE
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def encode_cursor(series_id: int, ts: datetime, row_id: int) -> str:
+    """Token of the key of the last row of a page"""
+
+    key = json.dumps([series_id, ts.isoformat(), row_id])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(token: str) -> tuple:
+    """Key of a token created by encode_cursor
+
+    Raises:
+        ValueError: When the token is malformed.
+    """
+
+    try:
+        series_id, ts, row_id = json.loads(base64.urlsafe_b64decode(token))
+        return int(series_id), datetime.fromisoformat(ts), int(row_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+
+
+def after_key(series, ts, row_id, cursor: str):
+    """Condition selecting the rows after the key of a cursor token"""
+
+    return tuple_(series, ts, row_id) > tuple_(*decode_cursor(cursor))
+
+
+def encode_stream_cursor(ts_server: datetime, row_id: int) -> str:
+    """Token of the ts_server and id of the last streamed row"""
+
+    key = json.dumps([ts_server.isoformat(), row_id])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_stream_cursor(token: str) -> tuple:
+    """Key of a token created by encode_stream_cursor
+
+    Raises:
+        ValueError: When the token is malformed.
+    """
+
+    try:
+        ts_server, row_id = json.loads(base64.urlsafe_b64decode(token))
+        return datetime.fromisoformat(ts_server), int(row_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+
+
+def streamed(ts_server, row_id, after: str | None):
+    """Condition selecting the rows to stream after a cursor token
+
+    With a cursor, rows inserted less than STREAM_LAG seconds ago are left for
+    a later poll. Without one every row is streamed.
+    """
+
+    if after is None:
+        return true()
+    cutoff = func.now() - func.make_interval(0, 0, 0, 0, 0, 0, STREAM_LAG)
+    return (ts_server <= cutoff) & (
+        tuple_(ts_server, row_id) > tuple_(*decode_stream_cursor(after))
+    )
+
+
+class Cursor(fields.Str):
+    """Query argument of a page token, validated by decoding its key"""
+
+    decode = staticmethod(decode_cursor)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        token = super()._deserialize(value, attr, data, **kwargs)
+        try:
+            self.decode(token)
+        except ValueError as e:
+            raise ValidationError(str(e)) from e
+        return token
+
+
+class StreamCursor(Cursor):
+    """Query argument of a streamed cursor token"""
+
+    decode = staticmethod(decode_stream_cursor)
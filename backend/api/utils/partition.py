@@ -0,0 +1,433 @@
+"""Maintains the monthly partitions of the time-series tables
+
+The tables are partitioned by month of ``ts``, see models/partition.py. This
+utility creates the partitions of the coming months ahead of time, drops the
+partitions of months past the retention period and migrates tables created
+before partitioning.
+
+Rows of months without a partition are stored in the default partition. When
+the partition of a month is created, its rows are moved out of the default
+partition in batches before the partition is attached, see create_partition.
+
+Migration
+---------
+The migration adding partitioning (``flask db upgrade``) only creates an empty
+partitioned copy ``{table}_partitioned`` of each table and a trigger mirroring
+every insert, update and delete of the table into the copy. The existing rows
+are then copied in batches of ids, each in its own transaction, while the
+application keeps writing to the table. Once all rows are copied the tables
+are swapped by renaming them in a short transaction, keeping the old table as
+``{table}_unpartitioned`` until it is dropped by hand. Rollup watermarks and
+pagination cursors stay valid since the ids are unchanged.
+
+Examples
+--------
+Create the partitions of the current and next three months::
+
+    $ python -m api.utils.partition
+
+Keep creating partitions, checking once a day::
+
+    $ python -m api.utils.partition --interval 86400
+
+Copy the rows of the unpartitioned tables and swap them::
+
+    $ python -m api.utils.partition --migrate
+
+Drop the partitions of months more than two years ago::
+
+    $ python -m api.utils.partition --retain 24
+
+Help prompt for utility::
+
+    $ python -m api.utils.partition -h
+"""
+
+from __future__ import annotations
+
+import re
+import time
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import text
+
+from ..conn import engine
+from ..models.partition import (
+    PARTITIONED_TABLES,
+    default_partition_name,
+    partition_name,
+)
+
+# months created ahead of the current month
+PREMAKE = 3
+
+_MONTH = re.compile(r"_p(\d{4})(\d{2})$")
+
+
+def month_start(dt: datetime) -> datetime:
+    """First instant of the month of dt"""
+
+    return datetime(dt.year, dt.month, 1)
+
+
+def partitioned_table(conn, table: str) -> str | None:
+    """Partitioned table holding the rows of table
+
+    Returns:
+        table once partitioned, {table}_partitioned while table is migrated and
+        None when table is not partitioned.
+    """
+
+    for name in (table, f"{table}_partitioned"):
+        kind = conn.execute(
+            text("SELECT relkind FROM pg_class WHERE relname = :name"),
+            {"name": name},
+        ).scalar()
+        if kind == "p":
+            return name
+    return None
+
+
+def partitions(conn, parent: str) -> list:
+    """Names of the partitions of a partitioned table"""
+
+    return list(
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST(:parent AS regclass) ORDER BY c.relname"
+            ),
+            {"parent": parent},
+        ).scalars()
+    )
+
+
+def partition_months(conn, table: str, parent: str) -> dict:
+    """Dictionary of the first instant of each month with a partition to its name"""
+
+    months = {}
+    for name in partitions(conn, parent):
+        match = _MONTH.search(name)
+        if name.startswith(f"{table}_p") and match is not None:
+            months[datetime(int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+
+def create_partition(
+    table: str,
+    parent: str,
+    month: datetime,
+    batch_size: int = 10000,
+    lock_timeout: str = "5s",
+    eng=engine,
+) -> str:
+    """Creates the partition of a month, moving its rows out of the default
+
+    The partition is created as a standalone table and its rows are moved out
+    of the default partition in batches of ids, each in its own transaction,
+    so writes are not blocked while they are moved. Moved rows are not read
+    until the table is attached. The rows inserted since the last batch are
+    moved while attaching, which only locks the default partition while it is
+    checked for rows of the month. An interrupted run is resumed by the next
+    one since the standalone table is kept.
+
+    Args:
+        table: Name of the time-series table
+        parent: Partitioned table, see partitioned_table
+        month: First instant of the month
+        batch_size: Number of rows moved per transaction
+        lock_timeout: Maximum wait for the locks of the attach
+        eng: SQLAlchemy engine
+
+    Returns:
+        Name of the partition.
+    """
+
+    name = partition_name(table, month)
+    default = default_partition_name(table)
+    bounds = {"lo": month, "hi": month + relativedelta(months=1)}
+    values = (
+        f"FOR VALUES FROM ('{bounds['lo']:%Y-%m-%d}') TO ('{bounds['hi']:%Y-%m-%d}')"
+    )
+
+    with eng.begin() as conn:
+        exists = conn.execute(
+            text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}
+        ).scalar()
+        if not exists:
+            # inserts go through the parent, which draws the ids
+            conn.execute(
+                text(
+                    f"CREATE TABLE {name} "
+                    f"(LIKE {parent} INCLUDING ALL EXCLUDING DEFAULTS)"
+                )
+            )
+            # lets the attach skip scanning the partition
+            conn.execute(
+                text(
+                    f"ALTER TABLE {name} ADD CONSTRAINT {name}_bounds CHECK "
+                    f"(ts IS NOT NULL AND ts >= '{bounds['lo']:%Y-%m-%d}' "
+                    f"AND ts < '{bounds['hi']:%Y-%m-%d}')"
+                )
+            )
+
+    move = text(
+        f"WITH moved AS (DELETE FROM {default} WHERE id IN ("
+        f"SELECT id FROM {default} WHERE ts >= :lo AND ts < :hi "
+        f"ORDER BY id LIMIT :n) RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    )
+    while True:
+        with eng.begin() as conn:
+            moved = conn.execute(move, {**bounds, "n": batch_size}).rowcount
+        if moved < batch_size:
+            break
+
+    with eng.begin() as conn:
+        conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+        conn.execute(text(f"LOCK TABLE {default} IN SHARE ROW EXCLUSIVE MODE"))
+        while conn.execute(move, {**bounds, "n": batch_size}).rowcount:
+            pass
+        conn.execute(text(f"ALTER TABLE {parent} ATTACH PARTITION {name} {values}"))
+        conn.execute(
+            text(f"ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {name}_bounds")
+        )
+    return name
+
+
+def ensure_partitions(table: str, months=None, eng=engine) -> list:
+    """Creates the missing partitions of months
+
+    Args:
+        table: Name of the time-series table
+        months: First instants of the months, by default the current month and
+            the PREMAKE following ones
+        eng: SQLAlchemy engine
+
+    Returns:
+        Names of the created partitions.
+    """
+
+    if months is None:
+        current = month_start(datetime.now())
+        months = [current + relativedelta(months=i) for i in range(PREMAKE + 1)]
+
+    with eng.connect() as conn:
+        parent = partitioned_table(conn, table)
+        if parent is None:
+            raise RuntimeError(f"{table} is not partitioned, run flask db upgrade")
+        existing = partition_months(conn, table, parent)
+
+    created = []
+    for month in sorted(set(months)):
+        if month not in existing:
+            created.append(create_partition(table, parent, month, eng=eng))
+    return created
+
+
+def drop_partitions(table: str, before: datetime, eng=engine) -> list:
+    """Drops the partitions of the months ending before a date
+
+    Rollups are not updated, rebuild them after dropping partitions, see
+    utils/rollup.py.
+
+    Returns:
+        Names of the dropped partitions.
+    """
+
+    dropped = []
+    with eng.begin() as conn:
+        parent = partitioned_table(conn, table)
+        if parent is None:
+            raise RuntimeError(f"{table} is not partitioned, run flask db upgrade")
+        for month, name in sorted(partition_months(conn, table, parent).items()):
+            if month + relativedelta(months=1) <= before:
+                conn.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+    return dropped
+
+
+def backfill(table: str, batch_size: int = 100000, start_id: int = 0, eng=engine):
+    """Copies the rows of an unpartitioned table into its partitioned copy
+
+    Rows are copied in batches of ids, each in its own transaction, and locked
+    while they are copied so concurrent updates and deletes are mirrored after
+    the copy. Rows already in the copy, such as those mirrored since the
+    migration, are skipped. Partitions are created for the months of the
+    copied rows up to PREMAKE months ahead, later rows go to the default
+    partition.
+
+    Args:
+        table: Name of the time-series table
+        batch_size: Number of rows per batch
+        start_id: Only copy rows with a greater id, to resume a backfill
+        eng: SQLAlchemy engine
+
+    Returns:
+        Number of copied rows.
+    """
+
+    shadow = f"{table}_partitioned"
+    horizon = month_start(datetime.now()) + relativedelta(months=PREMAKE + 1)
+
+    copied = 0
+    last_id = start_id
+    while True:
+        with eng.connect() as conn:
+            upper = conn.execute(
+                text(
+                    f"SELECT max(id) FROM (SELECT id FROM {table} WHERE id > :lo "
+                    "ORDER BY id LIMIT :n) batch"
+                ),
+                {"lo": last_id, "n": batch_size},
+            ).scalar()
+            if upper is None:
+                return copied
+
+            ids = {"lo": last_id, "hi": upper}
+            months = list(
+                conn.execute(
+                    text(
+                        f"SELECT DISTINCT date_trunc('month', ts) FROM {table} "
+                        "WHERE id > :lo AND id <= :hi"
+                    ),
+                    ids,
+                ).scalars()
+            )
+            existing = partition_months(conn, table, shadow)
+        for month in months:
+            if month not in existing and month < horizon:
+                create_partition(table, shadow, month, eng=eng)
+
+        with eng.begin() as conn:
+            copied += conn.execute(
+                text(
+                    f"INSERT INTO {shadow} SELECT * FROM {table} "
+                    "WHERE id > :lo AND id <= :hi FOR SHARE ON CONFLICT DO NOTHING"
+                ),
+                ids,
+            ).rowcount
+            last_id = upper
+        print(f"{table}: copied up to id {last_id}", flush=True)
+
+
+def _rename_indexes(conn, table: str, rename):
+    """Renames the indexes of table with rename(name)"""
+
+    names = conn.execute(
+        text("SELECT indexname FROM pg_indexes WHERE tablename = :table"),
+        {"table": table},
+    ).scalars()
+    for name in list(names):
+        conn.execute(text(f"ALTER INDEX {name} RENAME TO {rename(name)}"))
+
+
+def swap(table: str, lock_timeout: str = "5s", eng=engine):
+    """Replaces an unpartitioned table with its backfilled partitioned copy
+
+    Writes to the table wait while it is locked for the rename, which fails
+    instead of queueing behind long running queries after lock_timeout.
+
+    Args:
+        table: Name of the time-series table
+        lock_timeout: Maximum wait for the lock of the table
+        eng: SQLAlchemy engine
+    """
+
+    shadow = f"{table}_partitioned"
+    old = f"{table}_unpartitioned"
+    with eng.begin() as conn:
+        conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+        conn.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+        conn.execute(text(f"DROP TRIGGER {table}_mirror ON {table}"))
+
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {old}"))
+        _rename_indexes(conn, old, lambda name: f"{name}_unpartitioned")
+        conn.execute(text(f"ALTER TABLE {shadow} RENAME TO {table}"))
+        _rename_indexes(conn, table, lambda name: name[: -len("_partitioned")])
+
+        # the sequence would be dropped with the old table
+        conn.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+
+
+def migrate(table: str, batch_size: int = 100000, start_id: int = 0, eng=engine):
+    """Backfills and swaps an unpartitioned table, see the module documentation
+
+    Returns:
+        Number of copied rows.
+    """
+
+    with eng.connect() as conn:
+        parent = partitioned_table(conn, table)
+    if parent == table:
+        return 0
+    if parent is None:
+        raise RuntimeError(f"{table} is not partitioned, run flask db upgrade")
+
+    copied = backfill(table, batch_size=batch_size, start_id=start_id, eng=eng)
+    swap(table, eng=eng)
+    return copied
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time-series partition utility")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100000,
+        help="Number of rows per batch of --migrate",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Copy the rows of unpartitioned tables and swap them",
+    )
+    parser.add_argument(
+        "--start-id",
+        type=int,
+        default=0,
+        help="Resume --migrate after the rows with ids up to START_ID",
+    )
+    parser.add_argument(
+        "--retain",
+        type=int,
+        help="Drop the partitions of months older than RETAIN months",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        help="Keep creating partitions every INTERVAL seconds",
+    )
+    parser.add_argument(
+        "tables",
+        nargs="*",
+        default=list(PARTITIONED_TABLES),
+        help=f"Tables, any of {', '.join(PARTITIONED_TABLES)} (default: all)",
+    )
+
+    args = parser.parse_args()
+    for table in args.tables:
+        if table not in PARTITIONED_TABLES:
+            parser.error(f"invalid table: {table}")
+
+    if args.migrate:
+        for table in args.tables:
+            rows = migrate(table, batch_size=args.batch_size, start_id=args.start_id)
+            print(f"{table}: migrated {rows} rows", flush=True)
+
+    while True:
+        for table in args.tables:
+            for name in ensure_partitions(table):
+                print(f"{table}: created {name}", flush=True)
+            if args.retain is not None:
+                before = month_start(datetime.now()) - relativedelta(months=args.retain)
+                for name in drop_partitions(table, before):
+                    print(f"{table}: dropped {name}", flush=True)
+
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,282 @@
+"""Redis cache of time-series query results
+
+Dashboards request the same window of a cell repeatedly. When
+``QUERY_CACHE_URL`` is set, the results of get_power_data_obj,
+get_teros_data_obj and get_sensor_data_obj are stored in Redis under a key made
+of the series, its version and the canonical query arguments.
+
+Windows ending before the current bucket only contain closed buckets and are
+cached as a whole. Windows reaching into the current bucket are split at its
+start: the closed buckets are cached and merged with a fresh query of the
+remaining ones. Naive datetimes are in UTC like the ``ts`` columns, default
+windows of the read paths end at ``datetime.utcnow()``. Downsampled selections
+and pages of raw data depend on the whole window, so they are only cached once
+the window is closed. Live ``stream`` queries and pages after a ``cursor`` are
+never cached.
+
+Every series (the cell of power and TEROS data, the sensor of generic data)
+has a version that is incremented when new rows of the series are committed
+through a session, see bulk_write.py. Entries of older versions are never read
+again and expire after ``QUERY_CACHE_TTL`` seconds. Rows written on a plain
+connection, or deleted, are not tracked; use invalidate or flush the cache after
+changing data by hand.
+"""
+
+from __future__ import annotations
+
+import json
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import redis
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .resample import naive_origin, parse_interval
+
+# column identifying the series of each time-series table
+SERIES_COLUMNS = {
+    "power_data": "cell_id",
+    "teros_data": "cell_id",
+    "data": "sensor_id",
+}
+
+_SERIES_KEY = "query_cache_series"
+
+
+def _utc(dt: datetime) -> datetime:
+    """Aware UTC datetime, naive datetimes are in UTC"""
+
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def _like(dt: datetime, other: datetime) -> datetime:
+    """UTC datetime dt, naive when other is naive"""
+
+    return dt.replace(tzinfo=None) if other.tzinfo is None else dt
+
+
+def bucket_start(dt: datetime, resample: str, origin=None) -> datetime:
+    """Start of the bucket containing dt, like date_trunc and date_bin
+
+    Raw and per second queries are split on minutes, intervals on their buckets
+    aligned to origin.
+    """
+
+    width = parse_interval(resample)
+    if width is not None:
+        origin = _like(_utc(naive_origin(origin)), dt)
+        return origin + (dt - origin) // width * width
+
+    dt = dt.replace(second=0, microsecond=0)
+    if resample in ("none", "second", "minute"):
+        return dt
+    dt = dt.replace(minute=0)
+    if resample == "hour":
+        return dt
+    dt = dt.replace(hour=0)
+    if resample == "day":
+        return dt
+    if resample == "week":
+        return dt - timedelta(days=dt.weekday())
+    dt = dt.replace(day=1)
+    if resample == "month":
+        return dt
+    if resample == "quarter":
+        return dt.replace(month=(dt.month - 1) // 3 * 3 + 1)
+    if resample == "year":
+        return dt.replace(month=1)
+    raise ValueError(f"Unknown resample level: {resample}")
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        # serialized like the json responses
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+def dumps(data: dict) -> bytes:
+    return json.dumps(data, default=_default).encode()
+
+
+def loads(buf: bytes) -> dict:
+    data = json.loads(buf)
+    data["timestamp"] = [datetime.fromisoformat(ts) for ts in data["timestamp"]]
+    return data
+
+
+def merge(head: dict, tail: dict) -> dict:
+    """Appends the columns of tail to those of head"""
+
+    return {
+        key: head[key] + value if isinstance(value, list) else value
+        for key, value in tail.items()
+    }
+
+
+class QueryCache:
+    """Redis cache of time-series query results
+
+    Args:
+        client: Redis client, the cache is disabled when None
+        prefix: Prefix of the keys
+        ttl: Seconds an entry is kept
+    """
+
+    def __init__(self, client=None, prefix="query", ttl=86400):
+        self.redis = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def init_app(self, app):
+        """Configures the cache from the app config"""
+
+        self.connect(app.config.get("QUERY_CACHE_URL"))
+        self.prefix = app.config.get("QUERY_CACHE_PREFIX", self.prefix)
+        self.ttl = app.config.get("QUERY_CACHE_TTL", self.ttl)
+
+    def connect(self, url: str | None):
+        """Connects to Redis, disables the cache when url is empty"""
+
+        self.redis = redis.from_url(url) if url else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None
+
+    def version_key(self, table: str, series_id: int) -> str:
+        return f"{self.prefix}:version:{table}:{series_id}"
+
+    def invalidate(self, series):
+        """Increments the version of series
+
+        Args:
+            series: Iterable of (table, series id) tuples
+        """
+
+        if not self.enabled:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for table, series_id in series:
+            pipe.incr(self.version_key(table, series_id))
+        pipe.execute()
+
+    def fetch(
+        self,
+        table: str,
+        series_id: int,
+        query,
+        start_time,
+        end_time,
+        resample="hour",
+        stream=False,
+        downsample=None,
+        points=1000,
+        limit=None,
+        cursor=None,
+        origin=None,
+        agg=None,
+    ) -> dict:
+        """Cached result of a time-series query
+
+        Redis errors are logged and the query is executed directly.
+
+        Args:
+            table: Time-series table of the series, see SERIES_COLUMNS
+            series_id: Id of the cell or sensor
+            query: Function of (start_time, end_time) returning the result
+            start_time: Start of the range, inclusive
+            end_time: End of the range, inclusive
+            resample: Resample level of the query
+            stream: Whether the query is a live stream query, never cached
+            downsample: Downsampling method of the query
+            points: Number of points of downsampled queries
+            limit: Page size of raw queries
+            cursor: Key of the previous page of raw queries, never cached
+            origin: Origin of interval buckets
+            agg: Aggregates of resampled queries
+
+        Returns:
+            Result of the query.
+        """
+
+        if (
+            not self.enabled
+            or stream
+            or cursor is not None
+            or start_time is None
+            or end_time is None
+        ):
+            return query(start_time, end_time)
+
+        split = bucket_start(datetime.now(timezone.utc), resample, origin)
+        start = _utc(start_time)
+        end = _utc(end_time)
+        args = f"{resample}:{downsample}:{points if downsample else ''}:{limit or ''}"
+        if parse_interval(resample) is not None:
+            args += f":{naive_origin(origin).isoformat()}"
+        if agg:
+            args += f":{','.join(agg)}"
+
+        try:
+            version = self.redis.get(self.version_key(table, series_id)) or b"0"
+
+            def cached(start, end, start_time, end_time):
+                key = (
+                    f"{self.prefix}:{table}:{series_id}:{version.decode()}:{args}:"
+                    f"{start.isoformat()}:{end.isoformat()}"
+                )
+                buf = self.redis.get(key)
+                if buf is not None:
+                    return loads(buf)
+                data = query(start_time, end_time)
+                self.redis.set(key, dumps(data), ex=self.ttl)
+                return data
+
+            if end < split:
+                # only closed buckets
+                return cached(start, end, start_time, end_time)
+            if downsample or resample == "none" or start >= split:
+                return query(start_time, end_time)
+
+            # closed buckets are cached, the current ones are queried
+            head_end = split - timedelta(microseconds=1)
+            head = cached(start, head_end, start_time, _like(head_end, end_time))
+        except redis.RedisError as e:
+            print(f"[query_cache] {e}")
+            return query(start_time, end_time)
+
+        return merge(head, query(_like(split, start_time), end_time))
+
+
+query_cache = QueryCache()
+
+
+def track_series(session, table: str, series_ids):
+    """Records series with new rows in the transaction of a session
+
+    The versions of the series are incremented once the transaction commits.
+    """
+
+    tracked = session.info.setdefault(_SERIES_KEY, set())
+    tracked.update((table, series_id) for series_id in series_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    series = session.info.pop(_SERIES_KEY, None)
+    if series:
+        try:
+            query_cache.invalidate(series)
+        except redis.RedisError as e:
+            print(f"[query_cache] unable to invalidate {len(series)} series: {e}")
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop(_SERIES_KEY, None)
@@ -0,0 +1,220 @@
+"""Resample levels of the time-series queries
+
+Resampled queries average the measurements of each time bucket. The
+``resample`` argument is either one of the fixed units of date_trunc, or an
+interval such as ``30s``, ``5m``, ``15m``, ``6h`` or ``2d`` so clients can
+request exactly the resolution they can render. Intervals are binned with
+Postgres date_bin and the buckets are aligned to ``origin``, the unix epoch by
+default, e.g. ``6h`` buckets start at 00:00, 06:00, 12:00 and 18:00 UTC.
+
+With ``auto`` the interval is chosen so that each series has about ``points``
+buckets, see auto_resample. The density of each series is estimated from the
+cadence of its latest rows in the range, read from the (series, ts) index, so
+the estimate costs a handful of rows however large the range is.
+"""
+
+from __future__ import annotations
+
+import re
+from datetime import datetime, timedelta, timezone
+
+from marshmallow import ValidationError
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import (
+    Integer,
+    Interval,
+    cast,
+    column,
+    func,
+    literal,
+    select,
+    true,
+    values,
+)
+
+# fixed units, none disables resampling
+RESAMPLE_UNITS = (
+    "none",
+    "second",
+    "minute",
+    "hour",
+    "day",
+    "week",
+    "month",
+    "quarter",
+    "year",
+)
+
+# resample level chosen from the density of the data
+AUTO = "auto"
+
+# seconds of each interval unit
+INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# intervals chosen by auto, in seconds, coarser ones are whole days
+AUTO_INTERVALS = (
+    1,
+    2,
+    5,
+    10,
+    15,
+    30,
+    60,
+    2 * 60,
+    5 * 60,
+    10 * 60,
+    15 * 60,
+    30 * 60,
+    3600,
+    2 * 3600,
+    3 * 3600,
+    6 * 3600,
+    12 * 3600,
+    86400,
+    2 * 86400,
+    7 * 86400,
+)
+
+# latest rows of a series used to estimate its cadence
+CADENCE_SAMPLE = 100
+
+_INTERVAL = re.compile(r"^([1-9][0-9]{0,5})([smhd])$")
+
+# origin of interval buckets
+DEFAULT_ORIGIN = datetime(1970, 1, 1)
+
+
+def parse_interval(resample: str) -> timedelta | None:
+    """Width of an interval resample level, None for the fixed units"""
+
+    match = _INTERVAL.match(resample)
+    if match is None:
+        return None
+    count, unit = match.groups()
+    return timedelta(seconds=int(count) * INTERVAL_UNITS[unit])
+
+
+def naive_origin(origin: datetime | None) -> datetime:
+    """Origin of interval buckets as a naive UTC datetime"""
+
+    if origin is None:
+        return DEFAULT_ORIGIN
+    if origin.tzinfo is not None:
+        origin = origin.astimezone(timezone.utc).replace(tzinfo=None)
+    return origin
+
+
+def format_interval(width: timedelta) -> str:
+    """Interval resample level of a width, in the coarsest unit dividing it"""
+
+    seconds = int(width.total_seconds())
+    for unit, unit_seconds in reversed(INTERVAL_UNITS.items()):
+        if seconds % unit_seconds == 0:
+            return f"{seconds // unit_seconds}{unit}"
+    raise ValueError(f"Width is not whole seconds: {width}")
+
+
+def validate_resample(value: str):
+    """Validator of the resample query argument"""
+
+    if value not in RESAMPLE_UNITS and value != AUTO and parse_interval(value) is None:
+        raise ValidationError(
+            f"Must be one of: {', '.join(RESAMPLE_UNITS)}, {AUTO} or an interval"
+            " such as 15m."
+        )
+
+
+def estimate_rows(session, series, ts, series_ids: list, start_time, end_time):
+    """Estimated number of rows of the densest series in a range
+
+    The latest CADENCE_SAMPLE rows of each series in the range are read with a
+    lateral join and their cadence is extrapolated over the range. Ranges with
+    fewer rows are counted exactly.
+
+    Args:
+        session: Database session
+        series: Column identifying the series, e.g. PowerData.cell_id
+        ts: Timestamp column of the same table
+        series_ids: Ids of the series
+        start_time: Start of the range, inclusive
+        end_time: End of the range, inclusive
+
+    Returns:
+        Estimated number of rows.
+    """
+
+    if not series_ids:
+        return 0
+
+    ids = values(column("id", Integer), name="ids").data([(i,) for i in series_ids])
+    sample = (
+        select(ts.label("ts"))
+        .where((series == ids.c.id) & ts.between(start_time, end_time))
+        .order_by(ts.desc())
+        .limit(CADENCE_SAMPLE)
+        .lateral("sample")
+    )
+    stmt = (
+        select(func.count(), func.min(sample.c.ts), func.max(sample.c.ts))
+        .select_from(ids.join(sample, true()))
+        .group_by(ids.c.id)
+    )
+
+    span = (end_time - start_time).total_seconds()
+    rows = 0
+    for count, first, last in session.execute(stmt):
+        if count >= CADENCE_SAMPLE and last > first:
+            count = (count - 1) * span / (last - first).total_seconds()
+        rows = max(rows, count)
+    return rows
+
+
+def auto_resample(
+    session, series, ts, series_ids: list, start_time, end_time, points: int
+) -> str:
+    """Resample level giving series about points buckets
+
+    Args:
+        session, series, ts, series_ids, start_time, end_time: See estimate_rows
+        points: Number of points of each series
+
+    Returns:
+        none when the densest series has at most points rows in the range
+        (the last month when start_time or end_time is None, like the queries),
+        otherwise the finest interval of AUTO_INTERVALS (or whole days) with at
+        most points buckets in the range.
+    """
+
+    if start_time is None:
+        start_time = datetime.utcnow() - relativedelta(months=1)
+    if end_time is None:
+        end_time = datetime.utcnow()
+
+    if estimate_rows(session, series, ts, series_ids, start_time, end_time) <= points:
+        return "none"
+
+    seconds = (end_time - start_time).total_seconds() / points
+    for width in AUTO_INTERVALS:
+        if width >= seconds:
+            return format_interval(timedelta(seconds=width))
+    return format_interval(timedelta(days=-(-seconds // 86400)))
+
+
+def bucket(resample: str, ts, origin: datetime | None = None):
+    """SQL expression of the start of the bucket containing ts
+
+    Args:
+        resample: Fixed unit or interval, see the module documentation
+        ts: Timestamp column or expression
+        origin: Origin of interval buckets, ignored for fixed units
+
+    Returns:
+        date_trunc of fixed units and date_bin of intervals.
+    """
+
+    width = parse_interval(resample)
+    if width is None:
+        return func.date_trunc(resample, ts)
+    return func.date_bin(
+        literal(width, Interval()), ts, cast(naive_origin(origin), ts.type)
+    )
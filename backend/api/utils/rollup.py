@@ -0,0 +1,308 @@
+"""Maintains the rollups of the time-series tables
+
+Rows inserted since the last run, those with an id above the watermark of
+their table, are aggregated per minute, hour and day and added to the rollups,
+see models/rollup.py. Late measurements are rolled up like any other row since
+the watermark is on the insertion order rather than on the measurement time.
+
+Ids are handed out when a row is inserted, not when its transaction commits,
+so a transaction still open can commit rows with ids below rows that are
+already visible. The watermark only advances up to ids that are settled: each
+run reads the last id handed out by the sequence of the table and the
+transactions in progress, the fence, and the ids up to it are settled once
+these transactions ended, usually by the next run. Transactions are tracked by
+their virtual transaction id, so transactions that have not written yet are
+included. This requires sequences without a per session cache (CACHE 1, the
+default), otherwise a session could hand out a cached id after the fence.
+
+Rollups are not updated when rows are deleted, rebuild them after removing
+data, e.g. with utils/dedup.py.
+
+Examples
+--------
+Roll up the new rows of all tables::
+
+    $ python -m api.utils.rollup
+
+Keep the rollups up to date, rolling up every minute::
+
+    $ python -m api.utils.rollup --interval 60
+
+Rebuild the rollups of the power_data table::
+
+    $ python -m api.utils.rollup --rebuild power
+
+Help prompt for utility::
+
+    $ python -m api.utils.rollup -h
+"""
+
+import time
+
+from sqlalchemy import delete, func, literal, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+
+from ..conn import engine
+from ..models.rollup import (
+    ROLLUP_RESOLUTIONS,
+    ROLLUP_SOURCES,
+    Rollup,
+    RollupWatermark,
+)
+
+
+def _lock_watermark(conn, name: str) -> int:
+    """Locks the watermark of a source, creating it if needed"""
+
+    conn.execute(
+        insert(RollupWatermark)
+        .values(source=name, last_id=0)
+        .on_conflict_do_nothing(index_elements=["source"])
+    )
+    return conn.execute(
+        select(RollupWatermark.last_id)
+        .where(RollupWatermark.source == name)
+        .with_for_update()
+    ).scalar()
+
+
+def _read_fence(conn, table) -> tuple:
+    """Last id handed out by the sequence of a table and the virtual ids of
+    the other transactions in progress
+
+    The sequence is read first, so a transaction holding an id up to the
+    fence is either listed or already ended.
+    """
+
+    fence_id = conn.execute(
+        text(
+            "SELECT pg_sequence_last_value("
+            "CAST(pg_get_serial_sequence(:table, 'id') AS regclass))"
+        ),
+        {"table": table.name},
+    ).scalar()
+    # only client sessions of the database insert rows
+    xids = conn.execute(
+        text(
+            "SELECT l.virtualxid FROM pg_locks l "
+            "JOIN pg_stat_activity a ON a.pid = l.pid "
+            "WHERE l.locktype = 'virtualxid' AND l.pid <> pg_backend_pid() "
+            "AND a.datname = current_database() "
+            "AND a.backend_type = 'client backend'"
+        )
+    ).scalars()
+    return fence_id or 0, list(xids)
+
+
+def _in_progress(conn, xids: list) -> bool:
+    """Checks if any of the virtual transaction ids is still in progress"""
+
+    return conn.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_locks "
+            "WHERE locktype = 'virtualxid' AND virtualxid = ANY(:xids))"
+        ),
+        {"xids": xids},
+    ).scalar()
+
+
+def _settle(conn, name: str, table) -> int:
+    """Advances the fence of a source once its transactions ended
+
+    Returns:
+        Highest id of the source whose transaction is known to be committed
+        or rolled back.
+    """
+
+    _lock_watermark(conn, name)
+    watermark = conn.execute(
+        select(
+            RollupWatermark.settled_id,
+            RollupWatermark.fence_id,
+            RollupWatermark.fence_xids,
+        ).where(RollupWatermark.source == name)
+    ).one()
+    if watermark.fence_xids and _in_progress(conn, watermark.fence_xids):
+        return watermark.settled_id
+
+    settled = max(watermark.settled_id, watermark.fence_id or 0)
+    fence_id, xids = _read_fence(conn, table)
+    if not xids:
+        # nothing in progress, every id handed out is settled
+        settled = max(settled, fence_id)
+    conn.execute(
+        update(RollupWatermark)
+        .where(RollupWatermark.source == name)
+        .values(settled_id=settled, fence_id=fence_id, fence_xids=xids)
+    )
+    return settled
+
+
+def _upper_id(conn, table, last_id: int, batch_size: int, settled: int):
+    """Highest id of the next batch, None when there are no rows to roll up"""
+
+    ids = (
+        select(table.c.id)
+        .where((table.c.id > last_id) & (table.c.id <= settled))
+        .order_by(table.c.id)
+        .limit(batch_size)
+        .subquery()
+    )
+    return conn.execute(select(func.max(ids.c.id))).scalar()
+
+
+def _add_rollups(conn, source, resolution: str, lo: int, hi: int):
+    """Adds the aggregates of the rows with ids in (lo, hi] to the rollups"""
+
+    table = source.table
+    bucket = func.date_trunc(resolution, table.c.ts)
+
+    for measurement, expr in source.measurements.items():
+        stmt = insert(Rollup).from_select(
+            [
+                "source",
+                "series_id",
+                "resolution",
+                "bucket",
+                "measurement",
+                "count",
+                "sum",
+                "min",
+                "max",
+            ],
+            select(
+                literal(source.name),
+                source.series,
+                literal(resolution),
+                bucket,
+                literal(measurement),
+                func.count(expr),
+                func.sum(expr),
+                func.min(expr),
+                func.max(expr),
+            )
+            .where((table.c.id > lo) & (table.c.id <= hi))
+            .group_by(source.series, bucket)
+            .having(func.count(expr) > 0),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[
+                "source",
+                "series_id",
+                "resolution",
+                "bucket",
+                "measurement",
+            ],
+            set_={
+                "count": Rollup.count + stmt.excluded["count"],
+                "sum": Rollup.sum + stmt.excluded["sum"],
+                "min": func.least(Rollup.min, stmt.excluded["min"]),
+                "max": func.greatest(Rollup.max, stmt.excluded["max"]),
+            },
+        )
+        conn.execute(stmt)
+
+
+def refresh(name: str, batch_size: int = 100000, eng=engine) -> int:
+    """Rolls up the new rows of a source up to the settled ids
+
+    Each batch is committed with the watermark, concurrent runs wait on the
+    lock of the watermark.
+
+    Args:
+        name: Name of the source, see models.rollup.ROLLUP_SOURCES
+        batch_size: Number of rows per batch
+        eng: SQLAlchemy engine
+
+    Returns:
+        Number of rolled up rows.
+    """
+
+    source = ROLLUP_SOURCES[name]
+    with eng.begin() as conn:
+        settled = _settle(conn, name, source.table)
+
+    rows = 0
+    while True:
+        with eng.begin() as conn:
+            last_id = _lock_watermark(conn, name)
+            upper = _upper_id(conn, source.table, last_id, batch_size, settled)
+            if upper is None:
+                return rows
+
+            rows += conn.execute(
+                select(func.count()).where(
+                    (source.table.c.id > last_id) & (source.table.c.id <= upper)
+                )
+            ).scalar()
+            for resolution in ROLLUP_RESOLUTIONS:
+                _add_rollups(conn, source, resolution, last_id, upper)
+
+            conn.execute(
+                update(RollupWatermark)
+                .where(RollupWatermark.source == name)
+                .values(last_id=upper)
+            )
+
+
+def rebuild(name: str, batch_size: int = 100000, eng=engine) -> int:
+    """Deletes the rollups of a source and rolls up all rows again
+
+    Queries aggregate the raw rows until the rollups are rebuilt.
+
+    Returns:
+        Number of rolled up rows.
+    """
+
+    with eng.begin() as conn:
+        _lock_watermark(conn, name)
+        conn.execute(delete(Rollup).where(Rollup.source == name))
+        conn.execute(
+            update(RollupWatermark)
+            .where(RollupWatermark.source == name)
+            .values(last_id=0)
+        )
+
+    return refresh(name, batch_size=batch_size, eng=eng)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time-series rollup utility")
+    parser.add_argument(
+        "--batch-size", type=int, default=100000, help="Number of rows per batch"
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        help="Keep rolling up new rows every INTERVAL seconds",
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Rebuild the rollups from scratch"
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        default=list(ROLLUP_SOURCES),
+        help=f"Sources to roll up, any of {', '.join(ROLLUP_SOURCES)} (default: all)",
+    )
+
+    args = parser.parse_args()
+    for source in args.sources:
+        if source not in ROLLUP_SOURCES:
+            parser.error(f"invalid source: {source}")
+
+    if args.rebuild:
+        for source in args.sources:
+            rows = rebuild(source, batch_size=args.batch_size)
+            print(f"{source}: rebuilt from {rows} rows", flush=True)
+
+    while True:
+        for source in args.sources:
+            rows = refresh(source, batch_size=args.batch_size)
+            print(f"{source}: rolled up {rows} rows", flush=True)
+
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,207 @@
+"""Registry of the sensor types of protobuf measurements
+
+Maps the type of a decoded measurement to the measurements it contains and
+their units. A reading of a registered type is inserted with a single
+Sensor.add_measurements call, so adding a sensor type only requires an entry in
+SENSOR_TYPES. Power and TEROS-12 readings have their own tables and register a
+custom writer.
+
+Examples
+--------
+Insert all measurements of a decoded reading::
+
+    from api.utils.sensor_types import add_reading
+
+    obj_list = add_reading(meas)
+"""
+
+from datetime import datetime
+from typing import Callable, NamedTuple
+
+from ..models.power_data import PowerData
+from ..models.sensor import Sensor
+from ..models.teros_data import TEROSData
+
+
+class SensorType(NamedTuple):
+    """Sensor type of a reading
+
+    Attributes:
+        name: Type of the reading, meas["type"]
+        measurements: Tuple of (measurement name, unit) in the reading
+        add: Function writing a reading, add(meas, sensor_type, commit)
+            returning the list of created objects
+    """
+
+    name: str
+    measurements: tuple
+    add: Callable
+
+
+def add_sensor_data(meas: dict, sensor_type: SensorType, commit: bool) -> list:
+    """Writes a reading to the generic sensor and data tables"""
+
+    return Sensor.add_measurements(meas, sensor_type.measurements, commit=commit)
+
+
+def add_power_data(meas: dict, sensor_type: SensorType, commit: bool) -> list:
+    """Writes a power reading to the power_data table"""
+
+    obj = PowerData.add_protobuf_power_data(
+        meas["loggerId"],
+        meas["cellId"],
+        datetime.fromtimestamp(meas["ts"]),
+        meas["data"]["voltage"],
+        meas["data"]["current"],
+        commit=commit,
+    )
+    return [obj]
+
+
+def add_teros12_data(meas: dict, sensor_type: SensorType, commit: bool) -> list:
+    """Writes a TEROS-12 reading to the teros_data table"""
+
+    obj = TEROSData.add_protobuf_teros_data(
+        meas["cellId"],
+        datetime.fromtimestamp(meas["ts"]),
+        meas["data"]["vwcAdj"],
+        meas["data"]["vwcRaw"],
+        meas["data"]["temp"],
+        meas["data"]["ec"],
+        None,
+        commit=commit,
+    )
+    return [obj]
+
+
+# type: ((measurement, unit), ...), the writer defaults to add_sensor_data
+_SPECS = {
+    "power": ((("voltage", "V"), ("current", "A")), add_power_data),
+    "teros12": (
+        (("vwcAdj", "%"), ("vwcRaw", ""), ("temp", "C"), ("ec", "uS/cm")),
+        add_teros12_data,
+    ),
+    "phytos31": (("voltage", "V"), ("leafWetness", "?")),
+    "bme280": (("pressure", "hPa"), ("temperature", "C"), ("humidity", "%")),
+    "teros21": (("matricPot", "kPa"), ("temp", "C")),
+    "co2": (("CO2", "PPM"), ("state", "Boolean"), ("Photoresistivity", "Ohms")),
+    "pcap02": (("Capacitance", "Farads"),),
+    # water pressure
+    "sen0257": (("pressure", "kPa"), ("voltage", "V")),
+    # soil humidity
+    "sen0308": (("voltage", "V"), ("humidity", "%")),
+    # water flow
+    "yfs210c": (("flow", "L/Min"),),
+    "D10": (("flow", "G/Min"),),
+}
+
+
+def _compile(specs: dict) -> dict:
+    types = {}
+    for name, spec in specs.items():
+        if callable(spec[-1]):
+            measurements, add = spec
+        else:
+            measurements, add = spec, add_sensor_data
+        types[name] = SensorType(name, tuple(measurements), add)
+    return types
+
+
+SENSOR_TYPES = _compile(_SPECS)
+
+
+def generic_readings(measurements: list) -> list:
+    """Groups generic measurements into readings
+
+    Generic (f_port 2) measurements carry their own name and unit. Those with
+    the same type, cell, logger and timestamp are grouped into one reading so
+    they are inserted with a single add_sensor_data call.
+
+    Args:
+        measurements: Measurements in protojson format, see
+            ents.proto.sensor.parse_sensor_measurement
+
+    Returns:
+        List of (measurement dictionary, SensorType) tuples.
+
+    Raises:
+        ValueError: When a measurement has no value.
+    """
+
+    readings = {}
+    for m in measurements:
+        if "unsignedInt" in m:
+            value = m["unsignedInt"]
+        elif "signedInt" in m:
+            value = m["signedInt"]
+        elif "decimal" in m:
+            value = m["decimal"]
+        else:
+            raise ValueError("No valid measurement value found")
+
+        meta = m["meta"]
+        key = (m["type"], meta["cellId"], meta["loggerId"], meta["ts"])
+        if key not in readings:
+            # format a compatible dict
+            meas_dict = {
+                "type": m["type"],
+                "loggerId": meta["loggerId"],
+                "cellId": meta["cellId"],
+                "ts": meta["ts"],
+                "data": {},
+                "data_type": {},
+            }
+            readings[key] = (meas_dict, [])
+
+        meas_dict, units = readings[key]
+        if m["name"] not in meas_dict["data"]:
+            units.append((m["name"], m["unit"]))
+        meas_dict["data"][m["name"]] = value
+        meas_dict["data_type"][m["name"]] = type(value)
+
+    return [
+        (meas_dict, SensorType(meas_dict["type"], tuple(units), add_sensor_data))
+        for meas_dict, units in readings.values()
+    ]
+
+
+def check_reading(meas: dict):
+    """Checks that a decoded reading can be inserted with add_reading
+
+    Only the fields read by the writer of its type are checked, the database
+    is not queried.
+
+    Raises:
+        KeyError: A field or measurement of the reading is missing.
+        TypeError: A field has the wrong type.
+        ValueError: The timestamp is out of range.
+    """
+
+    sensor_type = SENSOR_TYPES.get(meas["type"])
+    if sensor_type is None:
+        return
+    hash(meas["cellId"])
+    if sensor_type.add is add_power_data:
+        hash(meas["loggerId"])
+    datetime.fromtimestamp(meas["ts"])
+    for name, _ in sensor_type.measurements:
+        meas["data"][name]
+
+
+def add_reading(meas: dict, commit: bool = True) -> list:
+    """Inserts all measurements of a decoded reading
+
+    Args:
+        meas: Measurement dictionary
+        commit: Commit the reading. When False the rows are only added to the
+            session and the caller is responsible for the commit.
+
+    Returns:
+        List of created objects, failed inserts are represented by None. Empty
+        for unknown sensor types.
+    """
+
+    sensor_type = SENSOR_TYPES.get(meas["type"])
+    if sensor_type is None:
+        return []
+    return sensor_type.add(meas, sensor_type, commit)
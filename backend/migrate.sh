@@ -13,7 +13,7 @@
 # flask --app api db downgrade <version> -d ./api/migrations
 # flask --app api db check -d ./api/migrations
 
-USAGE="script usage: $(basename $0) [-u] [-m <msg>] [-d <ver>] [-c] [-v] [-h]"
+USAGE="script usage: $(basename $0) [-u] [-m <msg>] [-d <ver>] [-c] [-v] [-i] [-h]"
 
 if [ "$#" -eq 0 ]; then
 	echo $USAGE
@@ -21,7 +21,7 @@ if [ "$#" -eq 0 ]; then
 fi
 
 
-while getopts 'um:d:chv' FLAG
+while getopts 'um:d:chvi' FLAG
 do
     case "$FLAG" in
 		u)
@@ -54,6 +54,10 @@ do
 			# Version
 			flask --app api db current -d ./api/migrations 
 			;;
+		i)
+			# Reports index usage of the time-series tables
+			python -m api.utils.index_audit
+			;;
 		?)
 			# Invalid flag
 			echo $USAGE >&2
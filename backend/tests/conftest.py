@@ -6,8 +6,9 @@ from flask import has_app_context
 
 from api import create_app, db
 from api.models.user import User
-from api.models.cell import Cell
-from api.models.sensor import Sensor
+from api.models.cell import Cell, cell_cache
+from api.models.logger import logger_cache
+from api.models.sensor import Sensor, sensor_registry
 from api.models.data import Data
 
 import logging
@@ -117,6 +118,9 @@ def test_client(db_conn):
             if os.getenv("TEST_SQLALCHEMY_DATABASE_URI"):
                 db.drop_all()
                 db.create_all()
+                sensor_registry.clear()
+                cell_cache.clear()
+                logger_cache.clear()
             yield testing_client
 
 
@@ -129,6 +133,10 @@ def init_database(test_client):
     db.drop_all()
     # Create the database and the database table
     db.create_all()
+    # ids are reused after the tables are recreated
+    sensor_registry.clear()
+    cell_cache.clear()
+    logger_cache.clear()
 
     # FIXME:
     # refactor later for support of cells
@@ -162,6 +170,7 @@ def clear_data(test_client):
     db.session.query(Data).delete()
     db.session.query(Sensor).delete()
     db.session.commit()
+    sensor_registry.clear()
 
     yield test_client
 
@@ -0,0 +1,107 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+from api import db
+from api.models.cell import Cell
+from api.models.teros_data import TEROSData
+from api.utils.bigint_ids import id_headroom, id_type, migrate
+from api.utils.bulk_write import copy_rows
+from api.utils.partition import ensure_partitions
+
+# state of a table created before bigint ids, like the migration widening them
+LEGACY_IDS = [
+    "ALTER TABLE teros_data ALTER COLUMN id TYPE integer",
+    "ALTER SEQUENCE teros_data_id_seq AS integer",
+    "ALTER TABLE teros_data ADD COLUMN id_big bigint",
+    "CREATE OR REPLACE FUNCTION copy_id_to_id_big() RETURNS trigger "
+    "LANGUAGE plpgsql AS $$ BEGIN NEW.id_big := NEW.id; RETURN NEW; END $$",
+    "CREATE TRIGGER teros_data_id_big BEFORE INSERT OR UPDATE ON teros_data "
+    "FOR EACH ROW EXECUTE FUNCTION copy_id_to_id_big()",
+]
+
+
+def teros_rows(cell_id, month):
+    return [
+        (cell_id, datetime(2024, month, day), 0.25, 1.0, 20.0, 4, None)
+        for day in range(1, 6)
+    ]
+
+
+@pytest.fixture(scope="module")
+def cell_id(init_database):
+    cell = Cell("cell_bigint")
+    cell.save()
+    copy_rows(db.session, "teros_data", teros_rows(cell.id, 1))
+    db.session.commit()
+    ensure_partitions("teros_data", [datetime(2024, 1, 1)], eng=db.engine)
+
+    with db.engine.begin() as conn:
+        for stmt in LEGACY_IDS:
+            conn.execute(text(stmt))
+    return cell.id
+
+
+def test_migrate_widens_ids(init_database, cell_id):
+    # written through the trigger, rows of the default partition
+    copy_rows(db.session, "teros_data", teros_rows(cell_id, 6))
+    db.session.commit()
+    assert id_type(db.session, "teros_data") == "integer"
+    ids = db.session.execute(
+        text("SELECT id, ts FROM teros_data ORDER BY id")
+    ).fetchall()
+    db.session.commit()
+
+    assert migrate("teros_data", batch_size=2, eng=db.engine) == 5
+
+    assert id_type(db.session, "teros_data") == "bigint"
+    assert (
+        db.session.execute(text("SELECT id, ts FROM teros_data ORDER BY id")).fetchall()
+        == ids
+    )
+    primary_keys = db.session.execute(
+        text(
+            "SELECT conrelid::regclass::text, pg_get_constraintdef(oid) "
+            "FROM pg_constraint WHERE contype = 'p' "
+            "AND conrelid::regclass::text LIKE 'teros_data%' ORDER BY 1"
+        )
+    ).fetchall()
+    assert primary_keys == [
+        ("teros_data", "PRIMARY KEY (id, ts)"),
+        ("teros_data_default", "PRIMARY KEY (id, ts)"),
+        ("teros_data_p202401", "PRIMARY KEY (id, ts)"),
+    ]
+    # indexes including the id are rebuilt on the bigint id
+    assert (
+        db.session.execute(
+            text("SELECT indexdef FROM pg_indexes WHERE indexname = :name"),
+            {"name": "idx_teros_data_cell_id_ts"},
+        )
+        .scalar()
+        .endswith("(cell_id, ts) INCLUDE (id, vwc, raw_vwc, temp, ec)")
+    )
+
+    # ids continue past the integer range
+    db.session.execute(text("SELECT setval('teros_data_id_seq', 2147483648)"))
+    TEROSData.add_teros_data(
+        "cell_bigint", datetime(2024, 1, 10), 0.25, 1.0, 20.0, 4, None
+    )
+    assert TEROSData.query.filter_by(ts=datetime(2024, 1, 10)).one().id == 2**31 + 1
+
+
+def test_id_headroom(init_database, cell_id):
+    headroom = id_headroom(db.session, "data")
+    assert headroom["type"] == "bigint"
+    assert headroom["max_id"] == 2**63 - 1
+
+    db.session.execute(text("ALTER SEQUENCE data_id_seq AS integer"))
+    db.session.execute(text("SELECT setval('data_id_seq', 2147483547)"))
+    db.session.commit()
+    assert id_headroom(db.session, "data")["remaining"] == 100
+
+    resp = init_database.get("/api/health/ids")
+    assert resp.status_code == 503
+    assert resp.json["healthy"] is False
+    assert resp.json["tables"]["data"]["remaining"] == 100
+    assert resp.json["tables"]["power_data"]["used"] == 0
@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from api import db
+from api.models.cell import Cell
+from api.models.data import Data
+from api.models.logger import Logger
+from api.models.power_data import PowerData
+from api.models.sensor import Sensor
+from api.models.teros_data import TEROSData
+from api.utils.bulk_write import copy_pending, copy_rows
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_copy_rows_round_trip(init_database, binary):
+    cell = Cell(f"cell_copy_rows_{binary}")
+    cell.save()
+    logger = Logger(f"logger_copy_rows_{binary}")
+    logger.save()
+    sensor = Sensor(name="bulk", measurement="text", data_type="text", cell_id=cell.id)
+    db.session.add(sensor)
+    db.session.commit()
+
+    ts = datetime(2023, 7, 8, 20, 0, 0, 123456)
+
+    assert copy_rows(
+        db.session,
+        "power_data",
+        [(logger.id, cell.id, ts, 0.5, 1.25)],
+        binary=binary,
+    )
+    assert copy_rows(
+        db.session,
+        "teros_data",
+        [(cell.id, ts, 30.5, None, 18.7, 246.6, None)],
+        binary=binary,
+    )
+    n = copy_rows(
+        db.session,
+        "data",
+        [
+            (sensor.id, ts, None, None, "tab\there\nback\\slash"),
+            (sensor.id, ts, None, 7, None),
+        ],
+        binary=binary,
+    )
+    assert n == 2
+    db.session.commit()
+
+    power = PowerData.query.filter_by(cell_id=cell.id).one()
+    assert (power.logger_id, power.ts, power.current, power.voltage) == (
+        logger.id,
+        ts,
+        0.5,
+        1.25,
+    )
+    assert power.ts_server is not None
+
+    teros = TEROSData.query.filter_by(cell_id=cell.id).one()
+    assert teros.raw_vwc is None
+    assert teros.water_pot is None
+    assert teros.temp == 18.7
+    # floats are rounded like an insert would
+    assert teros.ec == 247
+
+    data = Data.query.filter_by(sensor_id=sensor.id).order_by(Data.id).all()
+    assert data[0].text_val == "tab\there\nback\\slash"
+    assert data[1].int_val == 7
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_copy_rows_aware_timestamps(init_database, binary):
+    cell = Cell(f"cell_copy_aware_{binary}")
+    cell.save()
+    logger = Logger(f"logger_copy_aware_{binary}")
+    logger.save()
+
+    # converted to UTC rather than dropping the offset
+    ts = datetime(2023, 7, 8, 22, tzinfo=timezone(timedelta(hours=2)))
+    copy_rows(
+        db.session, "power_data", [(logger.id, cell.id, ts, 0.5, 1.25)], binary=binary
+    )
+    db.session.commit()
+
+    power = PowerData.query.filter_by(cell_id=cell.id).one()
+    assert power.ts == datetime(2023, 7, 8, 20)
+
+
+def test_copy_pending(init_database):
+    cell = Cell("cell_copy_pending")
+    cell.save()
+    ts = datetime(2023, 7, 8, 21, 0, 0)
+
+    db.session.add(TEROSData(cell_id=cell.id, ts=ts, vwc=1.0, temp=2.0, ec=3))
+    db.session.add(TEROSData(cell_id=cell.id, ts=ts, vwc=4.0, temp=5.0, ec=6))
+    # non time-series objects are left to the regular flush
+    other = Cell("cell_copy_pending_other")
+    db.session.add(other)
+
+    assert copy_pending(db.session) == 2
+    assert list(db.session.new) == [other]
+    db.session.commit()
+
+    assert TEROSData.query.filter_by(cell_id=cell.id).count() == 2
+    assert Cell.query.filter_by(name="cell_copy_pending_other").one()
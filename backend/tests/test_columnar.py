@@ -0,0 +1,320 @@
+import calendar
+import json
+import math
+import struct
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pyarrow as pa
+import pytest
+
+from api import db
+from api.models.cell import Cell
+from api.models.logger import Logger
+from api.models.sensor import Sensor
+from api.utils.bulk_write import copy_rows
+from api.utils.columnar import (
+    ARROW_MIMETYPE,
+    COLUMNAR_MIMETYPE,
+    encode_arrow,
+    encode_columnar,
+)
+
+START = datetime(2024, 1, 1)
+
+URLS = [
+    "/api/power/{cell_id}?resample=none",
+    "/api/teros/{cell_id}?resample=hour",
+    "/api/sensor/?cellId={cell_id}&name=columnar&measurement=temp&resample=none",
+]
+
+
+def decode(buf: bytes) -> dict:
+    """Decodes the columnar format like a client"""
+
+    (header_len,) = struct.unpack_from("<I", buf)
+    header = json.loads(buf[4 : 4 + header_len])
+    assert (4 + header_len) % 8 == 0
+
+    data = dict(header["meta"])
+    offset = 4 + header_len
+    for col in header["columns"]:
+        values = array("q" if col["type"] == "int64" else "d")
+        values.frombytes(buf[offset : offset + header["length"] * 8])
+        data[col["name"]] = values.tolist()
+        offset += header["length"] * 8
+    assert offset == len(buf)
+    return data
+
+
+def split(data: dict) -> dict:
+    """Splits decoded columns of multiple series by the series list"""
+
+    series = {}
+    offset = 0
+    for entry in data.pop("series"):
+        end = offset + entry["length"]
+        series[entry["key"]] = {
+            **entry["meta"],
+            **{name: values[offset:end] for name, values in data.items()},
+        }
+        offset = end
+    return series
+
+
+def http_ms(values):
+    """Milliseconds since the epoch of json timestamps"""
+
+    return [
+        calendar.timegm(time.strptime(v, "%a, %d %b %Y %H:%M:%S GMT")) * 1000
+        for v in values
+    ]
+
+
+@pytest.fixture(scope="module")
+def cell_id(init_database):
+    cell = Cell("cell_columnar")
+    cell.save()
+    logger = Logger("logger_columnar")
+    logger.save()
+    sensor = Sensor(
+        cell_id=cell.id,
+        name="columnar",
+        measurement="temp",
+        unit="C",
+        data_type="float",
+    )
+    sensor.save()
+
+    ts = [START + timedelta(minutes=i) for i in range(10)]
+    copy_rows(
+        db.session,
+        "power_data",
+        [(logger.id, cell.id, t, 0.5, 3.3) for t in ts],
+    )
+    copy_rows(
+        db.session,
+        "teros_data",
+        [(cell.id, t, 0.25, 1.0, 20.0, 4, None) for t in ts],
+    )
+    copy_rows(
+        db.session,
+        "data",
+        [
+            (sensor.id, t, None if i == 3 else 21.5, None, None)
+            for i, t in enumerate(ts)
+        ],
+    )
+    db.session.commit()
+    return cell.id
+
+
+@pytest.fixture(scope="module")
+def other_cell_id(init_database, cell_id):
+    """Cell with fewer rows and a text sensor"""
+
+    cell = Cell("cell_columnar_other")
+    cell.save()
+    logger = Logger.query.filter_by(name="logger_columnar").one()
+    sensor = Sensor(
+        cell_id=cell.id,
+        name="columnar_text",
+        measurement="note",
+        unit="",
+        data_type="text",
+    )
+    sensor.save()
+    Sensor(
+        cell_id=cell.id,
+        name="columnar_text",
+        measurement="temp",
+        unit="C",
+        data_type="float",
+    ).save()
+
+    ts = [START + timedelta(minutes=i) for i in range(3)]
+    copy_rows(
+        db.session,
+        "power_data",
+        [(logger.id, cell.id, t, 0.25, 1.5) for t in ts],
+    )
+    copy_rows(
+        db.session,
+        "teros_data",
+        [(cell.id, t, 0.5, 1.0, 21.0, 4, None) for t in ts],
+    )
+    copy_rows(
+        db.session,
+        "data",
+        [(sensor.id, t, None, None, f"note {i}") for i, t in enumerate(ts)],
+    )
+    db.session.commit()
+    return cell.id
+
+
+def test_encode_columnar():
+    data = {
+        "timestamp": [datetime(1970, 1, 1, 0, 0, 1, 500000), START],
+        "data": [1.5, None],
+        "unit": "C",
+    }
+
+    decoded = decode(encode_columnar(data))
+
+    assert decoded["timestamp"] == [1500, 1704067200000]
+    assert decoded["data"][0] == 1.5
+    assert math.isnan(decoded["data"][1])
+    assert decoded["unit"] == "C"
+
+    aware = {
+        "timestamp": [datetime(2024, 1, 1, 1, tzinfo=timezone(timedelta(hours=1)))]
+    }
+    assert decode(encode_columnar(aware))["timestamp"] == [1704067200000]
+
+    # numeric columns are returned as Decimal
+    numeric = {"timestamp": [START], "v": [Decimal("2.5")]}
+    assert decode(encode_columnar(numeric))["v"] == [2.5]
+
+
+def test_encode_arrow():
+    data = {
+        "timestamp": [datetime(1970, 1, 1, 0, 0, 1, 500000), START],
+        "data": [1.5, None],
+        "unit": "C",
+    }
+
+    table = pa.ipc.open_stream(encode_arrow(data)).read_all()
+
+    assert table.schema.field("timestamp").type == pa.timestamp("ms", tz="UTC")
+    assert table.column("timestamp").cast(pa.int64()).to_pylist() == [
+        1500,
+        1704067200000,
+    ]
+    assert table.column("data").to_pylist() == [1.5, None]
+    assert json.loads(table.schema.metadata[b"meta"]) == {"unit": "C"}
+
+
+def timeseries_url(url, cell_id):
+    url = url.format(cell_id=cell_id)
+    url += "&startTime=Mon, 01 Jan 2024 00:00:00 GMT"
+    return url + "&endTime=Tue, 02 Jan 2024 00:00:00 GMT"
+
+
+@pytest.mark.parametrize("url", URLS)
+def test_columnar_matches_json(init_database, cell_id, url):
+    url = timeseries_url(url, cell_id)
+
+    json_resp = init_database.get(url)
+    resp = init_database.get(url, headers={"Accept": COLUMNAR_MIMETYPE})
+
+    assert json_resp.mimetype == "application/json"
+    assert resp.mimetype == COLUMNAR_MIMETYPE
+    assert "Accept" in resp.headers["Vary"]
+
+    expected = json_resp.get_json()
+    data = decode(resp.data)
+    assert data.keys() == expected.keys()
+    for key, values in expected.items():
+        if key == "timestamp":
+            assert data[key] == http_ms(values)
+        elif isinstance(values, list):
+            assert [None if math.isnan(v) else v for v in data[key]] == values
+        else:
+            assert data[key] == values
+
+
+@pytest.mark.parametrize("url", URLS)
+def test_arrow_matches_json(init_database, cell_id, url):
+    url = timeseries_url(url, cell_id)
+
+    expected = init_database.get(url).get_json()
+    resp = init_database.get(url, headers={"Accept": ARROW_MIMETYPE})
+
+    assert resp.mimetype == ARROW_MIMETYPE
+    table = pa.ipc.open_stream(resp.data).read_all()
+    data = json.loads(table.schema.metadata[b"meta"])
+    data.update(table.to_pydict())
+    assert data.keys() == expected.keys()
+    assert data.pop("timestamp") == [
+        datetime.strptime(v, "%a, %d %b %Y %H:%M:%S GMT").replace(tzinfo=timezone.utc)
+        for v in expected.pop("timestamp")
+    ]
+    assert data == expected
+
+
+def test_json_preferred(init_database, cell_id):
+    resp = init_database.get(
+        f"/api/power/{cell_id}",
+        query_string={
+            "startTime": "Mon, 01 Jan 2024 00:00:00 GMT",
+            "endTime": "Tue, 02 Jan 2024 00:00:00 GMT",
+        },
+        headers={"Accept": f"application/json, {COLUMNAR_MIMETYPE};q=0.5"},
+    )
+    assert resp.mimetype == "application/json"
+
+
+SERIES_URLS = [
+    "/api/power/?cellIds={cell_id},{other_cell_id}&resample=none",
+    "/api/teros/?cellIds={cell_id},{other_cell_id}&resample=hour",
+    "/api/cell/{cell_id}/sensors/data?resample=none",
+]
+
+
+@pytest.mark.parametrize("url", SERIES_URLS)
+def test_columnar_series_match_json(init_database, cell_id, other_cell_id, url):
+    url = timeseries_url(url.replace("{other_cell_id}", str(other_cell_id)), cell_id)
+
+    expected = init_database.get(url).get_json()
+    resp = init_database.get(url, headers={"Accept": COLUMNAR_MIMETYPE})
+    assert resp.mimetype == COLUMNAR_MIMETYPE
+
+    series = split(decode(resp.data))
+    assert series.keys() == expected.keys()
+    for key, data in series.items():
+        assert data.keys() == expected[key].keys()
+        for name, values in expected[key].items():
+            if name == "timestamp":
+                assert data[name] == http_ms(values)
+            elif isinstance(values, list):
+                assert [None if math.isnan(v) else v for v in data[name]] == values
+            else:
+                assert data[name] == values
+
+    resp = init_database.get(url, headers={"Accept": ARROW_MIMETYPE})
+    table = pa.ipc.open_stream(resp.data).read_all()
+    data = json.loads(table.schema.metadata[b"meta"])
+    data.update(table.to_pydict())
+    data["timestamp"] = [int(ts.timestamp() * 1000) for ts in data["timestamp"]]
+    series = split(data)
+    for key, data in series.items():
+        assert data.pop("timestamp") == http_ms(expected[key].pop("timestamp"))
+        assert data == expected[key]
+
+
+def test_text_sensor(init_database, other_cell_id):
+    url = timeseries_url(
+        "/api/sensor/?cellId={cell_id}&name=columnar_text&measurement=note"
+        "&resample=none",
+        other_cell_id,
+    )
+
+    expected = init_database.get(url).get_json()
+    assert expected["data"] == ["note 0", "note 1", "note 2"]
+
+    resp = init_database.get(url, headers={"Accept": COLUMNAR_MIMETYPE})
+    assert resp.status_code == 406
+
+    resp = init_database.get(url, headers={"Accept": ARROW_MIMETYPE})
+    table = pa.ipc.open_stream(resp.data).read_all()
+    assert table.schema.field("data").type == pa.string()
+    assert table.column("data").to_pylist() == expected["data"]
+
+    # the text series does not share the column types of the numeric one
+    resp = init_database.get(
+        timeseries_url("/api/cell/{cell_id}/sensors/data?resample=none", other_cell_id),
+        headers={"Accept": ARROW_MIMETYPE},
+    )
+    assert resp.status_code == 406
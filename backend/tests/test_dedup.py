@@ -0,0 +1,176 @@
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import text
+
+from api import db
+from api.models.cell import Cell
+from api.models.data import Data
+from api.models.logger import Logger
+from api.models.power_data import PowerData
+from api.utils.bulk_write import TABLE_KEYS, copy_rows
+from api.utils.dedup import count_duplicates, create_unique_index, index_name
+
+from ents.proto import encode_power_measurement
+from ents.proto.sensor import format_sensor_measurement
+
+
+@pytest.fixture(scope="module")
+def cell_logger(init_database):
+    cell = Cell("cell_dedup")
+    cell.save()
+    logger = Logger("logger_dedup")
+    logger.save()
+    # ids since the objects are detached once the session is removed
+    return cell.id, logger.id
+
+
+@pytest.fixture
+def dedup(init_database):
+    """Creates the unique indexes and enables deduplication"""
+
+    # concurrent index builds wait for open transactions
+    db.session.commit()
+    for table in TABLE_KEYS:
+        create_unique_index(db.engine, table)
+
+    app = init_database.application
+    app.config["INGEST_DEDUP"] = True
+    yield
+    app.config["INGEST_DEDUP"] = False
+
+
+def test_create_unique_index_removes_duplicates(init_database, cell_logger):
+    cell_id, logger_id = cell_logger
+    ts = datetime(2024, 1, 1)
+    rows = [
+        (logger_id, cell_id, ts, 1.0, 1.0),
+        (logger_id, cell_id, ts, 2.0, 2.0),
+        (logger_id, cell_id, ts, 3.0, 3.0),
+        (logger_id, cell_id, datetime(2024, 1, 2), 4.0, 4.0),
+    ]
+    copy_rows(db.session, "power_data", rows)
+    db.session.commit()
+
+    assert count_duplicates(db.session, "power_data") == 2
+
+    # small batches so the duplicates span batches
+    assert create_unique_index(db.engine, "power_data", batch_size=1) == 2
+
+    kept = PowerData.query.filter_by(cell_id=cell_id, ts=ts).one()
+    assert kept.current == 1.0
+    valid = db.session.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = :name ::regclass"),
+        {"name": index_name("power_data")},
+    ).scalar()
+    assert valid
+
+    # already created
+    assert create_unique_index(db.engine, "power_data") == 0
+
+
+def test_dedup_measurement(init_database, cell_logger, dedup):
+    cell_id, logger_id = cell_logger
+    data = encode_power_measurement(1705176162, cell_id, logger_id, 3.3, 0.5)
+
+    with patch("api.resources.util.socketio") as mock_socketio:
+        resps = [
+            init_database.post(
+                "/api/sensor/",
+                data=data,
+                headers={"Content-Type": "application/octet-stream"},
+            )
+            for _ in range(2)
+        ]
+
+    # the resend is acknowledged but not inserted or sent to clients again
+    assert [r.status_code for r in resps] == [200, 200]
+    assert [r.headers["New-Rows"] for r in resps] == ["1", "0"]
+    assert [r.headers["Duplicate-Rows"] for r in resps] == ["0", "1"]
+    mock_socketio.emit.assert_called_once()
+
+    ts = datetime.fromtimestamp(1705176162)
+    assert PowerData.query.filter_by(cell_id=cell_id, ts=ts).count() == 1
+
+
+def test_dedup_generic_measurement(init_database, cell_logger, dedup):
+    cell_id, logger_id = cell_logger
+    meas = {
+        "meta": {"cellId": cell_id, "loggerId": logger_id, "ts": 1705176162},
+        "type": "POWER_VOLTAGE",
+        "decimal": 3.3,
+    }
+    data = format_sensor_measurement([meas])
+
+    with patch("api.resources.util.socketio"):
+        resps = [
+            init_database.post(
+                "/api/sensor/",
+                data=data,
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    "SensorVersion": "2",
+                },
+            )
+            for _ in range(2)
+        ]
+
+    assert [r.status_code for r in resps] == [200, 200]
+    assert [r.headers["Duplicate-Rows"] for r in resps] == ["0", "1"]
+    assert Data.query.count() == 1
+
+
+def test_dedup_batch(init_database, cell_logger, dedup):
+    cell_id, logger_id = cell_logger
+    meas = [
+        {
+            "type": "power",
+            "cellId": cell_id,
+            "loggerId": logger_id,
+            "ts": ts,
+            "data": {"voltage": 3.3, "current": 0.5},
+        }
+        for ts in (1705176200, 1705176200, 1705176201)
+    ]
+
+    with patch("api.resources.util.socketio") as mock_socketio:
+        first = init_database.post("/api/sensor_json/", json=meas).get_json()
+        # only the inserted rows are sent to clients
+        mock_socketio.emit.assert_called_once()
+        assert len(mock_socketio.emit.call_args[0][1]) == 2
+
+        mock_socketio.reset_mock()
+        second = init_database.post("/api/sensor_json/", json=meas).get_json()
+        mock_socketio.emit.assert_not_called()
+
+    assert (first["new"], first["duplicate"]) == (2, 1)
+    assert (second["new"], second["duplicate"]) == (0, 3)
+    assert second["status"] == [200, 200, 200]
+
+
+def test_orm_writes_not_deduplicated(init_database, cell_logger, dedup):
+    ts = datetime(2024, 2, 1)
+
+    # only the ingest paths skip duplicates, other writes keep their objects
+    power = PowerData.add_power_data("logger_dedup", "cell_dedup", ts, 3.3, 0.5)
+
+    assert power.id is not None
+    assert power in db.session
+    assert PowerData.query.filter_by(ts=ts).count() == 1
+
+
+def test_counts_without_dedup(init_database, cell_logger):
+    cell_id, logger_id = cell_logger
+    data = encode_power_measurement(1705176300, cell_id, logger_id, 3.3, 0.5)
+
+    with patch("api.resources.util.socketio"):
+        resp = init_database.post(
+            "/api/sensor/",
+            data=data,
+            headers={"Content-Type": "application/octet-stream"},
+        )
+
+    assert resp.status_code == 200
+    assert resp.headers["New-Rows"] == "1"
+    assert resp.headers["Duplicate-Rows"] == "0"
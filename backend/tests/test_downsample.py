@@ -0,0 +1,138 @@
+import math
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+
+import pytest
+from marshmallow import ValidationError
+
+from api import db
+from api.models.cell import Cell
+from api.models.logger import Logger
+from api.models.sensor import Sensor
+from api.models.teros_data import TEROSData
+from api.utils.bulk_write import copy_rows
+from api.utils.downsample import lttb
+
+START = datetime(2024, 1, 1)
+# one measurement per minute for a week with a single spike
+TS = [START + timedelta(minutes=i) for i in range(7 * 24 * 60)]
+SPIKE = 5000
+
+
+def value(i):
+    if i == SPIKE:
+        return 100.0
+    return math.sin(i / 500)
+
+
+@pytest.fixture(scope="module")
+def cell_id(init_database):
+    cell = Cell("cell_downsample")
+    cell.save()
+    logger = Logger("logger_downsample")
+    logger.save()
+
+    copy_rows(
+        db.session,
+        "power_data",
+        [(logger.id, cell.id, ts, value(i), 1.0) for i, ts in enumerate(TS)],
+    )
+    copy_rows(
+        db.session,
+        "teros_data",
+        [(cell.id, ts, value(i), 0.0, 20.0, 1, None) for i, ts in enumerate(TS)],
+    )
+    sensor = Sensor(
+        cell_id=cell.id,
+        name="downsample",
+        measurement="temp",
+        unit="C",
+        data_type="float",
+    )
+    sensor.save()
+    copy_rows(
+        db.session,
+        "data",
+        [(sensor.id, ts, value(i), None, None) for i, ts in enumerate(TS)],
+    )
+    db.session.commit()
+    return cell.id
+
+
+def test_lttb_keeps_spike():
+    class Row:
+        def __init__(self, ts, v):
+            self.ts = ts
+            self.v = v
+
+    rows = [Row(ts, value(i)) for i, ts in enumerate(TS)]
+    rows[10].v = None
+
+    selected = lttb(rows, 100, "v")
+
+    assert len(selected) == 100
+    assert selected[0] is rows[0]
+    assert selected[-1] is rows[-1]
+    assert rows[SPIKE] in selected
+    assert rows[10] not in selected
+    assert [r.ts for r in selected] == sorted(r.ts for r in selected)
+
+
+@pytest.mark.parametrize("method", ["m4", "lttb"])
+def test_power_downsample(init_database, cell_id, method):
+    resp = init_database.get(
+        f"/api/power/{cell_id}",
+        query_string={
+            "startTime": format_datetime(TS[0]),
+            "endTime": format_datetime(TS[-1]),
+            "downsample": method,
+            "points": 400,
+        },
+    )
+
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert 100 < len(data["timestamp"]) <= 400
+    # current is stored in amps and returned in microamps
+    assert 100.0 * 1e6 in data["i"]
+    assert data["timestamp"][0] == "Mon, 01 Jan 2024 00:00:00 GMT"
+    assert data["timestamp"][-1] == "Sun, 07 Jan 2024 23:59:00 GMT"
+
+
+def test_teros_downsample_m4(init_database, cell_id):
+    data = TEROSData.get_teros_data_obj(
+        cell_id,
+        start_time=TS[0],
+        end_time=TS[-1],
+        downsample="m4",
+        points=500,
+    )
+
+    assert len(data["timestamp"]) <= 500
+    assert data["timestamp"][0] == TS[0]
+    assert data["timestamp"][-1] == TS[-1]
+    assert max(data["vwc"]) == 100.0
+
+
+def test_sensor_downsample_m4(init_database, cell_id):
+    data = Sensor.get_sensor_data_obj(
+        "downsample",
+        cell_id,
+        "temp",
+        start_time=TS[0],
+        end_time=TS[-1],
+        downsample="m4",
+        points=100,
+    )
+
+    # first, last, min and max of 25 buckets
+    assert len(data["timestamp"]) <= 100
+    assert 100.0 in data["data"]
+    assert min(data["data"]) == min(value(i) for i in range(len(TS)))
+
+
+def test_invalid_downsample(init_database, cell_id):
+    with pytest.raises(ValidationError):
+        init_database.get(
+            f"/api/power/{cell_id}", query_string={"downsample": "average"}
+        )
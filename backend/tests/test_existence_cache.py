@@ -0,0 +1,82 @@
+from unittest.mock import patch
+
+import fakeredis
+
+from api.models.cell import Cell, cell_cache
+from api.models.logger import Logger
+from api.utils.existence_cache import ExistenceCache
+
+
+def test_existence_cache_positive_and_negative(init_database):
+    cache = ExistenceCache(Cell)
+    cell = Cell("cell_existence_cache")
+    cell.save()
+
+    assert cache.exists(cell.id)
+    assert not cache.exists(123451223)
+
+    # both results are served from the cache
+    with patch("api.utils.existence_cache.db") as mock_db:
+        assert cache.exists(cell.id)
+        assert not cache.exists(123451223)
+        mock_db.session.get.assert_not_called()
+
+
+def test_existence_cache_expires(init_database):
+    cache = ExistenceCache(Cell, negative_ttl=0)
+    assert not cache.exists(123451224)
+
+    cell = Cell("cell_existence_cache_expires")
+    cell.save()
+
+    # negative result expired immediately
+    assert not cache.exists(cell.id + 1)
+    assert cache.exists(cell.id)
+
+
+def test_existence_cache_bounded(init_database):
+    cache = ExistenceCache(Cell, maxsize=2)
+    for id in (1001, 1002, 1003):
+        cache.exists(id)
+
+    assert list(cache._entries) == [1002, 1003]
+
+
+def test_cell_cache_invalidated_on_insert_and_delete(init_database):
+    cell = Cell("cell_existence_cache_events")
+    cell.save()
+    assert cell_cache.exists(cell.id)
+
+    # a device may upload before its cell is created
+    assert not cell_cache.exists(cell.id + 1)
+    new_cell = Cell("cell_existence_cache_events_2")
+    new_cell.save()
+    assert new_cell.id == cell.id + 1
+    assert cell_cache.exists(new_cell.id)
+
+    cell.delete()
+    assert not cell_cache.exists(cell.id)
+
+
+def test_invalidations_shared_on_redis(init_database):
+    client = fakeredis.FakeRedis()
+    cell = Cell("cell_existence_cache_shared")
+    cell.save()
+
+    # caches of two workers
+    cache = ExistenceCache(Cell, client=client, poll=0)
+    other = ExistenceCache(Cell, client=client, poll=0)
+    assert cache.exists(cell.id)
+    assert other.exists(cell.id)
+
+    # invalidations of other tables are ignored
+    ExistenceCache(Logger, client=client).invalidate(cell.id)
+    with patch("api.utils.existence_cache.db") as mock_db:
+        assert cache.exists(cell.id)
+        mock_db.session.get.assert_not_called()
+
+    other.invalidate(cell.id)
+    with patch("api.utils.existence_cache.db") as mock_db:
+        mock_db.session.get.return_value = None
+        assert not cache.exists(cell.id)
+        assert not other.exists(cell.id)
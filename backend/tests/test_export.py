@@ -0,0 +1,219 @@
+import csv
+import io
+from datetime import datetime, timedelta, timezone
+
+import pyarrow.parquet as pq
+import pytest
+from marshmallow import ValidationError
+
+from api import db
+from api.models.cell import Cell
+from api.models.logger import Logger
+from api.models.sensor import Sensor
+from api.utils.bulk_write import copy_rows
+from api.utils.export import CSV_MISSING
+
+START = datetime(2024, 1, 1)
+EPOCH = int(START.replace(tzinfo=timezone.utc).timestamp())
+
+RANGE = {
+    "startTime": "Mon, 01 Jan 2024 00:00:00 GMT",
+    "endTime": "Mon, 01 Jan 2024 00:09:59 GMT",
+}
+
+
+@pytest.fixture(scope="module")
+def export_ids(init_database):
+    cell = Cell("cell_export")
+    cell.save()
+    other = Cell("cell_export_other")
+    other.save()
+    logger = Logger("logger_export")
+    logger.save()
+    sensor = Sensor(
+        name="phytos31",
+        measurement="voltage",
+        data_type="float",
+        unit="mV",
+        cell_id=other.id,
+    )
+    sensor.save()
+
+    # power every minute, teros every minute with a clock 20s late, the sensor
+    # every third minute
+    copy_rows(
+        db.session,
+        "power_data",
+        [
+            (logger.id, cell.id, START + timedelta(minutes=i), i * 1e-6, 0.5)
+            for i in range(10)
+        ],
+    )
+    copy_rows(
+        db.session,
+        "teros_data",
+        [
+            (cell.id, START + timedelta(minutes=i, seconds=20), 0.25, 1.0, i, 4, None)
+            for i in range(10)
+        ],
+    )
+    copy_rows(
+        db.session,
+        "data",
+        [
+            (sensor.id, START + timedelta(minutes=i, seconds=40), float(i), None, None)
+            for i in range(0, 10, 3)
+        ],
+    )
+    db.session.commit()
+    return cell.id, sensor.id
+
+
+def read_csv(resp):
+    return list(csv.reader(io.StringIO(resp.get_data(as_text=True))))
+
+
+def test_export_csv_aligned(init_database, export_ids):
+    cell_id, _ = export_ids
+    resp = init_database.get(
+        "/api/export/",
+        query_string={
+            "cellIds": cell_id,
+            "panels": "power-vi,temp",
+            "resample": "minute",
+            **RANGE,
+        },
+    )
+
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/csv"
+    assert resp.is_streamed
+    lines = read_csv(resp)
+    assert lines[:3] == [
+        ["timestamp", "Voltage", "Current", "Temperature"],
+        ["s", "mV", "uA", "C"],
+        ["TIME", "POWER_VOLTAGE", "POWER_CURRENT", "TEROS12_TEMP"],
+    ]
+    # the teros clock offset does not split the rows
+    assert len(lines) == 3 + 10
+    for i, (ts, v, current, temp) in enumerate(lines[3:]):
+        assert int(ts) == EPOCH + i * 60
+        assert float(v) == pytest.approx(500)
+        assert float(current) == pytest.approx(i)
+        assert float(temp) == pytest.approx(i)
+
+
+def test_export_fill(init_database, export_ids):
+    cell_id, sensor_id = export_ids
+    args = {
+        "cellIds": cell_id,
+        "panels": f"power-p,s:{sensor_id}",
+        "resample": "minute",
+        **RANGE,
+    }
+
+    def sensor_values(**fill):
+        lines = read_csv(
+            init_database.get("/api/export/", query_string={**args, **fill})
+        )
+        return [line[2] for line in lines[3:]]
+
+    lines = read_csv(init_database.get("/api/export/", query_string=args))
+    # names are prefixed by cell when the columns span multiple cells
+    assert lines[0] == ["timestamp", "cell_export Power", "cell_export_other voltage"]
+    assert lines[2][2] == "PHYTOS31"
+
+    assert sensor_values() == [
+        "0.0",
+        CSV_MISSING,
+        CSV_MISSING,
+        "3.0",
+        CSV_MISSING,
+        CSV_MISSING,
+        "6.0",
+        CSV_MISSING,
+        CSV_MISSING,
+        "9.0",
+    ]
+    assert sensor_values(fill="ffill") == [
+        "0.0",
+        "0.0",
+        "0.0",
+        "3.0",
+        "3.0",
+        "3.0",
+        "6.0",
+        "6.0",
+        "6.0",
+        "9.0",
+    ]
+    assert sensor_values(fill="ffill", tolerance="1m") == [
+        "0.0",
+        "0.0",
+        CSV_MISSING,
+        "3.0",
+        "3.0",
+        CSV_MISSING,
+        "6.0",
+        "6.0",
+        CSV_MISSING,
+        "9.0",
+    ]
+    assert sensor_values(fill="nearest") == [
+        "0.0",
+        "0.0",
+        "3.0",
+        "3.0",
+        "3.0",
+        "6.0",
+        "6.0",
+        "6.0",
+        "9.0",
+        "9.0",
+    ]
+
+
+def test_export_parquet(init_database, export_ids):
+    cell_id, _ = export_ids
+    resp = init_database.get(
+        "/api/export/",
+        query_string={
+            "cellIds": cell_id,
+            "panels": "power-vi",
+            "resample": "5m",
+            "format": "parquet",
+            **RANGE,
+        },
+    )
+
+    assert resp.status_code == 200
+    table = pq.read_table(io.BytesIO(resp.get_data()))
+    assert table.column_names == ["timestamp", "Voltage", "Current"]
+    assert table.schema.field("Current").metadata == {
+        b"unit": b"uA",
+        b"type": b"POWER_CURRENT",
+    }
+    assert table.column("Current").to_pylist() == pytest.approx([2, 7])
+    assert [
+        ts.replace(tzinfo=None) for ts in table.column("timestamp").to_pylist()
+    ] == [
+        START,
+        START + timedelta(minutes=5),
+    ]
+
+
+def test_export_invalid(init_database, export_ids):
+    cell_id, _ = export_ids
+
+    with pytest.raises(ValidationError):
+        init_database.get(
+            "/api/export/", query_string={"cellIds": cell_id, "panels": "power-x"}
+        )
+    with pytest.raises(ValidationError):
+        init_database.get(
+            "/api/export/",
+            query_string={"cellIds": cell_id, "panels": "power-p", "resample": "none"},
+        )
+
+    resp = init_database.get("/api/export/", query_string={"panels": "s:999999"})
+    assert resp.status_code == 404
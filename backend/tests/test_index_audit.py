@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, text
+
+from api import db
+from api.models.cell import Cell
+from api.models.logger import Logger
+from api.models.power_data import PowerData
+from api.utils.bulk_write import copy_rows
+from api.utils.index_audit import index_usage, write_amplification
+
+START = datetime(2024, 1, 1)
+
+
+@pytest.fixture(scope="module")
+def cell_id(init_database):
+    cell = Cell("cell_index_audit")
+    cell.save()
+    logger = Logger("logger_index_audit")
+    logger.save()
+    copy_rows(
+        db.session,
+        "power_data",
+        [
+            (logger.id, cell.id, START + timedelta(minutes=i), 1.0, 2.0)
+            for i in range(100)
+        ],
+    )
+    db.session.commit()
+
+    # sets the visibility map, so index-only scans skip the table
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM ANALYZE power_data"))
+    return cell.id
+
+
+def range_select(cell_id):
+    return select(
+        PowerData.id, PowerData.ts, PowerData.voltage, PowerData.current
+    ).where(
+        PowerData.cell_id == cell_id,
+        PowerData.ts.between(START, START + timedelta(minutes=10)),
+    )
+
+
+def test_time_range_is_index_only(init_database, cell_id):
+    stmt = range_select(cell_id)
+    sql = stmt.compile(db.engine, compile_kwargs={"literal_binds": True})
+
+    db.session.execute(text("SET LOCAL enable_seqscan = off"))
+    db.session.execute(text("SET LOCAL enable_bitmapscan = off"))
+    plan = "\n".join(db.session.execute(text(f"EXPLAIN {sql}")).scalars())
+
+    assert "Index Only Scan" in plan
+    assert len(db.session.execute(stmt).all()) == 11
+
+
+def test_index_usage(init_database, cell_id):
+    db.session.execute(text("SET LOCAL enable_seqscan = off"))
+    db.session.execute(range_select(cell_id)).all()
+    db.session.execute(text("SELECT pg_stat_force_next_flush()"))
+    db.session.commit()
+
+    with db.engine.connect() as conn:
+        indexes = {index["name"]: index for index in index_usage(conn, "power_data")}
+        stats = write_amplification(conn, "power_data")
+
+    # the ts index was dropped in favor of the covering index
+    assert set(indexes) == {
+        "idx_power_data_cell_id_ts",
+        "ix_power_data_ts_server",
+        "power_data_pkey",
+    }
+    covering = indexes["idx_power_data_cell_id_ts"]
+    assert covering["scans"] >= 1
+    assert covering["writes"] == 100
+    assert not covering["unused"]
+    assert indexes["power_data_pkey"]["unique"]
+    assert not indexes["power_data_pkey"]["unused"]
+    assert indexes["ix_power_data_ts_server"]["unused"]
+    assert 0 <= covering["bloat"] < 1
+
+    assert stats["rows_written"] == 100
+    assert stats["index_writes_per_row"] == 3
@@ -0,0 +1,211 @@
+import base64
+from unittest.mock import patch
+
+import fakeredis
+import pytest
+from sqlalchemy import text
+
+from api import db
+from api.models.cell import Cell, cell_cache
+from api.models.logger import Logger
+from api.models.power_data import PowerData
+from api.resources.util import process_measurement_batch
+from api.utils.ingest_queue import MEASUREMENT, consume, ingest_queue
+
+from ents.proto import encode_power_measurement
+
+from .test_util import _delimited
+
+
+@pytest.fixture
+def queue(init_database):
+    """Enables the ingest queue on a fake redis server"""
+
+    ingest_queue.redis = fakeredis.FakeRedis()
+    ingest_queue.create_group()
+    yield ingest_queue
+    ingest_queue.redis = None
+
+
+@pytest.fixture
+def cell_logger(init_database):
+    cell = Cell("cell_ingest_queue")
+    cell.save()
+    logger = Logger("logger_ingest_queue")
+    logger.save()
+    yield cell, logger
+    PowerData.query.filter_by(cell_id=cell.id).delete()
+    cell.delete()
+    logger.delete()
+
+
+def test_post_is_queued_and_consumed(init_database, queue, cell_logger):
+    cell, logger = cell_logger
+    data = encode_power_measurement(1705176162, cell.id, logger.id, 3.3, 0.5)
+
+    resp = init_database.post(
+        "/api/sensor/",
+        data=data,
+        headers={"Content-Type": "application/octet-stream"},
+    )
+
+    assert resp.status_code == 202
+    assert PowerData.query.filter_by(cell_id=cell.id).count() == 0
+
+    stats = init_database.get("/api/ingest/queue").get_json()
+    assert stats["enabled"]
+    assert stats["lag"] == 1
+
+    with patch("api.resources.util.socketio") as mock_socketio:
+        consume(queue, "test", block=None, once=True)
+
+    assert PowerData.query.filter_by(cell_id=cell.id).count() == 1
+    mock_socketio.emit.assert_called_once()
+
+    stats = queue.stats()
+    assert (stats["length"], stats["lag"], stats["pending"]) == (0, 0, 0)
+
+
+def test_ttn_uplink_is_queued(init_database, queue, cell_logger):
+    cell, logger = cell_logger
+    data = encode_power_measurement(1705176162, cell.id, logger.id, 3.3, 0.5)
+    uplink = {
+        "uplink_message": {
+            "f_port": 1,
+            "frm_payload": base64.b64encode(data).decode(),
+        }
+    }
+
+    resp = init_database.post("/api/sensor/", json=uplink)
+
+    assert resp.status_code == 202
+    assert queue.stats()["length"] == 1
+
+
+def test_malformed_upload_is_rejected(init_database, queue):
+    resp = init_database.post(
+        "/api/sensor/",
+        data=b"\xff\xff",
+        headers={"Content-Type": "application/octet-stream"},
+    )
+
+    assert resp.status_code == 400
+    assert queue.stats()["length"] == 0
+
+
+def test_unknown_cell_is_rejected(init_database, queue, cell_logger):
+    _, logger = cell_logger
+    data = encode_power_measurement(1705176162, 123451223, logger.id, 3.3, 0.5)
+
+    resp = init_database.post(
+        "/api/sensor/",
+        data=data,
+        headers={"Content-Type": "application/octet-stream"},
+    )
+
+    assert resp.status_code == 404
+    assert queue.stats()["length"] == 0
+
+
+def test_batch_with_unknown_cell_is_processed_inline(init_database, queue, cell_logger):
+    cell, logger = cell_logger
+    data = b"".join(
+        _delimited(encode_power_measurement(1705176162, cell_id, logger.id, 3.3, 0.5))
+        for cell_id in (cell.id, 123451223)
+    )
+
+    with patch("api.resources.util.socketio"):
+        resp = init_database.post(
+            "/api/sensor/",
+            data=data,
+            headers={"Content-Type": "application/octet-stream", "Batch": "true"},
+        )
+
+    assert resp.status_code == 200
+    assert resp.get_json()["status"] == [200, 501]
+    assert queue.stats()["length"] == 0
+    assert PowerData.query.filter_by(cell_id=cell.id).count() == 1
+
+
+def test_lag_without_xinfo_field(queue):
+    queue.enqueue(MEASUREMENT, b"")
+    queue.enqueue(MEASUREMENT, b"")
+    assert queue.stats()["lag"] == 2
+
+    # Redis < 7 does not report the lag of a group
+    groups = queue.redis.xinfo_groups(queue.stream)
+    for group in groups:
+        group.pop("lag", None)
+    with patch.object(queue.redis, "xinfo_groups", return_value=groups):
+        assert queue.stats()["lag"] == 2
+
+
+def test_failing_entry_is_retried_then_dead_lettered(queue):
+    queue.enqueue(MEASUREMENT, b"")
+
+    with patch(
+        "api.utils.ingest_queue.process_entries", side_effect=RuntimeError("db down")
+    ):
+        consume(queue, "test", block=None, max_deliveries=2, once=True)
+        # left pending for a retry
+        assert queue.stats()["pending"] == 1
+
+        consume(queue, "test", block=None, max_deliveries=2, once=True)
+
+    stats = queue.stats()
+    assert (stats["length"], stats["pending"], stats["dead"]) == (0, 0, 1)
+
+
+def test_failing_entry_does_not_fail_batch(init_database, queue, cell_logger):
+    cell, logger = cell_logger
+    queue.enqueue(
+        MEASUREMENT, encode_power_measurement(1705176170, cell.id, logger.id, 3.3, 0.5)
+    )
+    queue.enqueue(MEASUREMENT, encode_power_measurement(1705176171, 0, 0, 3.3, 0.5))
+
+    def fail_on_cell_0(meas_list):
+        if any(meas["cellId"] == 0 for meas in meas_list):
+            raise RuntimeError("constraint violated")
+        return process_measurement_batch(meas_list)
+
+    with patch("api.resources.util.socketio"), patch(
+        "api.resources.util.process_measurement_batch", side_effect=fail_on_cell_0
+    ):
+        consume(queue, "test", block=None, max_deliveries=1, once=True)
+
+    # only the failing entry is dead lettered
+    assert PowerData.query.filter_by(cell_id=cell.id).count() == 1
+    stats = queue.stats()
+    assert (stats["length"], stats["pending"], stats["dead"]) == (0, 0, 1)
+    dead = queue.redis.xrange(queue.dead_stream)
+    assert dead[0][1][b"error"] == b"constraint violated"
+
+
+def test_deleted_cell_still_cached(init_database, queue, cell_logger):
+    cell, logger = cell_logger
+    deleted = Cell("cell_ingest_queue_deleted")
+    deleted.save()
+    deleted_id = deleted.id
+    assert cell_cache.exists(deleted_id)
+    # deleted by another worker, the cache of this worker is not invalidated
+    db.session.execute(text("DELETE FROM cell WHERE id = :id"), {"id": deleted_id})
+    db.session.commit()
+    assert cell_cache.exists(deleted_id)
+
+    for cell_id in (cell.id, deleted_id):
+        queue.enqueue(
+            MEASUREMENT,
+            encode_power_measurement(1705176180, cell_id, logger.id, 3.3, 0.5),
+        )
+
+    with patch("api.resources.util.socketio"):
+        consume(queue, "test", block=None, once=True)
+
+    assert PowerData.query.filter_by(cell_id=cell.id).count() == 1
+    assert not cell_cache.exists(deleted_id)
+    stats = queue.stats()
+    assert (stats["length"], stats["pending"], stats["dead"]) == (0, 0, 0)
+
+
+def test_queue_disabled(init_database):
+    assert init_database.get("/api/ingest/queue").get_json() == {"enabled": False}
@@ -0,0 +1,91 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from api import db
+from api.models.cell import Cell
+from api.models.logger import Logger
+from api.models.sensor import Sensor
+from api.utils.bulk_write import copy_rows
+from api.utils.ndjson import NDJSON_MIMETYPE, ndjson_lines
+
+START = datetime(2024, 1, 1)
+
+RANGE = {
+    "startTime": "Mon, 01 Jan 2024 00:00:00 GMT",
+    "endTime": "Tue, 02 Jan 2024 00:00:00 GMT",
+}
+
+
+@pytest.fixture(scope="module")
+def cell_id(init_database):
+    cell = Cell("cell_ndjson")
+    cell.save()
+    logger = Logger("logger_ndjson")
+    logger.save()
+
+    ts = [START + timedelta(minutes=i) for i in range(25)]
+    copy_rows(
+        db.session,
+        "power_data",
+        [(logger.id, cell.id, t, 0.5, i * 0.1) for i, t in enumerate(ts)],
+    )
+    copy_rows(
+        db.session,
+        "teros_data",
+        [(cell.id, t, 0.25, 1.0, 20.0, 4, None) for t in ts],
+    )
+    sensor = Sensor(
+        cell_id=cell.id, name="ndjson", measurement="temp", unit="C", data_type="float"
+    )
+    sensor.save()
+    copy_rows(
+        db.session,
+        "data",
+        [(sensor.id, t, i * 0.5, None, None) for i, t in enumerate(ts)],
+    )
+    db.session.commit()
+    return cell.id
+
+
+def test_ndjson_lines_chunks(init_database):
+    rows = [{"n": i} for i in range(5)]
+
+    chunks = list(ndjson_lines(iter(rows), chunk_rows=2))
+
+    assert len(chunks) == 3
+    assert all(chunk.endswith("\n") for chunk in chunks)
+    assert [json.loads(line) for line in "".join(chunks).splitlines()] == rows
+
+
+@pytest.mark.parametrize(
+    "url, resample",
+    [
+        ("/api/power/{cell_id}", "none"),
+        ("/api/power/{cell_id}", "hour"),
+        ("/api/teros/{cell_id}", "none"),
+        ("/api/sensor/", "none"),
+        ("/api/sensor/", "hour"),
+    ],
+)
+def test_ndjson_matches_json(init_database, cell_id, url, resample):
+    url = url.format(cell_id=cell_id)
+    args = {"resample": resample, **RANGE}
+    if url == "/api/sensor/":
+        args.update(cellId=cell_id, name="ndjson", measurement="temp")
+
+    expected = init_database.get(url, query_string=args).get_json()
+    resp = init_database.get(
+        url, query_string=args, headers={"Accept": NDJSON_MIMETYPE}
+    )
+
+    assert resp.mimetype == NDJSON_MIMETYPE
+    assert resp.is_streamed
+    assert "Accept" in resp.headers["Vary"]
+
+    rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert len(rows) == len(expected["timestamp"])
+    for key, values in expected.items():
+        if isinstance(values, list):
+            assert [row[key] for row in rows] == values
@@ -0,0 +1,123 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select, text
+
+from api import db
+from api.models.cell import Cell
+from api.models.logger import Logger
+from api.models.power_data import PowerData
+from api.utils.bulk_write import copy_rows
+from api.utils.partition import (
+    create_partition,
+    drop_partitions,
+    ensure_partitions,
+    partition_months,
+    partitioned_table,
+)
+
+MONTHS = [datetime(2024, 1, 1), datetime(2024, 2, 1), datetime(2024, 3, 1)]
+
+
+@pytest.fixture(scope="module")
+def cell_id(init_database):
+    cell = Cell("cell_partition")
+    cell.save()
+    logger = Logger("logger_partition")
+    logger.save()
+
+    copy_rows(
+        db.session,
+        "power_data",
+        [
+            (logger.id, cell.id, datetime(2024, month, 15), 1.0, 2.0)
+            for month in (1, 2, 3)
+        ],
+    )
+    db.session.commit()
+    return cell.id
+
+
+def rows_of(partition: str) -> int:
+    return db.session.execute(text(f"SELECT count(*) FROM {partition}")).scalar()
+
+
+def test_ensure_partitions_moves_default_rows(init_database, cell_id):
+    assert partitioned_table(db.session, "power_data") == "power_data"
+    assert rows_of("power_data_default") == 3
+    db.session.commit()
+
+    created = ensure_partitions("power_data", MONTHS, eng=db.engine)
+
+    assert created == ["power_data_p202401", "power_data_p202402", "power_data_p202403"]
+    assert rows_of("power_data_default") == 0
+    assert rows_of("power_data_p202402") == 1
+    assert PowerData.query.filter_by(cell_id=cell_id).count() == 3
+
+    # already created
+    db.session.commit()
+    assert ensure_partitions("power_data", MONTHS, eng=db.engine) == []
+
+
+def test_queries_prune_partitions(init_database, cell_id):
+    db.session.commit()
+    ensure_partitions("power_data", MONTHS, eng=db.engine)
+
+    stmt = select(PowerData.id).where(
+        PowerData.ts.between(datetime(2024, 2, 1), datetime(2024, 2, 20))
+    )
+    sql = stmt.compile(db.engine, compile_kwargs={"literal_binds": True})
+    plan = "\n".join(db.session.execute(text(f"EXPLAIN {sql}")).scalars())
+
+    assert "power_data_p202402" in plan
+    assert "power_data_p202401" not in plan
+    assert "power_data_default" not in plan
+
+
+def test_drop_partitions(init_database, cell_id):
+    db.session.commit()
+    ensure_partitions("power_data", MONTHS, eng=db.engine)
+
+    dropped = drop_partitions("power_data", datetime(2024, 3, 1), eng=db.engine)
+
+    assert dropped == ["power_data_p202401", "power_data_p202402"]
+    assert list(partition_months(db.session, "power_data", "power_data")) == [
+        datetime(2024, 3, 1)
+    ]
+    assert PowerData.query.filter_by(cell_id=cell_id).count() == 1
+
+
+def test_create_partition_resumes_move(init_database, cell_id):
+    april = datetime(2024, 4, 1)
+    copy_rows(
+        db.session,
+        "power_data",
+        [(None, cell_id, datetime(2024, 4, day), float(day), 2.0) for day in (1, 2, 3)],
+    )
+    # a run interrupted after moving one row
+    db.session.execute(
+        text(
+            "CREATE TABLE power_data_p202404 "
+            "(LIKE power_data INCLUDING ALL EXCLUDING DEFAULTS)"
+        )
+    )
+    db.session.execute(
+        text(
+            "WITH moved AS (DELETE FROM power_data_default WHERE id = "
+            "(SELECT min(id) FROM power_data_default WHERE ts >= '2024-04-01') "
+            "RETURNING *) INSERT INTO power_data_p202404 SELECT * FROM moved"
+        )
+    )
+    db.session.commit()
+    assert april not in partition_months(db.session, "power_data", "power_data")
+    db.session.commit()
+
+    name = create_partition(
+        "power_data", "power_data", april, batch_size=1, eng=db.engine
+    )
+
+    assert name == "power_data_p202404"
+    assert april in partition_months(db.session, "power_data", "power_data")
+    assert rows_of("power_data_default") == 0
+    assert rows_of("power_data_p202404") == 3
+    assert PowerData.query.filter(PowerData.ts >= april).count() == 3
@@ -1,8 +1,18 @@
 from api.models.power_data import PowerData
 from api.models.cell import Cell
 from api.models.logger import Logger
+import api.utils.pagination
+import api.utils.resample
+import statistics
 from datetime import datetime
 
+import pytest
+from marshmallow import ValidationError
+from sqlalchemy import text
+
+from api import db
+from api.utils.pagination import decode_stream_cursor
+
 
 def test_new_power_data(init_database):
     """
@@ -170,3 +180,383 @@ def test_new_power_protobuf_data(init_database):
     assert datetime.timestamp(power_data.ts) == 1705176162
     assert 3 == power_data.voltage
     assert 4 == power_data.current
+
+
+def test_get_power_cells(init_database):
+    """
+    GIVEN multiple cells with Power Data
+    WHEN Power Data of the cells is requested at once
+    THEN check the data of each cell matches a single cell request
+    """
+    ts = datetime(2024, 1, 13, 12)
+    cells = []
+    for i in range(3):
+        cell = Cell(f"cell_multi_{i}", "", 1, 1, False, None)
+        cell.save()
+        cells.append(cell.id)
+        for minute in range(i * 5):
+            PowerData.add_power_data(
+                "logger_1",
+                f"cell_multi_{i}",
+                ts.replace(minute=minute),
+                i,
+                minute,
+            )
+
+    end = ts.replace(hour=13)
+    for resample in ["none", "minute", "hour"]:
+        data = PowerData.get_power_data_cells(cells, resample, ts, end)
+        assert list(data) == cells
+        for cell_id in cells:
+            assert data[cell_id] == PowerData.get_power_data_obj(
+                cell_id, resample, ts, end
+            )
+    assert data[cells[0]]["timestamp"] == []
+
+    # downsampled per cell
+    data = PowerData.get_power_data_cells(
+        cells, "none", ts, end, downsample="lttb", points=4
+    )
+    assert [len(data[cell_id]["timestamp"]) for cell_id in cells] == [0, 4, 4]
+    data = PowerData.get_power_data_cells(
+        cells, "none", ts, end, downsample="m4", points=8
+    )
+    # a single bucket, values are increasing so the first and last rows are kept
+    assert [len(data[cell_id]["timestamp"]) for cell_id in cells] == [0, 2, 2]
+
+
+def test_get_power_cell_ids_endpoint(init_database):
+    """
+    GIVEN multiple cells with Power Data
+    WHEN the cellIds query argument is used
+    THEN check the response is keyed by cell id
+    """
+    ts = datetime(2024, 1, 13, 12)
+    cells = []
+    for i in range(2):
+        cell = Cell(f"cell_ids_{i}", "", 1, 1, False, None)
+        cell.save()
+        cells.append(cell.id)
+        PowerData.add_power_data("logger_1", f"cell_ids_{i}", ts, i + 1, 2)
+
+    resp = init_database.get(
+        "/api/power/",
+        query_string={
+            "cellIds": ",".join(map(str, cells)),
+            "resample": "none",
+            "startTime": "Sat, 13 Jan 2024 00:00:00 GMT",
+            "endTime": "Sun, 14 Jan 2024 00:00:00 GMT",
+        },
+    )
+    data = resp.get_json()
+    assert list(data) == [str(cell_id) for cell_id in cells]
+    assert data[str(cells[0])]["v"] == [1e3]
+    assert data[str(cells[1])]["v"] == [2e3]
+
+
+def test_get_power_obj_after_cursor(init_database, monkeypatch):
+    """
+    GIVEN streamed Power Data with a cursor
+    WHEN Power Data is requested after the cursor
+    THEN check only rows inserted since are returned with the next cursor
+    """
+    # rows are streamed right after they are inserted
+    monkeypatch.setattr(api.utils.pagination, "STREAM_LAG", 0)
+    ts = datetime(2024, 1, 13, 12)
+    end = ts.replace(hour=13)
+    cell = Cell("cell_cursor", "", 1, 1, False, None)
+    cell.save()
+    PowerData.add_power_data("logger_1", "cell_cursor", ts, 1, 2)
+
+    data = PowerData.get_power_data_obj(cell.id, "none", ts, end, True)
+    assert data["v"] == [1e3]
+    cursor = data["cursor"]
+
+    data = PowerData.get_power_data_obj(cell.id, "none", ts, end, True, after=cursor)
+    assert data["v"] == []
+    assert data["cursor"] == cursor
+
+    PowerData.add_power_data("logger_1", "cell_cursor", ts.replace(minute=1), 2, 2)
+    PowerData.add_power_data("logger_1", "cell_cursor", ts.replace(minute=2), 3, 2)
+    resp = init_database.get(
+        f"/api/power/{cell.id}",
+        query_string={
+            "after": cursor,
+            "startTime": "Sat, 13 Jan 2024 00:00:00 GMT",
+            "endTime": "Sun, 14 Jan 2024 00:00:00 GMT",
+        },
+    )
+    data = resp.get_json()
+    assert data["v"] == [2e3, 3e3]
+    assert decode_stream_cursor(data["cursor"]) > decode_stream_cursor(cursor)
+
+
+def test_get_power_obj_after_cursor_late_commit(init_database, monkeypatch):
+    """
+    GIVEN a row committed after a poll by a transaction started before it
+    WHEN Power Data is requested after the cursor of the poll
+    THEN check the row is returned by the next poll
+    """
+    ts = datetime(2024, 1, 13, 12)
+    end = ts.replace(hour=13)
+    cell = Cell("cell_cursor_late", "", 1, 1, False, None)
+    cell.save()
+    logger = Logger("logger_cursor_late", None, "")
+    logger.save()
+    cell_id, logger_id = cell.id, logger.id
+    PowerData.add_power_data("logger_cursor_late", "cell_cursor_late", ts, 1, 2)
+    db.session.execute(
+        text(
+            "UPDATE power_data SET ts_server = now() - interval '1 minute' "
+            "WHERE cell_id = :cell_id"
+        ),
+        {"cell_id": cell_id},
+    )
+    db.session.commit()
+    data = PowerData.get_power_data_obj(cell_id, "none", ts, end, True)
+    assert data["v"] == [1e3]
+    cursor = data["cursor"]
+    db.session.commit()
+
+    # a slow ingest transaction, its row has a lower id and ts_server than the
+    # row committed before it
+    with db.engine.connect() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO power_data (logger_id, cell_id, ts, voltage, current) "
+                "VALUES (:logger_id, :cell_id, :ts, 2, 2)"
+            ),
+            {"logger_id": logger_id, "cell_id": cell_id, "ts": ts.replace(minute=1)},
+        )
+        PowerData.add_power_data(
+            "logger_cursor_late", "cell_cursor_late", ts.replace(minute=2), 3, 2
+        )
+
+        # rows inserted less than STREAM_LAG seconds ago are left for later
+        data = PowerData.get_power_data_obj(
+            cell_id, "none", ts, end, True, after=cursor
+        )
+        assert data["v"] == []
+        assert data["cursor"] == cursor
+        db.session.commit()
+        conn.commit()
+
+    monkeypatch.setattr(api.utils.pagination, "STREAM_LAG", 0)
+    data = PowerData.get_power_data_obj(cell_id, "none", ts, end, True, after=cursor)
+    assert data["v"] == [2e3, 3e3]
+
+
+def test_get_power_obj_stream_without_cursor(init_database):
+    """
+    GIVEN Power Data inserted right before the request
+    WHEN it is streamed without a cursor
+    THEN check the rows are returned without waiting for STREAM_LAG
+    """
+    ts = datetime(2024, 1, 13, 12)
+    end = ts.replace(hour=13)
+    cell = Cell("cell_stream_fresh", "", 1, 1, False, None)
+    cell.save()
+    PowerData.add_power_data("logger_1", "cell_stream_fresh", ts, 1, 2)
+    PowerData.add_power_data("logger_1", "cell_stream_fresh", ts, 2, 2)
+
+    data = PowerData.get_power_data_obj(cell.id, "none", ts, end, True)
+    assert data["v"] == [1e3, 2e3]
+    assert data["cursor"] is not None
+
+
+def test_get_power_obj_pages(init_database):
+    """
+    GIVEN raw Power Data of multiple cells, some sharing a timestamp
+    WHEN it is requested in pages
+    THEN check the pages cover every row once in order
+    """
+    ts = datetime(2024, 1, 13, 12)
+    end = ts.replace(hour=13)
+    cells = []
+    for i in range(2):
+        cell = Cell(f"cell_page_{i}", "", 1, 1, False, None)
+        cell.save()
+        cells.append(cell.id)
+        for minute in range(3):
+            # duplicate timestamps are only ordered by id
+            for v in range(2):
+                PowerData.add_power_data(
+                    "logger_1", f"cell_page_{i}", ts.replace(minute=minute), v, i
+                )
+
+    whole = PowerData.get_power_data_cells(cells, "none", ts, end)
+    assert [whole[cell_id]["next"] for cell_id in cells] == [None, None]
+
+    pages = []
+    cursor = None
+    while True:
+        data = PowerData.get_power_data_cells(
+            cells, "none", ts, end, limit=5, cursor=cursor
+        )
+        pages.append(data)
+        cursor = data[cells[0]]["next"]
+        if cursor is None:
+            break
+    assert len(pages) == 3
+    for cell_id in cells:
+        for key in ["timestamp", "v", "i"]:
+            values = [v for page in pages for v in page[cell_id][key]]
+            assert values == whole[cell_id][key]
+
+    # the cursor is returned by the endpoint and invalid cursors are rejected
+    query_string = {
+        "resample": "none",
+        "limit": 4,
+        "startTime": "Sat, 13 Jan 2024 00:00:00 GMT",
+        "endTime": "Sun, 14 Jan 2024 00:00:00 GMT",
+    }
+    data = init_database.get(f"/api/power/{cells[1]}", query_string=query_string)
+    data = data.get_json()
+    assert data["v"] == [0, 1e3, 0, 1e3]
+    query_string["cursor"] = data["next"]
+    data = init_database.get(f"/api/power/{cells[1]}", query_string=query_string)
+    data = data.get_json()
+    assert data["v"] == [0, 1e3]
+    assert data["next"] is None
+
+    query_string["cursor"] = "invalid"
+    with pytest.raises(ValidationError):
+        init_database.get(f"/api/power/{cells[1]}", query_string=query_string)
+
+
+def test_get_power_obj_interval(init_database):
+    """
+    GIVEN Power Data every minute
+    WHEN Power Data is resampled to an interval with and without origin
+    THEN check the averages of each interval bucket
+    """
+    ts = datetime(2024, 1, 13, 12)
+    cell = Cell("cell_interval", "", 1, 1, False, None)
+    cell.save()
+    for minute in range(30):
+        PowerData.add_power_data(
+            "logger_1", "cell_interval", ts.replace(minute=minute), minute, 1
+        )
+    end = ts.replace(hour=13)
+
+    data = PowerData.get_power_data_obj(cell.id, "15m", ts, end)
+    assert data["timestamp"] == [ts, ts.replace(minute=15)]
+    assert data["v"] == [7e3, 22e3]
+
+    origin = datetime(2024, 1, 1, 0, 5)
+    data = PowerData.get_power_data_obj(cell.id, "15m", ts, end, origin=origin)
+    assert data["timestamp"] == [
+        ts.replace(hour=11, minute=50),
+        ts.replace(minute=5),
+        ts.replace(minute=20),
+    ]
+    assert data["v"] == [2e3, 12e3, 24.5e3]
+
+    resp = init_database.get(
+        f"/api/power/{cell.id}",
+        query_string={
+            "resample": "10m",
+            "startTime": "Sat, 13 Jan 2024 00:00:00 GMT",
+            "endTime": "Sun, 14 Jan 2024 00:00:00 GMT",
+        },
+    )
+    assert resp.get_json()["v"] == [4.5e3, 14.5e3, 24.5e3]
+    with pytest.raises(ValidationError):
+        init_database.get(f"/api/power/{cell.id}", query_string={"resample": "5x"})
+
+
+def test_get_power_obj_auto(init_database, monkeypatch):
+    """
+    GIVEN Power Data every minute
+    WHEN Power Data is resampled with auto
+    THEN check the chosen interval gives at most points buckets
+    """
+    ts = datetime(2024, 1, 13, 12)
+    cell = Cell("cell_auto", "", 1, 1, False, None)
+    cell.save()
+    for minute in range(60):
+        PowerData.add_power_data(
+            "logger_1", "cell_auto", ts.replace(minute=minute), minute, 1
+        )
+    end = ts.replace(hour=13)
+
+    data = PowerData.get_power_data_obj(cell.id, "auto", ts, end, points=100)
+    assert data["resample"] == "none"
+    assert len(data["v"]) == 60
+
+    data = PowerData.get_power_data_obj(cell.id, "auto", ts, end, points=10)
+    assert data["resample"] == "10m"
+    expected = PowerData.get_power_data_obj(cell.id, "10m", ts, end)
+    assert data == {**expected, "resample": "10m"}
+
+    day = PowerData.get_power_data_cells(
+        [cell.id], "auto", ts, ts.replace(day=14), points=10
+    )[cell.id]
+    assert day["resample"] == "3h"
+    assert len(day["v"]) == 1
+
+    # the cadence of the latest rows is extrapolated over the range
+    monkeypatch.setattr(api.utils.resample, "CADENCE_SAMPLE", 10)
+    day = PowerData.get_power_data_cells(
+        [cell.id], "auto", ts, ts.replace(day=14), points=100
+    )[cell.id]
+    assert day["resample"] == "15m"
+
+
+def test_get_power_obj_aggregates(init_database):
+    """
+    GIVEN Power Data every minute
+    WHEN Power Data is resampled with multiple aggregates
+    THEN check each aggregate is returned as a parallel column
+    """
+    ts = datetime(2024, 1, 13, 12)
+    cell = Cell("cell_agg", "", 1, 1, False, None)
+    cell.save()
+    voltages = [3, 1, 4, 1, 5, 9, 2, 6]
+    for minute, v in enumerate(voltages):
+        PowerData.add_power_data(
+            "logger_1", "cell_agg", ts.replace(minute=minute), v, 1
+        )
+    end = ts.replace(hour=13)
+
+    agg = ["min", "max", "count", "stddev", "first", "last", "p50", "avg"]
+    data = PowerData.get_power_data_obj(cell.id, "hour", ts, end, agg=agg)
+    assert data["v"] == [pytest.approx(3.875e3)]
+    assert data["v_min"] == [1e3]
+    assert data["v_max"] == [9e3]
+    assert data["v_count"] == [8]
+    assert data["v_stddev"] == [pytest.approx(statistics.stdev(voltages) * 1e3)]
+    assert data["v_first"] == [3e3]
+    assert data["v_last"] == [6e3]
+    assert data["v_p50"] == [pytest.approx(3.5e3)]
+    assert data["i_max"] == [1e6]
+    assert "v_avg" not in data
+
+    # first and last of each bucket
+    data = PowerData.get_power_data_obj(
+        cell.id, "5m", ts, end, agg=["first", "last", "max"]
+    )
+    assert data["v"] == [pytest.approx(2.8e3), pytest.approx(17e3 / 3)]
+    assert data["v_first"] == [3e3, 9e3]
+    assert data["v_last"] == [5e3, 6e3]
+    assert data["v_max"] == [5e3, 9e3]
+    assert data["p_first"] == [3e6, 9e6]
+
+    # raw data is not aggregated
+    data = PowerData.get_power_data_obj(cell.id, "none", ts, end, agg=agg)
+    assert "v_min" not in data
+
+    resp = init_database.get(
+        f"/api/power/{cell.id}",
+        query_string={
+            "resample": "15m",
+            "agg": "min,max",
+            "startTime": "Sat, 13 Jan 2024 00:00:00 GMT",
+            "endTime": "Sun, 14 Jan 2024 00:00:00 GMT",
+        },
+    )
+    data = resp.get_json()
+    assert data["v_min"] == [1e3]
+    assert data["v_max"] == [9e3]
+    with pytest.raises(ValidationError):
+        init_database.get(f"/api/power/{cell.id}", query_string={"agg": "median"})
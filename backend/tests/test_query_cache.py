@@ -0,0 +1,156 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import fakeredis
+import pytest
+
+from api import db
+from api.models.cell import Cell
+from api.models.logger import Logger
+from api.models.power_data import PowerData
+from api.utils.bulk_write import copy_rows
+from api.utils.query_cache import bucket_start, query_cache
+
+from .test_sensor import _count_statements
+
+START = datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def cache():
+    """Enables the query cache on a fake redis server"""
+
+    query_cache.redis = fakeredis.FakeRedis()
+    yield query_cache
+    query_cache.redis = None
+
+
+@pytest.fixture
+def cell_logger(init_database):
+    cell = Cell("cell_query_cache")
+    cell.save()
+    logger = Logger("logger_query_cache")
+    logger.save()
+    yield cell, logger
+    PowerData.query.filter_by(cell_id=cell.id).delete()
+    cell.delete()
+    logger.delete()
+
+
+def _power_queries(fn) -> int:
+    return len([s for s in _count_statements(fn) if "FROM power_data" in s])
+
+
+@pytest.mark.parametrize(
+    "resample, expected",
+    [
+        ("none", datetime(2024, 5, 15, 13, 42)),
+        ("hour", datetime(2024, 5, 15, 13)),
+        ("day", datetime(2024, 5, 15)),
+        ("week", datetime(2024, 5, 13)),
+        ("month", datetime(2024, 5, 1)),
+        ("quarter", datetime(2024, 4, 1)),
+        ("year", datetime(2024, 1, 1)),
+        ("15m", datetime(2024, 5, 15, 13, 30)),
+        ("6h", datetime(2024, 5, 15, 12)),
+    ],
+)
+def test_bucket_start(resample, expected):
+    assert bucket_start(datetime(2024, 5, 15, 13, 42, 7, 5), resample) == expected
+
+
+def test_closed_window_cached(cache, cell_logger):
+    cell, logger = cell_logger
+    PowerData.add_power_data(logger.name, cell.name, START, 1, 2)
+
+    args = (cell.id, "hour", START, START + timedelta(days=1))
+    data = PowerData.get_power_data_obj(*args)
+    assert data["v"] == [1e3]
+
+    # served from the cache
+    results = []
+    assert (
+        _power_queries(lambda: results.append(PowerData.get_power_data_obj(*args))) == 0
+    )
+    assert results[0] == data
+
+    # new rows increment the version of the cell
+    PowerData.add_power_data(logger.name, cell.name, START + timedelta(hours=1), 3, 2)
+    data = PowerData.get_power_data_obj(*args)
+    assert data["v"] == [1e3, 3e3]
+
+
+def test_copy_invalidates(cache, cell_logger):
+    cell, logger = cell_logger
+    args = (cell.id, "none", START, START + timedelta(days=1))
+    assert PowerData.get_power_data_obj(*args)["v"] == []
+
+    copy_rows(db.session, "power_data", [(logger.id, cell.id, START, 2.0, 1.0)])
+    db.session.commit()
+
+    assert PowerData.get_power_data_obj(*args)["v"] == [1e3]
+
+
+def test_open_window_tail_is_fresh(cache, cell_logger):
+    cell, logger = cell_logger
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    hour = bucket_start(now, "hour")
+    PowerData.add_power_data(logger.name, cell.name, hour - timedelta(hours=2), 1, 2)
+    PowerData.add_power_data(logger.name, cell.name, hour, 1, 2)
+
+    args = (cell.id, "hour", hour - timedelta(hours=3), now + timedelta(hours=1))
+    data = PowerData.get_power_data_obj(*args)
+    assert data["timestamp"] == [hour - timedelta(hours=2), hour]
+
+    # rows written on a connection are not tracked, the closed buckets are
+    # served from the cache while the current bucket is queried
+    with db.engine.begin() as conn:
+        copy_rows(
+            conn,
+            "power_data",
+            [
+                # logger, cell, ts, current, voltage
+                (logger.id, cell.id, hour - timedelta(hours=1), 2.0, 1.0),
+                (logger.id, cell.id, hour, 2.0, 3.0),
+            ],
+        )
+
+    data = PowerData.get_power_data_obj(*args)
+    assert data["timestamp"] == [hour - timedelta(hours=2), hour]
+    assert data["v"] == [1e3, 2e3]
+
+
+def test_default_window_is_utc(cache, cell_logger, monkeypatch):
+    cell, logger = cell_logger
+    # local time is behind UTC
+    monkeypatch.setenv("TZ", "Pacific/Honolulu")
+    time.tzset()
+    try:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        PowerData.add_power_data(
+            logger.name, cell.name, now - timedelta(minutes=1), 1, 2
+        )
+        data = PowerData.get_power_data_obj(cell.id, "none")
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert data["v"] == [1e3]
+
+
+def test_endpoint_cached(init_database, cache, cell_logger):
+    cell, logger = cell_logger
+    PowerData.add_power_data(logger.name, cell.name, START, 1, 2)
+    url = f"/api/power/{cell.id}"
+    args = {
+        "resample": "none",
+        "startTime": "Mon, 01 Jan 2024 00:00:00 GMT",
+        "endTime": "Tue, 02 Jan 2024 00:00:00 GMT",
+    }
+
+    expected = init_database.get(url, query_string=args).get_json()
+    resp = []
+    assert (
+        _power_queries(lambda: resp.append(init_database.get(url, query_string=args)))
+        == 0
+    )
+    assert resp[0].get_json() == expected
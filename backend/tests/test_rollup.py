@@ -0,0 +1,223 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from api import db
+from api.models.cell import Cell
+from api.models.logger import Logger
+from api.models.power_data import PowerData
+from api.models.rollup import (
+    Rollup,
+    RollupWatermark,
+    rollup_resolution,
+    rollup_select,
+)
+from api.models.sensor import Sensor
+from api.models.teros_data import TEROSData
+from api.utils.bulk_write import copy_rows
+from api.utils.rollup import rebuild, refresh
+
+START = datetime(2024, 1, 1)
+
+
+@pytest.fixture(scope="module")
+def series(init_database):
+    cell = Cell("cell_rollup")
+    cell.save()
+    logger = Logger("logger_rollup")
+    logger.save()
+    sensor = Sensor(
+        cell_id=cell.id,
+        name="rollup",
+        measurement="temp",
+        unit="C",
+        data_type="float",
+    )
+    sensor.save()
+    return cell.id, logger.id, sensor.id
+
+
+def insert(series, minutes):
+    cell_id, logger_id, sensor_id = series
+    ts = [START + timedelta(minutes=m) for m in minutes]
+    copy_rows(
+        db.session,
+        "power_data",
+        [
+            (logger_id, cell_id, t, m % 7 + 0.5, m % 5 + 1.0)
+            for m, t in zip(minutes, ts)
+        ],
+    )
+    copy_rows(
+        db.session,
+        "teros_data",
+        [
+            (cell_id, t, (m % 9) / 10, 1.0, 20.0, m % 3, None)
+            for m, t in zip(minutes, ts)
+        ],
+    )
+    copy_rows(
+        db.session,
+        "data",
+        [(sensor_id, t, m % 11 + 0.25, None, None) for m, t in zip(minutes, ts)],
+    )
+    db.session.commit()
+
+
+def query(series, resample, start_time, end_time):
+    cell_id, _, sensor_id = series
+    return (
+        PowerData.get_power_data_obj(cell_id, resample, start_time, end_time),
+        TEROSData.get_teros_data_obj(cell_id, resample, start_time, end_time),
+        Sensor.get_sensor_data_obj(
+            "rollup", cell_id, "temp", resample, start_time, end_time
+        ),
+    )
+
+
+def assert_same(rolled, raw):
+    for rolled_obj, raw_obj in zip(rolled, raw):
+        assert rolled_obj.keys() == raw_obj.keys()
+        assert rolled_obj["timestamp"] == raw_obj["timestamp"]
+        for key, values in raw_obj.items():
+            if isinstance(values, list) and key != "timestamp":
+                assert rolled_obj[key] == pytest.approx(values), key
+
+
+def test_refresh(init_database, series):
+    # three days every 7 minutes
+    insert(series, range(0, 3 * 24 * 60, 7))
+
+    assert refresh("power", batch_size=100, eng=db.engine) == 618
+    assert refresh("power", eng=db.engine) == 0
+
+    cell_id = series[0]
+    day = Rollup.query.filter_by(
+        source="power", series_id=cell_id, resolution="day", measurement="voltage"
+    ).all()
+    assert sorted(r.count for r in day) == [206, 206, 206]
+    assert db.session.get(RollupWatermark, "power").last_id > 0
+
+
+@pytest.mark.parametrize(
+    "resample", ["minute", "hour", "day", "week", "month", "15m", "6h", "2d"]
+)
+def test_rollup_matches_raw(init_database, series, resample):
+    for source in ("power", "teros", "data"):
+        refresh(source, eng=db.engine)
+    # rows past the watermark, including late ones in rolled up buckets
+    insert(series, [1, 2, 3000, 3001, 4000])
+
+    # partial buckets at both ends of the range
+    start_time = START + timedelta(hours=10, minutes=30)
+    end_time = START + timedelta(days=2, hours=13, minutes=15)
+
+    assert (
+        rollup_select("power", [series[0]], resample, start_time, end_time) is not None
+    )
+    rolled = query(series, resample, start_time, end_time)
+
+    # raw aggregation once the rollups are gone
+    RollupWatermark.query.delete()
+    Rollup.query.delete()
+    db.session.commit()
+    raw = query(series, resample, start_time, end_time)
+
+    assert len(raw[0]["timestamp"]) > 0
+    assert_same(rolled, raw)
+
+
+def test_rollup_aggregates_match_raw(init_database, series):
+    for source in ("power", "teros", "data"):
+        refresh(source, eng=db.engine)
+    insert(series, [5, 3005])
+
+    start_time = START + timedelta(hours=10, minutes=30)
+    end_time = START + timedelta(days=2, hours=13, minutes=15)
+    agg = ["min", "max", "count"]
+    cell_id, _, sensor_id = series
+
+    def query():
+        return (
+            PowerData.get_power_data_obj(
+                cell_id, "hour", start_time, end_time, agg=agg
+            ),
+            TEROSData.get_teros_data_obj(
+                cell_id, "hour", start_time, end_time, agg=agg
+            ),
+            Sensor.get_sensor_data_obj(
+                "rollup", cell_id, "temp", "hour", start_time, end_time, agg=agg
+            ),
+        )
+
+    assert (
+        rollup_select(
+            "power", [cell_id], "hour", start_time, end_time, aggregates=["max"]
+        )
+        is not None
+    )
+    assert (
+        rollup_select(
+            "power", [cell_id], "hour", start_time, end_time, aggregates=["stddev"]
+        )
+        is None
+    )
+    rolled = query()
+
+    RollupWatermark.query.delete()
+    Rollup.query.delete()
+    db.session.commit()
+    raw = query()
+
+    assert raw[0]["v_count"][0] > 0
+    assert raw[2]["data_max"]
+    assert_same(rolled, raw)
+
+
+def test_refresh_waits_for_open_transactions(init_database, series):
+    cell_id, logger_id, _ = series
+    refresh("power", eng=db.engine)
+    count = PowerData.query.filter_by(cell_id=cell_id).count()
+
+    # a slow transaction holding an id below a row committed after it
+    with db.engine.connect() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO power_data (logger_id, cell_id, ts, voltage, current) "
+                "VALUES (:logger_id, :cell_id, :ts, 1, 1)"
+            ),
+            {"logger_id": logger_id, "cell_id": cell_id, "ts": START},
+        )
+        insert(series, [6000])
+
+        # the committed row is held back until the transaction ended
+        assert refresh("power", eng=db.engine) == 0
+        conn.commit()
+
+    assert refresh("power", eng=db.engine) == 2
+    rolled = Rollup.query.filter_by(
+        source="power", series_id=cell_id, resolution="day", measurement="voltage"
+    ).all()
+    assert sum(r.count for r in rolled) == count + 2
+
+
+def test_rebuild(init_database, series):
+    refresh("data", eng=db.engine)
+    sensor_id = series[2]
+    before = Rollup.query.filter_by(source="data", series_id=sensor_id).count()
+
+    rows = rebuild("data", eng=db.engine)
+
+    assert rows > 0
+    assert Rollup.query.filter_by(source="data", series_id=sensor_id).count() == before
+
+
+def test_second_resample_reads_raw(init_database, series):
+    refresh("power", eng=db.engine)
+    assert rollup_select("power", [series[0]], "second", START, START) is None
+    assert rollup_select("power", [series[0]], "90s", START, START) is None
+    # buckets of the hour rollup span two interval buckets
+    origin = START + timedelta(minutes=30)
+    assert rollup_select("power", [series[0]], "6h", START, START, origin) is not None
+    assert rollup_resolution("6h", origin) == "minute"
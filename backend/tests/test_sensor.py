@@ -1,6 +1,11 @@
-from api.models.sensor import Sensor
+import api.utils.pagination
+from api import db
+from api.models.sensor import Sensor, sensor_registry
 from api.models.cell import Cell
+from api.models.data import Data
 from datetime import datetime
+from sqlalchemy import event
+from api.utils.pagination import decode_stream_cursor
 
 
 def test_new_sensor_data(init_database):
@@ -135,3 +140,277 @@ def test_sensor_endpoint_returns_only_sensors(init_database):
     returned_ids = [sensor["id"] for sensor in result]
     assert sensor.id in returned_ids
     assert all(sensors["cell_id"] == cell.id for sensors in result)
+
+
+def test_cell_sensor_data_endpoint(init_database):
+    ts = 1705176162
+    cell = Cell("test_cell_sensor_data", "", 1, 1, False, None)
+    cell.save()
+
+    measurements = (("temperature", "C"), ("humidity", "%"), ("pressure", "kPa"))
+    for i in range(3):
+        meas_dict = {
+            "type": "bme280",
+            "cellId": cell.id,
+            "data": {"temperature": 20.0 + i, "humidity": 40.0, "pressure": 101.3},
+            "ts": ts + i * 60,
+        }
+        sensors = Sensor.add_measurements(meas_dict, measurements)
+    Sensor.add_data(
+        "status",
+        "",
+        {"type": "logger", "cellId": cell.id, "data": {"status": "ok"}, "ts": ts},
+    )
+    sensor_ids = [data.sensor_id for data in sensors]
+
+    args = {
+        "startTime": "Sat, 13 Jan 2024 00:00:00 GMT",
+        "endTime": "Sun, 14 Jan 2024 00:00:00 GMT",
+        "resample": "none",
+    }
+    response = init_database.get(
+        f"/api/cell/{cell.id}/sensors/data",
+        query_string={"names": "bme280", **args},
+    )
+
+    assert response.status_code == 200
+    result = response.get_json()
+    assert list(result) == [f"s:{sensor_id}" for sensor_id in sensor_ids]
+    for sensor_id, (measurement, _) in zip(sensor_ids, measurements):
+        sensor = db.session.get(Sensor, sensor_id)
+        expected = init_database.get(
+            "/api/sensor/",
+            query_string={
+                "cellId": cell.id,
+                "name": "bme280",
+                "measurement": measurement,
+                **args,
+            },
+        ).get_json()
+        assert result[f"s:{sensor_id}"] == expected
+        assert expected["unit"] == sensor.unit
+    assert result[f"s:{sensor_ids[0]}"]["data"] == [20.0, 21.0, 22.0]
+
+    # filtered by measurement and resampled in one query
+    statements = []
+
+    def get():
+        statements.append(
+            init_database.get(
+                f"/api/cell/{cell.id}/sensors/data",
+                query_string={
+                    **args,
+                    "measurements": "temperature,humidity",
+                    "resample": "hour",
+                },
+            ).get_json()
+        )
+
+    queries = _count_statements(get)
+    result = statements[0]
+    assert list(result) == [f"s:{sensor_id}" for sensor_id in sensor_ids[:2]]
+    assert result[f"s:{sensor_ids[0]}"]["data"] == [21.0]
+    assert result[f"s:{sensor_ids[1]}"]["data"] == [40.0]
+    assert len([q for q in queries if "FROM data" in q]) == 1
+
+
+def test_sensor_endpoint_after_cursor(init_database, monkeypatch):
+    # rows are streamed right after they are inserted
+    monkeypatch.setattr(api.utils.pagination, "STREAM_LAG", 0)
+    ts = 1705176162
+    cell = Cell("test_cell_sensor_cursor", "", 1, 1, False, None)
+    cell.save()
+
+    def add(value, offset):
+        meas_dict = {
+            "type": "cursor",
+            "cellId": cell.id,
+            "data": {"temperature": value},
+            "ts": ts + offset,
+        }
+        Sensor.add_data("temperature", "C", meas_dict)
+
+    args = {
+        "cellId": cell.id,
+        "name": "cursor",
+        "measurement": "temperature",
+        "startTime": "Sat, 13 Jan 2024 00:00:00 GMT",
+        "endTime": "Sun, 14 Jan 2024 00:00:00 GMT",
+        "stream": True,
+    }
+    add(20.0, 0)
+    first = init_database.get("/api/sensor/", query_string=args).get_json()
+    assert first["data"] == [20.0]
+
+    add(21.0, 60)
+    data = init_database.get(
+        "/api/sensor/", query_string={**args, "after": first["cursor"]}
+    ).get_json()
+    assert data["data"] == [21.0]
+    assert decode_stream_cursor(data["cursor"]) > decode_stream_cursor(first["cursor"])
+
+
+def test_sensors_data_pages(init_database):
+    """
+    GIVEN raw data of sensors of different data types
+    WHEN it is requested in pages
+    THEN check the pages cover every row once in order
+    """
+    ts = 1705176162
+    cell = Cell("test_cell_sensor_pages", "", 1, 1, False, None)
+    cell.save()
+    for offset in range(3):
+        meas_dict = {
+            "type": "pages",
+            "cellId": cell.id,
+            "data": {"temperature": 20.0 + offset, "count": offset},
+            "ts": ts + offset * 60,
+        }
+        Sensor.add_measurements(meas_dict, (("temperature", "C"), ("count", "")))
+    sensors = Sensor.query.filter_by(cell_id=cell.id).order_by(Sensor.id).all()
+    assert [sensor.data_type for sensor in sensors] == ["float", "int"]
+
+    start = datetime(2024, 1, 13)
+    end = datetime(2024, 1, 14)
+    whole = Sensor.get_sensors_data_obj(sensors, "none", start, end)
+    pages = []
+    cursor = None
+    while True:
+        data = Sensor.get_sensors_data_obj(
+            sensors, "none", start, end, limit=2, cursor=cursor
+        )
+        pages.append(data)
+        cursor = data[sensors[0].id]["next"]
+        if cursor is None:
+            break
+    assert len(pages) == 3
+    assert [len(page[sensors[1].id]["data"]) for page in pages] == [0, 1, 2]
+    for sensor in sensors:
+        values = [v for page in pages for v in page[sensor.id]["data"]]
+        assert values == whole[sensor.id]["data"]
+
+
+def _count_statements(fn):
+    """Run fn and return the SQL statements it executed."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+
+def test_sensor_registry_cached_insert(init_database):
+    cell = Cell("cell_registry", "", 1, 1, False, None)
+    cell.save()
+    meas_dict = {
+        "type": "registry_type",
+        "cellId": cell.id,
+        "data": {"registry_meas": 1.5},
+        "ts": 1705176162,
+    }
+
+    data = Sensor.add_data("registry_meas", "unit", meas_dict)
+    assert sensor_registry.get(cell.id, "registry_type", "registry_meas") == (
+        data.sensor_id,
+        "float",
+    )
+
+    statements = _count_statements(
+        lambda: Sensor.add_data("registry_meas", "unit", meas_dict)
+    )
+    inserts = [s for s in statements if s.startswith("INSERT")]
+    selects = [s for s in statements if s.startswith("SELECT")]
+    assert len(inserts) == 1
+    assert "INSERT INTO data" in inserts[0]
+    assert not selects
+    assert Sensor.query.filter_by(cell_id=cell.id).count() == 1
+
+
+def test_sensor_registry_rollback_not_cached(init_database):
+    cell = Cell("cell_registry_rollback", "", 1, 1, False, None)
+    cell.save()
+    meas_dict = {
+        "type": "registry_type",
+        "cellId": cell.id,
+        "data": {"registry_meas": 1},
+        "ts": 1705176162,
+    }
+
+    Sensor.add_data("registry_meas", "unit", meas_dict, commit=False)
+    db.session.rollback()
+
+    assert sensor_registry.get(cell.id, "registry_type", "registry_meas") is None
+    assert Sensor.query.filter_by(cell_id=cell.id).count() == 0
+
+
+def test_sensor_registry_invalidated_on_cell_delete(init_database):
+    cell = Cell("cell_registry_delete", "", 1, 1, False, None)
+    cell.save()
+    cell_id = cell.id
+    meas_dict = {
+        "type": "registry_type",
+        "cellId": cell_id,
+        "data": {"registry_meas": 1},
+        "ts": 1705176162,
+    }
+    Sensor.add_data("registry_meas", "unit", meas_dict)
+    assert sensor_registry.get(cell_id, "registry_type", "registry_meas")
+
+    cell.delete()
+
+    assert sensor_registry.get(cell_id, "registry_type", "registry_meas") is None
+    assert Sensor.add_data("registry_meas", "unit", meas_dict) is None
+
+
+def test_sensor_registry_rejects_data_type_mismatch(init_database):
+    cell = Cell("cell_registry_type", "", 1, 1, False, None)
+    cell.save()
+    meas_dict = {
+        "type": "registry_type",
+        "cellId": cell.id,
+        "data": {"registry_meas": 1.5},
+        "ts": 1705176162,
+    }
+    data = Sensor.add_data("registry_meas", "unit", meas_dict)
+    assert data is not None
+
+    # an int value of a float sensor would not be read back
+    meas_dict["data"]["registry_meas"] = 2
+    assert Sensor.add_data("registry_meas", "unit", meas_dict) is None
+    assert Data.query.filter_by(sensor_id=data.sensor_id).count() == 1
+
+    # also when the sensor is not cached yet
+    sensor_registry.clear()
+    assert Sensor.add_data("registry_meas", "unit", meas_dict) is None
+    assert Data.query.filter_by(sensor_id=data.sensor_id).count() == 1
+
+
+def test_sensor_registry_warmed_on_first_lookup(init_database):
+    cell = Cell("cell_registry_warm", "", 1, 1, False, None)
+    cell.save()
+    meas_dict = {
+        "type": "registry_type",
+        "cellId": cell.id,
+        "data": {"registry_meas": 1.5},
+        "ts": 1705176162,
+    }
+    data = Sensor.add_data("registry_meas", "unit", meas_dict)
+    cell_id, sensor_id = cell.id, data.sensor_id
+    sensor_registry.clear()
+
+    entries = []
+
+    def get():
+        entries.append(sensor_registry.get(cell_id, "registry_type", "registry_meas"))
+
+    statements = _count_statements(get)
+    assert len(statements) == 1
+    assert "FROM sensor" in statements[0]
+    assert _count_statements(get) == []
+    assert entries == [(sensor_id, "float")] * 2
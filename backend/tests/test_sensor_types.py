@@ -0,0 +1,117 @@
+from unittest.mock import patch
+
+from api import db
+from api.models.cell import Cell
+from api.models.data import Data
+from api.models.logger import Logger
+from api.models.sensor import Sensor
+from api.resources.util import process_generic_measurement, process_measurement_dict
+from api.utils.sensor_types import SENSOR_TYPES, add_reading
+
+from ents.proto.sensor import format_sensor_measurement
+
+
+def test_registry_compiled():
+    bme280 = SENSOR_TYPES["bme280"]
+    assert bme280.measurements == (
+        ("pressure", "hPa"),
+        ("temperature", "C"),
+        ("humidity", "%"),
+    )
+    assert SENSOR_TYPES["power"].add is not bme280.add
+
+
+def test_co2_reading_inserts_all_measurements(init_database):
+    cell = Cell("cell_sensor_types_co2")
+    cell.save()
+    meas = {
+        "type": "co2",
+        "cellId": cell.id,
+        "loggerId": 1,
+        "ts": 1705176162,
+        "data": {"CO2": 415.0, "state": 1, "Photoresistivity": 1200.0},
+    }
+
+    with patch.object(db.session, "commit", wraps=db.session.commit) as mock_commit:
+        obj_list = add_reading(meas)
+
+    # the reading is written with a single commit
+    assert mock_commit.call_count == 1
+    assert len(obj_list) == 3
+    assert None not in obj_list
+
+    sensors = Sensor.query.filter_by(cell_id=cell.id, name="co2").all()
+    assert sorted(s.measurement for s in sensors) == [
+        "CO2",
+        "Photoresistivity",
+        "state",
+    ]
+    assert Sensor.query.filter_by(measurement="Photoresistivity").one().unit == "Ohms"
+    sensor_ids = [s.id for s in sensors]
+    assert Data.query.filter(Data.sensor_id.in_(sensor_ids)).count() == 3
+
+
+def test_unknown_type(init_database):
+    meas = {"type": "unknown", "cellId": 1, "loggerId": 1, "ts": 0, "data": {}}
+
+    assert add_reading(meas) == []
+    assert process_measurement_dict(meas).status_code == 200
+
+
+def test_unknown_cell(init_database):
+    meas = {
+        "type": "bme280",
+        "cellId": 123456789,
+        "loggerId": 1,
+        "ts": 1705176162,
+        "data": {"pressure": 1000.0, "temperature": 20.0, "humidity": 50.0},
+    }
+
+    assert add_reading(meas) == [None, None, None]
+    assert process_measurement_dict(meas).status_code == 501
+
+
+def test_generic_message_single_transaction(init_database):
+    cell = Cell("cell_sensor_types_generic")
+    cell.save()
+    logger = Logger("logger_sensor_types_generic")
+    logger.save()
+
+    meta = {"cellId": cell.id, "loggerId": logger.id, "ts": 1705176162}
+    data = format_sensor_measurement(
+        [
+            {"meta": meta, "type": "BME280_TEMP", "decimal": 20.5},
+            {"meta": meta, "type": "BME280_PRESSURE", "decimal": 101.3},
+            {"meta": meta, "type": "POWER_VOLTAGE", "decimal": 3.3},
+        ]
+    )
+
+    with patch("api.resources.util.socketio") as mock_socketio:
+        with patch.object(db.session, "commit", wraps=db.session.commit) as mock_commit:
+            resp = process_generic_measurement(data)
+
+    assert resp.status_code == 200
+    assert mock_commit.call_count == 1
+    # readings of the cell are sent as one event
+    mock_socketio.emit.assert_called_once()
+    event, events = mock_socketio.emit.call_args[0]
+    assert event == "measurements_received"
+    assert [e["type"] for e in events] == [
+        "BME280_TEMP",
+        "BME280_PRESSURE",
+        "POWER_VOLTAGE",
+    ]
+    assert mock_socketio.emit.call_args[1]["room"] == f"cell_{cell.id}"
+    assert Sensor.query.filter_by(cell_id=cell.id).count() == 3
+
+
+def test_generic_message_unknown_cell(init_database):
+    meta = {"cellId": 123456789, "loggerId": 1, "ts": 1705176162}
+    data = format_sensor_measurement(
+        [{"meta": meta, "type": "POWER_VOLTAGE", "decimal": 3.3}]
+    )
+
+    resp = process_generic_measurement(data)
+
+    assert resp.status_code == 400
+    assert Sensor.query.filter_by(cell_id=123456789).count() == 0
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+import redis
+import socketio
+from fakeredis import TcpFakeServer
+
+# an ingest process publishing measurements of cell 1
+EMITTER = """
+from api import create_app
+from api.resources.util import EmitBuffer
+
+create_app(emit_only=True)
+emits = EmitBuffer()
+for ts in (1705176162, 1705176222):
+    emits.add({"type": "power", "cellId": 1, "ts": ts, "data": {}}, 2)
+emits.flush()
+"""
+
+
+@pytest.fixture(scope="session")
+def redis_url():
+    """Local redis server shared by the processes
+
+    The server is left running, the socket.io listener thread cannot be
+    stopped and retries forever once its connection is closed.
+    """
+
+    server = TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    # connection handlers must not keep the test process alive
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return f"redis://127.0.0.1:{server.server_address[1]}"
+
+
+def test_emit_from_ingest_process(init_database, redis_url):
+    # worker hosting a client subscribed to cell 1
+    manager = socketio.RedisManager(redis_url, channel="flask-socketio")
+    server = socketio.Server(async_mode="threading", client_manager=manager)
+    sent = []
+    server._send_eio_packet = lambda eio_sid, pkt: sent.append(pkt.data)
+    sid = manager.connect("eio_sid", "/")
+    manager.enter_room(sid, "/", "cell_1")
+    manager.initialize()
+
+    client = redis.Redis.from_url(redis_url)
+    for _ in range(50):
+        if client.pubsub_numsub("flask-socketio")[0][1]:
+            break
+        time.sleep(0.1)
+
+    env = dict(
+        os.environ,
+        SOCKETIO_MESSAGE_QUEUE=redis_url,
+        TEST_SQLALCHEMY_DATABASE_URI=init_database.application.config[
+            "SQLALCHEMY_DATABASE_URI"
+        ],
+    )
+    subprocess.run(
+        [sys.executable, "-c", EMITTER],
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+        env=env,
+        check=True,
+        timeout=60,
+    )
+
+    for _ in range(50):
+        if sent:
+            break
+        time.sleep(0.1)
+
+    # socket.io event packet, type 2 followed by [event, data]
+    assert len(sent) == 1
+    event, events = json.loads(sent[0][1:])
+    assert event == "measurements_received"
+    assert [e["timestamp"] for e in events] == [1705176162, 1705176222]
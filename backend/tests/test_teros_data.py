@@ -277,3 +277,37 @@ def test_get_teros_obj_hour_resample_normalizes_before_averaging(init_database):
 
     assert len(teros_data_obj["vwc"]) == 1
     assert teros_data_obj["vwc"][0] == pytest.approx(40.0)
+
+
+def test_get_teros_cells(init_database):
+    """
+    GIVEN multiple cells with TEROS Data
+    WHEN TEROS Data of the cells is requested at once
+    THEN check the data of each cell matches a single cell request
+    """
+    ts = datetime(2024, 1, 13, 12)
+    cells = []
+    for i in range(3):
+        cell = Cell(f"cell_teros_multi_{i}", "", 1, 1, False, None)
+        cell.save()
+        cells.append(cell.id)
+        for minute in range(i * 5):
+            TEROSData.add_teros_data(
+                f"cell_teros_multi_{i}",
+                ts.replace(minute=minute),
+                0.25,
+                minute,
+                20.0 + i,
+                4,
+                None,
+            )
+
+    end = ts.replace(hour=13)
+    for resample in ["none", "hour"]:
+        data = TEROSData.get_teros_data_cells(cells, resample, ts, end)
+        assert list(data) == cells
+        for cell_id in cells:
+            assert data[cell_id] == TEROSData.get_teros_data_obj(
+                cell_id, resample, ts, end
+            )
+    assert data[cells[2]]["temp"] == [22.0]
@@ -1,13 +1,23 @@
-from api.resources.util import process_measurement_dict, process_generic_measurement
+from api.resources import util
+from api.resources.util import (
+    EmitBuffer,
+    EmitWindow,
+    process_measurement_dict,
+    process_generic_measurement,
+    split_delimited,
+)
 from datetime import datetime
 from unittest.mock import patch
 from api.models.logger import Logger
 from api.models.cell import Cell
 from api.models.sensor import Sensor
 from api.models.data import Data
+from api.models.power_data import PowerData
 import os
 
+import pytest
 
+from ents.proto import encode_power_measurement
 from ents.proto.sensor import format_sensor_measurement
 
 
@@ -227,3 +237,202 @@ def test_socketio_emit_error_handling():
             mock_socketio.emit("test", {}, room="test_room")
         except Exception as e:
             assert str(e) == "Connection error"
+
+
+def _delimited(msg: bytes) -> bytes:
+    """Prefix a message with its varint encoded length."""
+    prefix = bytearray()
+    length = len(msg)
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        if length:
+            prefix.append(byte | 0x80)
+        else:
+            prefix.append(byte)
+            break
+    return bytes(prefix) + msg
+
+
+def test_split_delimited():
+    msgs = [b"", b"a", b"x" * 300]
+    data = b"".join(_delimited(m) for m in msgs)
+    assert split_delimited(data) == msgs
+
+
+def test_split_delimited_truncated():
+    data = _delimited(b"x" * 10)[:-1]
+    with pytest.raises(ValueError):
+        split_delimited(data)
+
+
+def test_measurement_batch_json(init_database):
+    logger = Logger("logger_batch_json")
+    logger.save()
+    cell = Cell("cell_batch_json")
+    cell.save()
+
+    ts = 1705176162
+    batch = [
+        {
+            "type": "power",
+            "loggerId": logger.id,
+            "cellId": cell.id,
+            "ts": ts,
+            "data": {"voltage": 3.3, "current": 0.5},
+        },
+        {
+            "type": "bme280",
+            "loggerId": logger.id,
+            "cellId": cell.id,
+            "ts": ts,
+            "data": {"pressure": 1013.2, "temperature": 22.5, "humidity": 43.6},
+        },
+        # unknown cell
+        {
+            "type": "power",
+            "loggerId": logger.id,
+            "cellId": 123451223,
+            "ts": ts,
+            "data": {"voltage": 3.3, "current": 0.5},
+        },
+        # missing humidity after the other bme280 values were added
+        {
+            "type": "bme280",
+            "loggerId": logger.id,
+            "cellId": cell.id,
+            "ts": ts + 60,
+            "data": {"pressure": 1013.2, "temperature": 22.5},
+        },
+        {
+            "type": "power",
+            "loggerId": logger.id,
+            "cellId": cell.id,
+            "ts": ts + 60,
+            "data": {"voltage": 3.1, "current": 0.4},
+        },
+    ]
+
+    with patch("api.resources.util.socketio") as mock_socketio:
+        resp = init_database.post("/api/sensor_json/", json=batch)
+
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body["status"] == [200, 200, 501, 400, 200]
+    assert body["inserted"] == 3
+    assert body["failed"] == 2
+    # the measurements of the cell are sent as one event
+    mock_socketio.emit.assert_called_once()
+    event, events = mock_socketio.emit.call_args[0]
+    assert event == "measurements_received"
+    assert [e["timestamp"] for e in events] == [ts, ts, ts + 60]
+
+    assert PowerData.query.filter_by(cell_id=cell.id).count() == 2
+    sensor_ids = [s.id for s in Sensor.query.filter_by(cell_id=cell.id).all()]
+    assert len(sensor_ids) == 3
+    assert Data.query.filter(Data.sensor_id.in_(sensor_ids)).count() == 3
+
+
+def test_measurement_batch_malformed_checked_once(init_database):
+    logger = Logger("logger_batch_malformed")
+    logger.save()
+    cell = Cell("cell_batch_malformed")
+    cell.save()
+
+    ts = 1705176162
+    power = {
+        "type": "power",
+        "loggerId": logger.id,
+        "cellId": cell.id,
+        "data": {"voltage": 3.3, "current": 0.5},
+    }
+    batch = [
+        {**power, "ts": ts},
+        {**power, "ts": "now"},
+        {**power, "ts": ts + 1, "data": {"voltage": 3.3}},
+        {**power, "ts": ts + 2},
+        {"type": "power"},
+        {**power, "ts": ts + 3},
+    ]
+
+    # measurements are only added once, the batch is not started over for
+    # each malformed entry
+    with patch("api.resources.util.socketio"), patch(
+        "api.resources.util.add_measurement_dict",
+        wraps=util.add_measurement_dict,
+    ) as add:
+        resp = init_database.post("/api/sensor_json/", json=batch)
+
+    assert resp.status_code == 200
+    assert resp.get_json()["status"] == [200, 400, 400, 200, 400, 200]
+    assert add.call_count == 3
+    assert PowerData.query.filter_by(cell_id=cell.id).count() == 3
+
+
+def test_measurement_batch_binary(init_database):
+    logger = Logger("logger_batch_binary")
+    logger.save()
+    cell = Cell("cell_batch_binary")
+    cell.save()
+
+    ts = 1705176162
+    data = b"".join(
+        [
+            _delimited(encode_power_measurement(ts, cell.id, logger.id, 3.3, 0.5)),
+            _delimited(b"\xff\xff"),
+            _delimited(encode_power_measurement(ts + 1, cell.id, logger.id, 3.1, 0.4)),
+        ]
+    )
+
+    with patch("api.resources.util.socketio"):
+        resp = init_database.post(
+            "/api/sensor/",
+            data=data,
+            headers={"Content-Type": "application/octet-stream", "Batch": "true"},
+        )
+
+    assert resp.status_code == 200
+    assert resp.get_json()["status"] == [200, 400, 200]
+    assert PowerData.query.filter_by(cell_id=cell.id).count() == 2
+
+
+def test_emit_buffer_per_room():
+    buffer = EmitBuffer()
+    for cell_id, ts in [(1, 0), (2, 0), (1, 60), (None, 0)]:
+        buffer.add({"type": "power", "cellId": cell_id, "ts": ts, "data": {}}, 2)
+
+    with patch("api.resources.util.socketio") as mock_socketio:
+        buffer.flush()
+        buffer.flush()
+
+    assert mock_socketio.emit.call_count == 2
+    calls = {c[1]["room"]: c[0] for c in mock_socketio.emit.call_args_list}
+    event, events = calls["cell_1"]
+    assert event == "measurements_received"
+    assert [e["timestamp"] for e in events] == [0, 60]
+    event, data = calls["cell_2"]
+    assert event == "measurement_received"
+    assert data["obj_count"] == 2
+
+
+def test_emit_window_merges_requests():
+    window = EmitWindow(0.25)
+
+    with patch("api.resources.util.socketio") as mock_socketio:
+        for ts in (0, 60):
+            buffer = EmitBuffer(window)
+            buffer.add({"type": "power", "cellId": 1, "ts": ts, "data": {}}, 2)
+            buffer.flush()
+
+        # a single task is scheduled for the window
+        mock_socketio.start_background_task.assert_called_once_with(window._run)
+        mock_socketio.emit.assert_not_called()
+
+        window._run()
+
+    mock_socketio.sleep.assert_called_once_with(0.25)
+    mock_socketio.emit.assert_called_once()
+    event, events = mock_socketio.emit.call_args[0]
+    assert event == "measurements_received"
+    assert [e["timestamp"] for e in events] == [0, 60]
+    assert not window.scheduled
@@ -297,29 +297,27 @@ function Dashboard() {
     });
   }, []);
 
-  // processing for WebSocket updates
+  // processing for WebSocket updates, a single measurement or a list of
+  // measurements coalesced by the server
   const processImmediateUpdate = useCallback(
     (data) => {
       if (processingRef.current) return;
       processingRef.current = true;
 
       try {
+        const receivedAt = new Date().toISOString();
+        const updates = (Array.isArray(data) ? data : [data]).map((measurement) => ({
+          ...measurement,
+          receivedAt,
+        }));
+
         // Always collect data in background
-        backgroundStreamDataRef.current = [
-          ...backgroundStreamDataRef.current,
-          { ...data, receivedAt: new Date().toISOString() },
-        ].slice(-200);
+        backgroundStreamDataRef.current = [...backgroundStreamDataRef.current, ...updates].slice(-200);
 
         // Update live data if streaming
         if (stream) {
           setLiveData((prevData) => {
-            const newData = [
-              ...prevData,
-              {
-                ...data,
-                receivedAt: new Date().toISOString(),
-              },
-            ];
+            const newData = [...prevData, ...updates];
             return newData.slice(-100);
           });
 
@@ -365,6 +363,9 @@ function Dashboard() {
     socket.on('measurement_received', (data) => {
       processImmediateUpdate(data);
     });
+    socket.on('measurements_received', (data) => {
+      processImmediateUpdate(data);
+    });
     socket.on('connect_error', () => {});
 
     return () => {